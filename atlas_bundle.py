@@ -0,0 +1,191 @@
+"""
+Single file atlas bundles.
+
+A bundle packs everything the pipeline needs from an atlas into one chunk
+file (see chunkfile.py), replacing the atlas file, the folder of cluster
+files and the MRML file.
+    points, offsets - the atlas fibers in atlas space, see streamlines.py
+    cluster_ids - np.int32 cluster of each fiber
+    meta - the cluster names, the cluster -> tract hierarchy from the MRML
+        file and sha1 hashes of the source files
+"""
+import datetime
+import glob
+import hashlib
+import logging
+import os
+import re
+import numpy as np
+import vtkio
+from chunkfile import ChunkReader, ChunkWriter
+from parse_mrml import MapTracts
+from streamlines import hash_streams, find_hashes, unpack_streamlines
+
+logger = logging.getLogger(__name__)
+
+BUNDLE_VERSION = 1
+
+DEFAULT_CLUSTER_PATTERN = r'^.*cluster_\d{5}'
+
+
+class BundleError(Exception):
+    pass
+
+
+def find_cluster_files(clusterDir, pattern=None):
+    """
+    Finds the cluster files in clusterDir.
+    pattern is a regex the cluster name (filename without extension)
+    must match, default '^.*cluster_\\d{5}'
+    Returns a sorted list of cluster names
+    """
+    # set a default pattern, so other files in the folder don't get processed
+    if not pattern:
+        pattern = DEFAULT_CLUSTER_PATTERN
+
+    clusters = glob.glob(os.path.join(clusterDir, '*'))
+    # just get the cluster filename
+    clusters = [os.path.splitext(os.path.basename(f))[0]
+                for f in clusters]
+    clusters = set(clusters)
+    p = re.compile(pattern)
+    return(sorted(f for f in clusters if p.match(f)))
+
+
+def sha1_file(fname):
+    """
+    Returns the hex sha1 of a file
+    """
+    sha = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(2 ** 20), b''):
+            sha.update(block)
+    return(sha.hexdigest())
+
+
+def create_bundle(bundle_file, atlas_file, cluster_dir, mrml_file,
+                  pattern=None, chunk_rows=2 ** 18, compress=6):
+    """
+    Creates an atlas bundle.
+
+    Inputs:
+        atlas_file - the whole atlas (.vtp or .vtk)
+        cluster_dir - folder with one .vtp or .vtk file per cluster
+        mrml_file - Slicer hierarchy mapping clusters to tracts
+        pattern - regex limiting the files used in cluster_dir
+        chunk_rows - rows per chunk in the bundle
+        compress - zlib compression level, 0 stores the arrays uncompressed
+    """
+    clusters = find_cluster_files(cluster_dir, pattern)
+    logger.info('Found {} cluster files.'.format(len(clusters)))
+
+    hashes = []
+    cluster_ids = []
+    cluster_sha1 = {}
+    for cluster_id, cluster in enumerate(clusters):
+        cluster_file = None
+        for ext in ['.vtp', '.vtk']:
+            if os.path.isfile(os.path.join(cluster_dir, cluster + ext)):
+                cluster_file = os.path.join(cluster_dir, cluster + ext)
+                break
+        if not cluster_file:
+            raise BundleError('No .vtp or .vtk file for cluster:{}'
+                              .format(cluster))
+        logger.debug('Reading cluster:{}'.format(cluster_file))
+        points, offsets = vtkio.read_polydata(cluster_file)
+        hashes.append(hash_streams(unpack_streamlines(points, offsets)))
+        cluster_ids.append(np.full(len(offsets) - 1, cluster_id,
+                                   dtype=np.int32))
+        cluster_sha1[cluster] = sha1_file(cluster_file)
+
+    hashes = np.concatenate(hashes) if hashes else np.empty(0, np.uint64)
+    cluster_ids = (np.concatenate(cluster_ids) if cluster_ids
+                   else np.empty(0, np.int32))
+    # a fiber in several clusters gets the first of them, like
+    # match_streams
+    order = np.argsort(hashes, kind='mergesort')
+
+    logger.info('Reading atlas:{}'.format(atlas_file))
+    points, offsets = vtkio.read_polydata(atlas_file)
+    atlas_hashes = hash_streams(unpack_streamlines(points, offsets))
+    idx, found = find_hashes(hashes[order], atlas_hashes)
+    if not found.all():
+        raise BundleError('{} atlas fibers not found in any cluster'
+                          .format(np.count_nonzero(~found)))
+    fiber_clusters = cluster_ids[order].take(idx)
+
+    tract_map = MapTracts(mrml_file).tract_map
+
+    with ChunkWriter(bundle_file, chunk_rows=chunk_rows,
+                     compress=compress) as writer:
+        writer.meta = {
+            'version': BUNDLE_VERSION,
+            'atlas_name': os.path.splitext(os.path.basename(atlas_file))[0],
+            'cluster_names': clusters,
+            'tract_map': tract_map,
+            'provenance': {
+                'created': datetime.datetime.utcnow().isoformat(),
+                'atlas_file': os.path.abspath(atlas_file),
+                'atlas_sha1': sha1_file(atlas_file),
+                'cluster_dir': os.path.abspath(cluster_dir),
+                'cluster_sha1': cluster_sha1,
+                'mrml_file': os.path.abspath(mrml_file),
+                'mrml_sha1': sha1_file(mrml_file)}}
+        writer.append('points', points)
+        writer.append('offsets', offsets)
+        writer.append('cluster_ids', fiber_clusters)
+
+    logger.info('Wrote {} fibers in {} clusters to:{}'
+                .format(len(fiber_clusters), len(clusters), bundle_file))
+
+
+class AtlasBundle(object):
+    """
+    Lazily opened atlas bundle.
+    Arrays are only read from the file when they are used.
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        self.reader = ChunkReader(fname)
+        meta = self.reader.meta
+        if meta.get('version') != BUNDLE_VERSION:
+            raise BundleError('Unsupported bundle version:{} in {}'
+                              .format(meta.get('version'), fname))
+        self.atlas_name = meta['atlas_name']
+        self.cluster_names = meta['cluster_names']
+        # json turns the (cluster, file) tuples into lists
+        self.tract_map = {tract: [tuple(c) for c in clusters]
+                          for tract, clusters in meta['tract_map'].items()}
+        self.provenance = meta['provenance']
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *errstuff):
+        self.close()
+
+    def close(self):
+        self.reader.close()
+
+    @property
+    def n_fibers(self):
+        return(self.reader.shape('cluster_ids')[0])
+
+    def cluster_ids(self):
+        """
+        np.int32 vector with the cluster id of every fiber,
+        indexing into cluster_names
+        """
+        return(self.reader.read('cluster_ids'))
+
+    def offsets(self):
+        return(self.reader.read('offsets'))
+
+    def write_atlas_vtk(self, fname):
+        """
+        Writes the atlas fibers to a legacy .vtk file,
+        one chunk of points at a time.
+        """
+        vtkio.write_vtk(fname, self.reader.iter_chunks('points'),
+                        self.offsets())
+        return(fname)
@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+"""
+End to end benchmark of get_subject_tract_coordinates.py on synthetic data.
+
+Generates an atlas, its cluster files, an MRML hierarchy and a subject, then
+runs the whole pipeline with the stand-in external tools in standins/ first
+on the PATH, so no registration tools or singularity are needed, and an
+empty placeholder stands in for the MIRTK container. Records the wall time
+of each run, the time between the pipeline's stage checkpoints and checksums
+of the outputs.
+
+Usage:
+    benchmark_pipeline.py [options]
+
+Options:
+    --fibers=<n>            Number of atlas fibers [default: 20000]
+    --clusters=<n>          Number of atlas clusters [default: 200]
+    --tracts=<n>            Number of tracts the clusters belong to
+                            [default: 20]
+    --points=<n>            Average number of points per fiber [default: 50]
+    --seed=<n>              Seed for the synthetic data [default: 0]
+    --repeat=<n>            Number of timed runs [default: 3]
+    --chunk-fibers=<n>      Passed to the pipeline
+    --threads=<n>           Passed to the pipeline [default: 1]
+    --keep-intermediates    Passed to the pipeline, also runs the stand-in
+                            conversions
+    --data_dir=<dir>        Where to write the synthetic data and the runs,
+                            a temporary folder is used if not set
+    --results=<file>        Write the results to this json file
+    --baseline=<file>       Compare with the results of an earlier run, fails
+                            if the outputs differ or the median wall time is
+                            more than --tolerance slower
+    --tolerance=<f>         Allowed slow down against --baseline
+                            [default: 0.2]
+    --debug                 Extra logging information
+    --quiet                 Only log errors
+
+Details:
+    Every run uses a fresh work dir, so nothing is reused between runs.
+    The stand-ins are deterministic, so the same options always give the
+    same outputs, the checksums only change when the results do.
+"""
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+import numpy as np
+import nibabel as nib
+from docopt import docopt
+import tempdir
+import vtkio
+from atlas_bundle import sha1_file
+from streamlines import pack_streamlines
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+STANDINS_DIR = os.path.join(SCRIPT_DIR, 'standins')
+PIPELINE = os.path.join(SCRIPT_DIR, 'get_subject_tract_coordinates.py')
+
+# parse_mrml.py expects the tracts at the top level and the cluster nodes
+# one level further down
+MRML_TEMPLATE = """<MRML version="Slicer4.4.0">
+{tracts}
+<Scene>
+{clusters}
+</Scene>
+</MRML>
+"""
+
+
+def make_fibers(n_fibers, mean_points, rng):
+    """
+    Random smooth fibers inside a 100mm box
+    """
+    lengths = np.maximum(rng.poisson(mean_points, n_fibers), 2)
+    steps = rng.normal(0, 1.0, (lengths.sum(), 3)).astype(np.float32)
+    offsets = np.zeros(n_fibers + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    steps[offsets[:-1]] = rng.uniform(-50, 50, (n_fibers, 3))
+    fibers = []
+    for start, stop in zip(offsets[:-1], offsets[1:]):
+        fibers.append(np.cumsum(steps[start:stop], axis=0))
+    return(fibers)
+
+
+def write_mrml(fname, tracts):
+    """
+    Writes a Slicer hierarchy, tracts is a dict {tract: [cluster names]}
+    """
+    tract_nodes = []
+    cluster_nodes = []
+    for i, (tract, clusters) in enumerate(sorted(tracts.items())):
+        tract_id = 'vtkMRMLModelHierarchyNode{}'.format(i)
+        tract_nodes.append('<ModelHierarchy id="{}" name="{}" />'
+                           .format(tract_id, tract))
+        for cluster in clusters:
+            cluster_nodes.append('<ModelHierarchy id="h_{0}" name="h_{0}" '
+                         'parentNodeRef="{1}" associatedNodeRef="fb_{0}" />'
+                         .format(cluster, tract_id))
+            cluster_nodes.append('<FiberBundle id="fb_{0}" name="{0}" '
+                         'storageNodeRef="st_{0}" />'.format(cluster))
+            cluster_nodes.append('<FiberBundleStorage id="st_{0}" '
+                         'fileName="{0}.vtp" />'.format(cluster))
+    with open(fname, 'w') as f:
+        f.write(MRML_TEMPLATE.format(tracts='\n'.join(tract_nodes),
+                                     clusters='\n'.join(cluster_nodes)))
+
+
+def make_data(data_dir, n_fibers, n_clusters, n_tracts, mean_points, seed):
+    """
+    Writes the synthetic atlas, clusters, mrml, subject and anat files
+    Returns a dict of their paths
+    """
+    rng = np.random.RandomState(seed)
+    paths = {'atlas': os.path.join(data_dir, 'atlas.vtp'),
+             'clusters': os.path.join(data_dir, 'clusters'),
+             'mrml': os.path.join(data_dir, 'atlas.mrml'),
+             'subject': os.path.join(data_dir, 'subject.vtk'),
+             'anat': os.path.join(data_dir, 'subject.nii.gz'),
+             'mirtk': os.path.join(data_dir, 'MIRTK.img')}
+    if not os.path.isdir(paths['clusters']):
+        os.mkdir(paths['clusters'])
+
+    fibers = make_fibers(n_fibers, mean_points, rng)
+    vtkio.write_vtp(paths['atlas'], *pack_streamlines(fibers))
+
+    cluster_ids = rng.randint(0, n_clusters, n_fibers)
+    names = ['cluster_{:05d}'.format(i) for i in range(n_clusters)]
+    for i, name in enumerate(names):
+        vtkio.write_vtp(os.path.join(paths['clusters'], name + '.vtp'),
+                        *pack_streamlines([fibers[j] for j in
+                                           np.flatnonzero(cluster_ids == i)]))
+
+    # the last clusters don't belong to any tract, like real atlases
+    tracts = {}
+    for i, name in enumerate(names[:int(n_clusters * 0.9)]):
+        tracts.setdefault('tract_{:03d}'.format(i % n_tracts), []).append(name)
+    write_mrml(paths['mrml'], tracts)
+
+    vtkio.write_vtk(paths['subject'],
+                    *pack_streamlines(make_fibers(1000, mean_points, rng)))
+    # the singularity stand-in never opens the container, it only has to
+    # exist for the preflight checks
+    open(paths['mirtk'], 'w').close()
+    affine = np.diag([2.0, 2.0, 2.0, 1.0])
+    affine[:3, 3] = -64
+    nib.save(nib.Nifti1Image(np.zeros((64, 64, 64), dtype=np.int16), affine),
+             paths['anat'])
+    return(paths)
+
+
+def read_stages(events_file, start_time):
+    """
+    Returns a list of (stage, seconds) between consecutive checkpoints,
+    the first stage includes python start up
+    """
+    stages = []
+    last = start_time
+    with open(events_file, 'r') as f:
+        for line in f:
+            event = json.loads(line)
+            if event['event'] == 'checkpoint':
+                stages.append((event['name'], round(event['time'] - last, 3)))
+                last = event['time']
+    return(stages, last)
+
+
+def run_pipeline(paths, run_dir, options):
+    """
+    Runs the pipeline once
+    Returns a dict with the wall time, stage times and output checksums
+    """
+    os.mkdir(run_dir)
+    output = os.path.join(run_dir, 'output.json')
+    events = os.path.join(run_dir, 'events.jsonl')
+    cmd = [sys.executable, PIPELINE,
+           '--atlas_file={}'.format(paths['atlas']),
+           '--cluster_dir={}'.format(paths['clusters']),
+           '--mrml_file={}'.format(paths['mrml']),
+           '--mirtk_file={}'.format(paths['mirtk']),
+           '--work_dir={}'.format(os.path.join(run_dir, 'work')),
+           '--output={}'.format(output),
+           '--progress-events={}'.format(events),
+           '--quiet'] + options + [paths['subject'], paths['anat']]
+    env = dict(os.environ)
+    env['PATH'] = STANDINS_DIR + os.pathsep + env.get('PATH', '')
+
+    logger.debug('Running:{}'.format(' '.join(cmd)))
+    start_time = time.time()
+    subprocess.check_call(cmd, env=env)
+    wall = time.time() - start_time
+
+    stages, last = read_stages(events, start_time)
+    stages.append(('write_output', round(start_time + wall - last, 3)))
+    return({'wall': round(wall, 3),
+            'stages': stages,
+            'checksums': {'output': sha1_file(output)}})
+
+
+def summarise(runs):
+    """
+    Median wall and stage times of several runs
+    """
+    summary = {'wall': float(np.median([run['wall'] for run in runs])),
+               'stages': []}
+    for i, (stage, _) in enumerate(runs[0]['stages']):
+        summary['stages'].append(
+            (stage, float(np.median([run['stages'][i][1] for run in runs]))))
+    return(summary)
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns a list of the differences that count as regressions
+    """
+    problems = []
+    if results['params'] != baseline['params']:
+        problems.append('Parameters differ from the baseline')
+    if results['checksums'] != baseline['checksums']:
+        problems.append('Outputs differ from the baseline:{} != {}'
+                        .format(results['checksums'], baseline['checksums']))
+    limit = baseline['summary']['wall'] * (1 + tolerance)
+    if results['summary']['wall'] > limit:
+        problems.append('Median wall time {:.2f}s is more than {:.0%} over '
+                        'the baseline {:.2f}s'
+                        .format(results['summary']['wall'], tolerance,
+                                baseline['summary']['wall']))
+    return(problems)
+
+
+def benchmark(data_dir, params, options, repeat):
+    paths = make_data(data_dir, params['fibers'], params['clusters'],
+                      params['tracts'], params['points'], params['seed'])
+    runs = []
+    for i in range(repeat):
+        run = run_pipeline(paths, os.path.join(data_dir, 'run_{}'.format(i)),
+                           options)
+        logger.info('Run {}: {:.2f}s'.format(i + 1, run['wall']))
+        runs.append(run)
+
+    checksums = runs[0]['checksums']
+    if any(run['checksums'] != checksums for run in runs):
+        msg = 'Runs gave different outputs, the pipeline is not deterministic'
+        logger.error(msg)
+        sys.exit(msg)
+    return({'params': params,
+            'checksums': checksums,
+            'summary': summarise(runs),
+            'runs': runs})
+
+
+def print_results(results):
+    summary = results['summary']
+    print('Median wall time: {:.2f}s over {} runs'
+          .format(summary['wall'], len(results['runs'])))
+    for stage, seconds in summary['stages']:
+        print('    {:<28} {:8.2f}s'.format(stage, seconds))
+    for name, checksum in sorted(results['checksums'].items()):
+        print('{} sha1: {}'.format(name, checksum))
+
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+
+    if arguments['--debug']:
+        logger.setLevel(logging.DEBUG)
+    elif arguments['--quiet']:
+        logger.setLevel(logging.ERROR)
+    else:
+        logger.setLevel(logging.INFO)
+
+    try:
+        params = {key: int(arguments['--' + key])
+                  for key in ['fibers', 'clusters', 'tracts', 'points',
+                              'seed']}
+        repeat = int(arguments['--repeat'])
+        tolerance = float(arguments['--tolerance'])
+        assert repeat > 0 and params['clusters'] >= params['tracts'] > 0
+    except (ValueError, AssertionError):
+        msg = 'Invalid benchmark options'
+        logger.error(msg)
+        sys.exit(msg)
+
+    options = ['--threads={}'.format(arguments['--threads'])]
+    if arguments['--chunk-fibers']:
+        options.append('--chunk-fibers={}'.format(arguments['--chunk-fibers']))
+    if arguments['--keep-intermediates']:
+        options.append('--keep-intermediates')
+    params['options'] = options
+
+    if arguments['--data_dir']:
+        if not os.path.isdir(arguments['--data_dir']):
+            os.makedirs(arguments['--data_dir'])
+        results = benchmark(arguments['--data_dir'], params, options, repeat)
+    else:
+        with tempdir.TempDir(prefix='tractmap_benchmark_') as data_dir:
+            results = benchmark(data_dir, params, options, repeat)
+
+    print_results(results)
+    if arguments['--results']:
+        with open(arguments['--results'], 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if arguments['--baseline']:
+        with open(arguments['--baseline'], 'r') as f:
+            baseline = json.load(f)
+        problems = compare(results, baseline, tolerance)
+        if problems:
+            for problem in problems:
+                logger.error(problem)
+            sys.exit(1)
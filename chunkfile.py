@@ -0,0 +1,206 @@
+"""
+A single file container for large numpy arrays.
+
+Arrays are stored as a sequence of chunks along their first axis. Each
+chunk is zlib compressed (or stored as is) so part of an array can be read
+without decoding the rest. The file is memory mapped when read, uncompressed
+chunks are returned as views of the map without copying.
+
+Layout:
+    MAGIC
+    chunk data ...
+    json footer {'meta': {...},
+                 'arrays': {name: {'dtype': str,
+                                   'shape': [n, ...],
+                                   'compressed': bool,
+                                   'shuffled': bool, optional,
+                                   'chunks': [[offset, nbytes, nrows], ...]}}}
+    footer length (uint64, little endian)
+    MAGIC
+"""
+import json
+import mmap
+import os
+import zlib
+import numpy as np
+
+MAGIC = b'TMCHUNK1'
+_FOOTER_LEN = np.dtype('<u8')
+
+
+class ChunkFileError(Exception):
+    pass
+
+
+class ChunkWriter(object):
+    """
+    Writes arrays to a chunk file.
+
+        with ChunkWriter(fname) as writer:
+            writer.meta['key'] = 'value'
+            writer.append('points', points)
+
+    Calling append again with the same name adds rows to that array.
+    With shuffle the bytes of compressed chunks are regrouped by their
+    position in each value before compressing, all the first bytes then all
+    the second bytes and so on. This compresses small integers stored in
+    wide types much better.
+    """
+    def __init__(self, fname, chunk_rows=65536, compress=6, shuffle=False):
+        self.fname = fname
+        self.chunk_rows = chunk_rows
+        self.compress = compress
+        self.shuffle = shuffle and bool(compress)
+        self.meta = {}
+        self.arrays = {}
+        # write to a temporary name so readers never see a partial file
+        self._tmp_name = fname + '.partial'
+        self._f = open(self._tmp_name, 'wb')
+        self._f.write(MAGIC)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def append(self, name, array):
+        """
+        Appends the rows of array to the array called name
+        """
+        array = np.ascontiguousarray(array)
+        if name not in self.arrays:
+            self.arrays[name] = {'dtype': array.dtype.str,
+                                 'shape': [0] + list(array.shape[1:]),
+                                 'compressed': bool(self.compress),
+                                 'shuffled': self.shuffle,
+                                 'chunks': []}
+        info = self.arrays[name]
+        if (np.dtype(info['dtype']) != array.dtype or
+                list(array.shape[1:]) != info['shape'][1:]):
+            raise ChunkFileError('Array {} has inconsistent dtype or shape'
+                                 .format(name))
+
+        for start in range(0, len(array), self.chunk_rows):
+            rows = array[start:start + self.chunk_rows]
+            data = rows.tobytes()
+            if self.shuffle:
+                data = (np.frombuffer(data, dtype=np.uint8)
+                        .reshape(-1, array.dtype.itemsize).T.tobytes())
+            if self.compress:
+                data = zlib.compress(data, self.compress)
+            info['chunks'].append([self._f.tell(), len(data), len(rows)])
+            self._f.write(data)
+        info['shape'][0] += len(array)
+
+    def close(self):
+        footer = json.dumps({'meta': self.meta,
+                             'arrays': self.arrays}).encode('utf-8')
+        self._f.write(footer)
+        self._f.write(np.array([len(footer)], dtype=_FOOTER_LEN).tobytes())
+        self._f.write(MAGIC)
+        self._f.close()
+        os.rename(self._tmp_name, self.fname)
+
+    def abort(self):
+        self._f.close()
+        os.remove(self._tmp_name)
+
+
+class ChunkReader(object):
+    """
+    Lazily reads arrays from a chunk file.
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        self._f = open(fname, 'rb')
+        try:
+            self._map = mmap.mmap(self._f.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        except ValueError:
+            raise ChunkFileError('Empty chunk file:{}'.format(fname))
+
+        size = len(self._map)
+        tail = len(MAGIC) + _FOOTER_LEN.itemsize
+        if (size < len(MAGIC) + tail or
+                self._map[:len(MAGIC)] != MAGIC or
+                self._map[size - len(MAGIC):] != MAGIC):
+            raise ChunkFileError('Not a chunk file:{}'.format(fname))
+        footer_len = int(np.frombuffer(self._map[size - tail:
+                                                 size - len(MAGIC)],
+                                       dtype=_FOOTER_LEN)[0])
+        footer = self._map[size - tail - footer_len:size - tail]
+        footer = json.loads(footer.decode('utf-8'))
+        self.meta = footer['meta']
+        self.arrays = footer['arrays']
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *errstuff):
+        self.close()
+
+    def close(self):
+        try:
+            self._map.close()
+        except BufferError:
+            # arrays returned from uncompressed chunks still use the map,
+            # it is released once they are garbage collected
+            pass
+        self._f.close()
+
+    def names(self):
+        return(sorted(self.arrays.keys()))
+
+    def shape(self, name):
+        return(tuple(self.arrays[name]['shape']))
+
+    def _read_chunk(self, info, chunk):
+        offset, nbytes, nrows = chunk
+        dtype = np.dtype(info['dtype'])
+        shape = [nrows] + info['shape'][1:]
+        if info['compressed']:
+            data = zlib.decompress(self._map[offset:offset + nbytes])
+            if info.get('shuffled'):
+                data = (np.frombuffer(data, dtype=np.uint8)
+                        .reshape(dtype.itemsize, -1).T.tobytes())
+            return(np.frombuffer(data, dtype=dtype).reshape(shape))
+        return(np.frombuffer(self._map, dtype=dtype,
+                             count=nbytes // dtype.itemsize,
+                             offset=offset).reshape(shape))
+
+    def iter_chunks(self, name):
+        """
+        Yields the chunks of an array in order
+        """
+        info = self.arrays[name]
+        for chunk in info['chunks']:
+            yield self._read_chunk(info, chunk)
+
+    def read(self, name, start=0, stop=None):
+        """
+        Reads rows start:stop of an array, only decoding the chunks needed
+        """
+        info = self.arrays[name]
+        n_rows = info['shape'][0]
+        if stop is None or stop > n_rows:
+            stop = n_rows
+        parts = []
+        row = 0
+        for chunk in info['chunks']:
+            chunk_stop = row + chunk[2]
+            if chunk_stop > start and row < stop:
+                data = self._read_chunk(info, chunk)
+                parts.append(data[max(start - row, 0):stop - row])
+            row = chunk_stop
+            if row >= stop:
+                break
+        if not parts:
+            return(np.empty([0] + info['shape'][1:],
+                            dtype=np.dtype(info['dtype'])))
+        if len(parts) == 1:
+            return(parts[0])
+        return(np.concatenate(parts))
@@ -29,22 +29,77 @@ Options:
     --debug                         Extra logging information
     --quiet                         Only log errors
     --logDir=<logDir>               Place to put logs
-    --rewrite                       Overwrite existing outputs
+    --rewrite                       Overwrite existing outputs, submits
+                                    every file again even if it is queued,
+                                    running or has failed too often
+    --max-attempts=<n>              Number of times a failed file is
+                                    submitted before giving up [default: 3]
+    --retry-delay=<minutes>         Time to wait before submitting a failed
+                                    file again, doubled after each failure
+                                    [default: 30]
+    --subjects-per-job=<k>          Number of DTI files to process in each
+                                    cluster job [default: 1]
+    --slots=<n>                     Number of cores to request for each job,
+                                    the pipeline uses all of them [default: 1]
+    --plan                          Print the expected cost of the work and
+                                    exit without submitting any jobs
+    --concurrency=<n>               Number of jobs expected to run at the same
+                                    time, used to estimate the makespan
+                                    [default: 50]
+    --profile                       Profile each subject, the profiles are
+                                    written next to the outputs
+    --scratch                       Keep the intermediate files of each job
+                                    on the node local $TMPDIR
+    --check-only                    Only run the preflight checks of the
+                                    inputs and exit without submitting
 
 Details:
     If atlas_file, cluser_dir, mrml_file are not specified the defaults in
     /opt/quarantine/tractmap are used.
+
+    With --subjects-per-job greater than 1 the DTI files are packed into
+    jobs that process them in a single python process, so the module
+    loading, python startup and atlas labelling is paid once per job.
+
+    Work is submitted longest expected first, DTI files are packed so the
+    jobs have similar expected costs. The cost of each DTI file is
+    estimated from the size of its _SlicerTractography.vtk file, using the
+    run times recorded in <logDir>/tractmap_timings.tsv by previous jobs.
+
+    Each job appends json progress events, with the throughput of each
+    stage and the status of each subject, to <logDir>/progress.<JOB_ID>.jsonl
+
+    The job id of every submitted file is recorded in
+    <logDir>/tractmap_jobs.json. Before submitting, the recorded jobs are
+    looked up with qstat and qacct: files whose job is still queued or
+    running are skipped, files whose job ended without writing the output
+    are submitted again once the retry delay has passed. The retry delay
+    doubles after each failure, up to 12 hours. --plan only reads the
+    recorded jobs as they are, without qstat or qacct, and changes nothing.
+
+    Before submitting, the preflight checks look for the container, atlas
+    files and log folder, and for the nifti header, tract file and output
+    folder of each file, see preflight.py. Files with problems are not
+    submitted. The commands the jobs run are only on the PATH once the
+    job has loaded its modules, each job checks them before starting.
 """
+import fcntl
+import heapq
+import json
 import logging
 import os
+import re
 import subprocess
 import sys
 import tempfile
+import time
 from datman.docopt import docopt
 
 from datman import scanid
 from datman import config
 
+import preflight
+
 JOB_TEMPLATE = """
 #####################################
 #$ -S /bin/bash
@@ -52,7 +107,11 @@ JOB_TEMPLATE = """
 #$ -N {name}
 #$ -e {errfile}
 #$ -o {logfile}
+{parallel_env}
 #####################################
+export OMP_NUM_THREADS={slots}
+export OPENBLAS_NUM_THREADS={slots}
+export MKL_NUM_THREADS={slots}
 echo "------------------------------------------------------------------------"
 echo "Job started on" `date`
 echo "------------------------------------------------------------------------"
@@ -62,13 +121,15 @@ echo "Job ended on" `date`
 echo "------------------------------------------------------------------------"
 """
 
-CODE_TEMPLATE = """
+MODULE_TEMPLATE = """
 module load python/2.7.13_sci_01
 module load whitematteranalysis/latest
 module load tractconverter/0.8.1
 module load tractmap/latest
 source activate
-get_subject_tract_coordinates.py \
+"""
+
+CODE_TEMPLATE = MODULE_TEMPLATE + """get_subject_tract_coordinates.py \
 --cluster-pattern="{cluster_pattern}" \
 --mirtk_file="{container}" \
 --output="{outfile}" \
@@ -76,6 +137,32 @@ get_subject_tract_coordinates.py \
 "{subject}" "{anat}"
 """
 
+BATCH_CODE_TEMPLATE = MODULE_TEMPLATE + """get_subject_tract_coordinates.py \
+--cluster-pattern="{cluster_pattern}" \
+--mirtk_file="{container}" \
+--batch=- \
+{options} <<'END_OF_BATCH'
+{batch}
+END_OF_BATCH
+"""
+
+TIMINGS_FILE = 'tractmap_timings.tsv'
+
+# json lines progress events written by each job
+PROGRESS_FILE = 'progress.$JOB_ID.jsonl'
+
+# cost estimate used until run times have been recorded
+DEFAULT_SECONDS_PER_MB = 20.0
+
+# job id and status of every submitted file
+JOBS_FILE = 'tractmap_jobs.json'
+
+# longest wait before a failed file is submitted again
+MAX_RETRY_DELAY = 12 * 3600
+
+# time qacct may take to record a job that has left the queue
+ACCOUNTING_DELAY = 15 * 60
+
 logging.basicConfig(level=logging.WARN,
                     format="[%(name)s] %(levelname)s: %(message)s")
 logger = logging.getLogger(__name__)
@@ -98,19 +185,34 @@ class QJob(object):
             pass
 
     def run(self, code, name="DTIPrep", logfile="output.$JOB_ID", errfile="error.$JOB_ID", cleanup=True, slots=1):
+        parallel_env = ''
+        if slots > 1:
+            parallel_env = '#$ -pe smp {}'.format(slots)
         open(self.qs_n, 'w').write(JOB_TEMPLATE.format(script=code,
                                                        name=name,
                                                        logfile=logfile,
                                                        errfile=errfile,
+                                                       parallel_env=parallel_env,
                                                        slots=slots))
         logger.info('Submitting job')
         logger.debug('Job code:{}'.format(code))
-        subprocess.call('qsub < ' + self.qs_n, shell=True)
-
-
-def make_job(src_files, outFile):
+        try:
+            output = subprocess.check_output('qsub -terse < ' + self.qs_n,
+                                             shell=True)
+        except subprocess.CalledProcessError as e:
+            logger.error('Failed submitting job. {}'.format(str(e)))
+            return
+        # -terse prints the job id, array jobs add .<tasks>
+        match = re.match(r'\s*(\d+)', output.decode('utf-8', 'replace'))
+        if not match:
+            logger.error('Unexpected qsub output:{}'.format(output))
+            return
+        return(match.group(1))
+
+
+def get_options():
     """
-    Launches a job on the cluster
+    Builds the command line options shared by all jobs
     """
     opts = ''
 
@@ -126,21 +228,332 @@ def make_job(src_files, outFile):
         opts = opts + "--debug "
     if QUIET:
         opts = opts + "--quiet "
-
-    code = CODE_TEMPLATE.format(cluster_pattern=CLUSTER_PATTERN,
-                                container=CONTAINER,
-                                atlas=ATLAS_FILE,
-                                clusters=CLUSTER_DIR,
-                                mrml=MRML_FILE,
-                                subject=src_files[1],
-                                anat=src_files[0],
-                                options=opts,
-                                outfile=outFile)
+    if PROFILE:
+        opts = opts + "--profile "
+    if SCRATCH:
+        # double quotes so the job's shell expands $TMPDIR
+        opts = opts + '--scratch="$TMPDIR" '
+    opts = opts + "--timings='{}' ".format(os.path.join(LOGDIR, TIMINGS_FILE))
+    opts = opts + "--threads={} ".format(SLOTS)
+    # double quotes so the job's shell expands $JOB_ID
+    opts = opts + '--progress-events="{}" '.format(
+        os.path.join(LOGDIR, PROGRESS_FILE))
+    return(opts)
+
+
+def make_job(work_items):
+    """
+    Launches a job on the cluster
+    Inputs:
+        work_items - list of (src_files, outFile) processed by the job,
+            src_files is a tuple (dti_file, tract_file)
+    Return:
+        the job id, None if the submission failed
+    """
+    opts = get_options()
+
+    if len(work_items) == 1:
+        src_files, outFile = work_items[0]
+        code = CODE_TEMPLATE.format(cluster_pattern=CLUSTER_PATTERN,
+                                    container=CONTAINER,
+                                    subject=src_files[1],
+                                    anat=src_files[0],
+                                    options=opts,
+                                    outfile=outFile)
+    else:
+        batch = ['\t'.join([src_files[1], src_files[0], outFile])
+                 for src_files, outFile in work_items]
+        code = BATCH_CODE_TEMPLATE.format(cluster_pattern=CLUSTER_PATTERN,
+                                          container=CONTAINER,
+                                          options=opts,
+                                          batch='\n'.join(batch))
 
     with QJob() as qjob:
         logfile = os.path.join(LOGDIR, 'output.$JOB_ID')
         errfile = os.path.join(LOGDIR, 'error.$JOB_ID')
-        qjob.run(code=code, logfile=logfile, errfile=errfile)
+        return(qjob.run(code=code, logfile=logfile, errfile=errfile,
+                        slots=SLOTS))
+
+
+def pack_work_items(costed, per_job):
+    """
+    Packs work items into as few jobs of at most per_job items as possible,
+    balancing the cost of the jobs.
+    Items are taken longest first and each one goes to the cheapest job
+    that still has room (longest processing time first scheduling).
+
+    Inputs:
+        costed - list of (cost, work_item) sorted longest first, see
+            order_by_cost
+    Returns a list of (cost, work_items) for each job, longest job first
+    """
+    n_jobs = -(-len(costed) // per_job)
+    jobs = [[0.0, []] for _ in range(n_jobs)]
+    # (cost, job index) of the jobs with room, the index breaks ties so
+    # the packing is deterministic
+    open_jobs = [(0.0, i) for i in range(n_jobs)]
+    for cost, item in costed:
+        job_cost, i = heapq.heappop(open_jobs)
+        jobs[i][0] += cost
+        jobs[i][1].append(item)
+        if len(jobs[i][1]) < per_job:
+            heapq.heappush(open_jobs, (jobs[i][0], i))
+    jobs.sort(key=lambda job: job[0], reverse=True)
+    return([(cost, items) for cost, items in jobs])
+
+
+def read_timings(timings_file):
+    """
+    Reads the run times recorded by get_subject_tract_coordinates.py
+    Returns a dict {tract_file: (size, seconds)} with the latest
+    successful run of each file
+    """
+    timings = {}
+    if not os.path.isfile(timings_file):
+        return timings
+
+    with open(timings_file, 'r') as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) != 4 or fields[3] != 'ok':
+                continue
+            try:
+                timings[fields[0]] = (int(fields[1]), float(fields[2]))
+            except ValueError:
+                logger.debug('Invalid timing record:{}'.format(line))
+    return timings
+
+
+def fit_cost_model(timings):
+    """
+    Estimates the run time per byte of tractography file
+    as the median rate of the recorded runs.
+    """
+    rates = sorted(seconds / size
+                   for size, seconds in timings.values() if size > 0)
+    if not rates:
+        return(DEFAULT_SECONDS_PER_MB / 2 ** 20)
+    return(rates[len(rates) // 2])
+
+
+def estimate_cost(tract_file, timings, seconds_per_byte):
+    """
+    Expected run time in seconds for a tractography file.
+    Uses the recorded run time if the file has been processed before.
+    """
+    if tract_file in timings:
+        return(timings[tract_file][1])
+    try:
+        size = os.path.getsize(tract_file)
+    except OSError:
+        size = 0
+    return(size * seconds_per_byte)
+
+
+def order_by_cost(work_items, timings):
+    """
+    Sorts work_items longest expected first
+    Returns a list of (cost, work_item)
+    """
+    seconds_per_byte = fit_cost_model(timings)
+    costed = [(estimate_cost(item[0][1], timings, seconds_per_byte), item)
+              for item in work_items]
+    costed.sort(key=lambda c: c[0], reverse=True)
+    return(costed)
+
+
+def estimate_makespan(job_costs, concurrency):
+    """
+    Simulates running jobs in submission order on concurrency slots,
+    each job starting as soon as a slot is free.
+    Returns the time the last job finishes.
+    """
+    slots = [0.0] * max(concurrency, 1)
+    for cost in job_costs:
+        heapq.heapreplace(slots, slots[0] + cost)
+    return(max(slots))
+
+
+def print_plan(jobs, job_costs, concurrency, slots=1):
+    """
+    Prints a summary of the expected cost of the jobs,
+    each job uses slots cores.
+    """
+    n_items = sum(len(job) for job in jobs)
+    total = sum(job_costs)
+    makespan = estimate_makespan(job_costs, concurrency)
+    print('Files to process:    {}'.format(n_items))
+    print('Jobs:                {}'.format(len(jobs)))
+    print('Total core-hours:    {:.2f}'.format(total * slots / 3600.0))
+    print('Longest job (hours): {:.2f}'.format(max(job_costs + [0]) / 3600.0))
+    print('Makespan (hours):    {:.2f} with {} concurrent jobs'
+          .format(makespan / 3600.0, concurrency))
+
+
+def read_job_states(jobs_file):
+    """
+    Reads the jobs recorded by earlier runs
+    Returns a dict {outFile: state}, state is a dict with the job_id,
+    status (submitted, done or failed), number of attempts and the times
+    of the latest submission
+    """
+    if not os.path.isfile(jobs_file):
+        return({})
+    try:
+        with open(jobs_file, 'r') as f:
+            return(json.load(f))
+    except ValueError:
+        # guessing could submit every file again
+        msg = 'Invalid jobs file:{}'.format(jobs_file)
+        logger.error(msg)
+        sys.exit(msg)
+
+
+def write_job_states(jobs_file, states):
+    """
+    Replaces jobs_file, readers never see a partial file
+    """
+    tmp_file = jobs_file + '.partial'
+    with open(tmp_file, 'w') as f:
+        json.dump(states, f, indent=1, sort_keys=True)
+    os.rename(tmp_file, jobs_file)
+
+
+def get_queued_jobs():
+    """
+    Lists the jobs in the queue
+    Returns a dict {job_id: state}, state is the qstat code e.g. qw, r, Eqw
+    """
+    try:
+        output = subprocess.check_output(['qstat'])
+    except (OSError, subprocess.CalledProcessError) as e:
+        # without the queue every recorded job could be submitted twice
+        msg = 'Failed running qstat. {}'.format(str(e))
+        logger.error(msg)
+        sys.exit(msg)
+
+    jobs = {}
+    for line in output.decode('utf-8', 'replace').splitlines():
+        fields = line.split()
+        # skips the header and separator lines
+        if len(fields) > 4 and fields[0].isdigit():
+            jobs[fields[0]] = fields[4]
+    return(jobs)
+
+
+def get_accounting(job_id):
+    """
+    Looks up a job that has left the queue with qacct
+    Returns a dict with the failed and exit_status fields of the latest
+    record, None if the job has not been recorded (yet)
+    """
+    try:
+        with open(os.devnull, 'w') as devnull:
+            output = subprocess.check_output(['qacct', '-j', job_id],
+                                             stderr=devnull)
+    except (OSError, subprocess.CalledProcessError):
+        return
+
+    record = {}
+    for line in output.decode('utf-8', 'replace').splitlines():
+        fields = line.split(None, 1)
+        if len(fields) == 2 and fields[0] in ['failed', 'exit_status']:
+            record[fields[0]] = fields[1].strip()
+    return(record or None)
+
+
+def get_retry_delay(attempts):
+    """
+    Seconds to wait before submitting a file that failed attempts times
+    """
+    return(min(RETRY_DELAY * 2 ** (attempts - 1), MAX_RETRY_DELAY))
+
+
+def update_job_states(states, now):
+    """
+    Updates the status of the submitted jobs from qstat and qacct.
+    A job is done once its output exists and has failed if it left the
+    queue without writing it.
+    """
+    submitted = [(outFile, state) for outFile, state in states.items()
+                 if state['status'] == 'submitted']
+    if not submitted:
+        return
+
+    queued = get_queued_jobs()
+    accounting = {}
+    for outFile, state in sorted(submitted):
+        job_id = state['job_id']
+        if job_id in queued:
+            state['last_seen'] = now
+            if 'E' in queued[job_id]:
+                logger.warning('Job:{} for:{} is in state:{}, delete it with '
+                               'qdel to allow a retry'
+                               .format(job_id, outFile, queued[job_id]))
+            continue
+
+        if os.path.isfile(outFile):
+            state['status'] = 'done'
+            state['finished'] = now
+            continue
+
+        # batch jobs are shared by several files
+        if job_id not in accounting:
+            accounting[job_id] = get_accounting(job_id)
+        record = accounting[job_id]
+        if record is None and now - state['last_seen'] < ACCOUNTING_DELAY:
+            logger.debug('Job:{} left the queue, waiting for its record'
+                         .format(job_id))
+            continue
+
+        state['status'] = 'failed'
+        state['finished'] = now
+        state['exit_status'] = record.get('exit_status') if record else None
+        state['next_retry'] = now + get_retry_delay(state['attempts'])
+        logger.warning('Job:{} for:{} ended without output, exit status:{}'
+                       .format(job_id, outFile, state['exit_status']))
+
+
+def select_work_items(work_items, states, now):
+    """
+    Drops the work items that are queued or running, waiting for a retry
+    or have failed MAX_ATTEMPTS times. Nothing is dropped with OVERWRITE.
+    """
+    selected = []
+    for item in work_items:
+        outFile = item[1]
+        state = states.get(outFile)
+        if OVERWRITE or state is None or state['status'] == 'done':
+            selected.append(item)
+        elif state['status'] == 'submitted':
+            logger.info('File:{} is in job:{}. Skipping'
+                        .format(outFile, state['job_id']))
+        elif state['attempts'] >= MAX_ATTEMPTS:
+            logger.warning('File:{} failed {} times. Skipping, use --rewrite '
+                           'to submit it again'
+                           .format(outFile, state['attempts']))
+        elif now < state['next_retry']:
+            logger.info('File:{} failed, retrying after:{}'
+                        .format(outFile, time.ctime(state['next_retry'])))
+        else:
+            selected.append(item)
+    return(selected)
+
+
+def record_submission(states, work_items, job_id, now):
+    """
+    Records the job processing work_items
+    """
+    for _, outFile in work_items:
+        previous = states.get(outFile)
+        attempts = 1
+        if previous and previous['status'] == 'failed' and not OVERWRITE:
+            attempts = previous['attempts'] + 1
+        states[outFile] = {'job_id': job_id,
+                           'status': 'submitted',
+                           'attempts': attempts,
+                           'submitted': now,
+                           'last_seen': now}
 
 
 def get_files(session, filename):
@@ -185,6 +598,7 @@ def get_files(session, filename):
 def process_session(session):
     """
     Searches for all .nii.gz files with DTI tag in a session
+    Returns a list of (src_files, outFile) that need processing
     """
     logger.info('Processing session:{}'.format(session))
     # Check if inputs exist
@@ -199,29 +613,132 @@ def process_session(session):
     if len(files_to_process) == 0:
         logger.warning('No DTI files found for session:{}'
                        .format(session))
-        return
+        return []
 
+    work_items = []
     for f in files_to_process:
         # check if the output already exists
         basename = os.path.splitext(os.path.basename(f[1]))[0]
         basename = basename + '_tract_ends.json'
         out_path = os.path.join(dtiprep_dir, basename)
-        if os.path.isfile(out_path):
+        if os.path.isfile(out_path) and not OVERWRITE:
             logger.info('File:{} in session:{} is already processed. Skipping'
                         .format(basename, session))
             continue
-        make_job(f, out_path)
+        work_items.append((f, out_path))
+    return(work_items)
+
+
+def check_work_items(work_items):
+    """
+    Runs the preflight checks of the inputs, see preflight.py
+    Exits if an input shared by all jobs has a problem.
+    Returns a tuple (passed, failed) of the work items whose own inputs
+    passed or failed the checks
+    """
+    shared = [(preflight.check_file, [CONTAINER, 'MIRTK container']),
+              (preflight.check_writable, [LOGDIR, 'log folder'])]
+    if ATLAS_FILE:
+        shared.append((preflight.check_file, [ATLAS_FILE, 'atlas file']))
+    if CLUSTER_DIR:
+        shared.append((preflight.check_dir, [CLUSTER_DIR, 'cluster folder']))
+    if MRML_FILE:
+        shared.append((preflight.check_file, [MRML_FILE, 'mrml file']))
+    problems = preflight.check_all(shared)
+    if problems:
+        preflight.fail(problems)
+
+    checks = []
+    for (dti_file, tract_file), outFile in work_items:
+        checks.extend([(preflight.check_nifti, [dti_file, 'DTI file']),
+                       (preflight.check_file, [tract_file, 'tract file']),
+                       (preflight.check_writable, [os.path.dirname(outFile),
+                                                   'output folder'])])
+    results = preflight.run_checks(checks)
+
+    passed = []
+    failed = []
+    for i, item in enumerate(work_items):
+        problems = sum(results[3 * i:3 * i + 3], [])
+        for problem in problems:
+            logger.error(problem)
+        if problems:
+            failed.append(item)
+        else:
+            passed.append(item)
+    return(passed, failed)
+
+
+def plan_jobs(work_items):
+    """
+    Packs work_items into jobs, longest expected first
+    Returns a tuple (jobs, job_costs)
+    """
+    # submit the longest work first so big files don't make a long tail
+    timings = read_timings(os.path.join(LOGDIR, TIMINGS_FILE))
+    costed = order_by_cost(work_items, timings)
+    packed = pack_work_items(costed, SUBJECTS_PER_JOB)
+    return([items for _, items in packed], [cost for cost, _ in packed])
+
+
+def submit(work_items, states, jobs_file):
+    """
+    Packs work_items into jobs and submits them, recording the job ids
+    """
+    jobs, job_costs = plan_jobs(work_items)
+    logger.info('Submitting {} files in {} jobs.'.format(len(work_items),
+                                                         len(jobs)))
+    for job in jobs:
+        job_id = make_job(job)
+        if job_id:
+            record_submission(states, job, job_id, time.time())
+            # written after every job, so an interrupted launcher
+            # never loses a job id
+            write_job_states(jobs_file, states)
 
 
 def main(study, session=None):
     logger.info('Processing study:{}'.format(study))
     if session:
-        process_session(session)
+        sessions = [session]
     else:
         sessions = os.listdir(NII_PATH)
         logger.info('Found {} sessions.'.format(len(sessions)))
-        for session in sessions:
-            process_session(session)
+
+    work_items = []
+    for session in sessions:
+        work_items.extend(process_session(session))
+
+    work_items, failed = check_work_items(work_items)
+    if failed:
+        logger.error('{} files failed the preflight checks and are not '
+                     'submitted'.format(len(failed)))
+    if CHECK_ONLY:
+        print('{} of {} files passed the preflight checks'
+              .format(len(work_items), len(work_items) + len(failed)))
+        if failed:
+            sys.exit(1)
+        return
+
+    jobs_file = os.path.join(LOGDIR, JOBS_FILE)
+    if PLAN:
+        # a dry run, the recorded states are used as they are
+        work_items = select_work_items(work_items,
+                                       read_job_states(jobs_file),
+                                       time.time())
+        jobs, job_costs = plan_jobs(work_items)
+        print_plan(jobs, job_costs, CONCURRENCY, SLOTS)
+        return
+
+    with open(jobs_file + '.lock', 'a') as lock:
+        # a second launcher would submit the same files
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        now = time.time()
+        states = read_job_states(jobs_file)
+        update_job_states(states, now)
+        write_job_states(jobs_file, states)
+        work_items = select_work_items(work_items, states, now)
+        submit(work_items, states, jobs_file)
 
 if __name__ == '__main__':
     arguments = docopt(__doc__)
@@ -236,6 +753,30 @@ if __name__ == '__main__':
     LOGDIR = arguments['--logDir']
     OVERWRITE = arguments['--rewrite']
 
+    PLAN = arguments['--plan']
+    CHECK_ONLY = arguments['--check-only']
+    PROFILE = arguments['--profile']
+    SCRATCH = arguments['--scratch']
+
+    try:
+        SUBJECTS_PER_JOB = int(arguments['--subjects-per-job'])
+        CONCURRENCY = int(arguments['--concurrency'])
+        SLOTS = int(arguments['--slots'])
+        MAX_ATTEMPTS = int(arguments['--max-attempts'])
+        RETRY_DELAY = float(arguments['--retry-delay']) * 60
+        assert SUBJECTS_PER_JOB > 0 and CONCURRENCY > 0 and SLOTS > 0
+        assert MAX_ATTEMPTS > 0 and RETRY_DELAY >= 0
+    except (ValueError, AssertionError):
+        msg = ('Invalid --subjects-per-job:{}, --concurrency:{}, --slots:{}, '
+               '--max-attempts:{} or --retry-delay:{}'
+               .format(arguments['--subjects-per-job'],
+                       arguments['--concurrency'],
+                       arguments['--slots'],
+                       arguments['--max-attempts'],
+                       arguments['--retry-delay']))
+        logger.error(msg)
+        sys.exit(msg)
+
     QUIET = False
     DEBUG = False
     if arguments['--debug']:
@@ -7,6 +7,7 @@ Transforms a DTI atlas to subject space and returns streamlines coordinates
 Usage:
     get_subject_tract_coordinates.py [options] <subjectFile>
     get_subject_tract_coordinates.py [options] <subjectFile> <anatFile>
+    get_subject_tract_coordinates.py [options] --batch=<file>
 
 Arguments:
     <subjectFile>   Full path to a tractography file
@@ -29,6 +30,84 @@ Options:
                                     [default: ./data/clusters/]
     --mrml_file=<mrml_file>         Path to the atlas mrml (Slicer) file mapping clusters to tracts
                                     [default: ./data/clustered_tracts_display_100_percent_aem.mrml]
+    --threads=<n>                   Number of cores to use for conversion,
+                                    registration and matching. Defaults to
+                                    $NSLOTS if set, otherwise 1
+    --timings=<file>                Append the run time of each subject to
+                                    this tab separated file
+    --chunk-fibers=<n>              Stream the atlases n fibers at a time,
+                                    bounding memory use by n instead of the
+                                    atlas size
+    --bundle=<file>                 Path to an atlas bundle created with
+                                    tractmapper.py bundle, used instead of
+                                    the atlas, cluster and mrml files
+    --batch=<file>                  Process several subjects in one run, sharing
+                                    the atlas labels. Tab separated file with
+                                    one <subjectFile> <anatFile> <output> per
+                                    line, - reads from stdin
+    --atlases=<file>                Map the subject to several atlases in one
+                                    run, see Details. Tab separated file with
+                                    one <name> <atlas_file> <cluster_dir>
+                                    <mrml_file> per line
+    --scratch=<dir>                 Work on node local scratch, e.g. $TMPDIR,
+                                    instead of in --work_dir, see Details
+    --stage-keep=<patterns>         With --scratch, comma separated patterns
+                                    of the files copied back to --work_dir
+                                    [default: *cluster_cache.tmc,*_reg.vtk,subject_cache/*]
+    --keep-intermediates            Write the intermediate .vtk and .trk files
+                                    to --work_dir, instead of reading the
+                                    fibers straight into memory
+    --progress-events=<file>        Append json progress events for each
+                                    stage and subject to this file
+    --profile                       Profile the run, writes <prefix>.prof and
+                                    <prefix>.stacks.txt, see profiling.py.
+                                    <prefix> is the output without extension,
+                                    in --batch mode the first output without
+                                    extension followed by _batch
+    --profile-memory                With --profile, also record memory use at
+                                    each stage in <prefix>.memory.txt
+    --summary                       Also write the count, centroid, covariance
+                                    and bounding box of the starts and ends
+                                    of each tract to <output>_summary.json
+    --summary-k=<k>                 With --summary, also cluster the starts and
+                                    ends of each tract with k-means
+                                    [default: 0]
+    --density                       Also write the number of fiber end points
+                                    of each tract in every voxel of <anatFile>
+                                    to <output>_density.nii.gz, see Details
+    --streamlines                   Also export the registered streamlines of
+                                    each tract to <output>_streamlines.tmc,
+                                    see streamline_export.py
+    --streamline-step=<mm>          With --streamlines, quantize coordinates
+                                    to this step, each coordinate is within
+                                    step / 2 of the registered fiber
+                                    [default: 0.01]
+    --sample-fraction=<f>           Only map this fraction of the atlas fibers
+                                    of each tract, for quick QC runs,
+                                    see Details
+    --max-fibers-per-tract=<n>      Only map up to n atlas fibers of each tract
+    --seed=<n>                      Seed for choosing the sampled atlas and
+                                    subject fibers [default: 0]
+    --subject-fibers=<n>            Register the atlas to a sample of n subject
+                                    fibers, cached for later runs, see Details
+    --subject-min-length=<mm>       With --subject-fibers, only sample fibers
+                                    at least this long [default: 40]
+    --subject-cache=<dir>           Where to cache the subject samples.
+                                    Defaults to subject_cache in --work_dir
+    --min-points=<n>                Drop registered fibers with fewer points
+    --min-length=<mm>               Drop registered fibers shorter than this
+    --max-length=<mm>               Drop registered fibers longer than this
+    --min-end-distance=<mm>         Drop registered fibers whose end points
+                                    are closer than this, e.g. loops
+    --fiber-filter=<file>           Json file with the thresholds of single
+                                    tracts, see Details
+    --match-tolerance=<mm>          Match atlas fibers without an identical
+                                    cluster fiber to the nearest one closer
+                                    than this, see Details
+    --match-points=<n>              Number of points fibers are resampled to
+                                    for tolerant matching [default: 15]
+    --check-only                    Only run the preflight checks and exit,
+                                    see Details
 
 Returns:
     A json object with the start and end coordinates of fibers organised
@@ -37,6 +116,11 @@ Returns:
     {'tract1': {start: [(x, y, z), (x, y, z)],
                 end: [(x, y, x), (x, y, z)]}}}
 
+    With --output the end points and cluster of every fiber are also saved
+    to <output>_fiber_ends.tmc, tractmapper.py relabel uses these to
+    regenerate the output for a new mrml file without rerunning the
+    pipeline.
+
 Dependencies:
     These need to be on your PATH
         wm_register_to_atlas_new.py -   https://github.com/SlicerDMRI/whitematteranalysis
@@ -45,8 +129,68 @@ Dependencies:
         MIRTK.img                   -   singularity container
 
 Details:
+    In --batch mode each subject is processed in a subdirectory of --work_dir
+    and written to its own output. A failing subject is reported and the
+    remaining subjects are still processed, the exit code is non zero
+    if any subject failed.
+
     --atlas_file, --cluster_dir or --mrml_file can be specified. If a relative
     path is provided it is interpreted relative to __file__
+
+    --density needs <anatFile> and --output. The 4D volume has 3 volumes
+    per tract, the start, end and all end points of its fibers counted on
+    the voxel grid of <anatFile>. <output>_density.json names the tract and
+    kind of each volume.
+
+    With --atlases each atlas is mapped in the <name> subdirectory of
+    --work_dir and written to <output>_<name>.json, with its extra outputs
+    next to it. Atlases are processed at the same time, sharing the
+    --threads cores, and the subject anat header is only read once.
+    Relative paths in the file are interpreted relative to the file.
+
+    With --scratch the intermediate files are written to a directory in
+    <dir>, the subject and atlas files are copied there before registration.
+    Files in --work_dir matching --stage-keep are copied to scratch at the
+    start, and copied back in the background as they are created, so
+    caches like the cluster cache survive the run. Scratch is deleted in a
+    background process at exit. --cleanup copies nothing back.
+
+    --sample-fraction and --max-fibers-per-tract pick the same atlas fibers
+    for every subject and run with the same --seed. The whole atlas is
+    registered, so the transform is the one of a full run, and only the
+    picked fibers are converted and mapped. Fibers in clusters without a
+    tract are left out.
+
+    --min-points, --min-length, --max-length and --min-end-distance remove
+    registered fibers before their end points are collected, lengths are
+    the arc length along the fiber in mm. --fiber-filter overrides them for
+    single tracts, e.g. {"tract_name": {"min_length": 40, "max_length":
+    200}}. The number of fibers removed from each tract is stored in
+    <output>_fiber_ends.tmc.
+
+    With --subject-fibers the subject tractography is not passed to the
+    registration whole. A random sample of n of its fibers, picked with
+    --seed, is written to a binary .vtk file in --subject-cache named by
+    the sha1 of the subject file and the sample options. Reruns, e.g. with
+    a new atlas, and the other atlases of --atlases read the cached sample.
+    n should be at least the number of fibers the registration samples.
+
+    Atlas fibers are labelled by finding the identical fiber in the
+    cluster files. If the cluster files were converted differently from the
+    atlas, e.g. with rounding, --match-tolerance labels the fibers without
+    an identical cluster fiber with the nearest one. Fibers are resampled
+    to --match-points points equally spaced along their length, and the
+    distance between two fibers is the root mean square distance between
+    their points, in either direction. The nearest cluster fiber is found
+    with a KD-tree, which needs scipy. The distance of every atlas fiber to
+    its cluster fiber, 0 if identical, is saved to match_distances.tmc in
+    --work_dir. Atlas bundles store labels that are already matched.
+
+    Before any work the preflight checks look for the external commands
+    and the MIRTK container the run needs, the input files, the nifti
+    header of each anat file and write access to the work and output
+    folders, see preflight.py. All the problems found are reported and
+    the run exits without starting.
 """
 import os
 import subprocess
@@ -54,19 +198,88 @@ import tempdir
 import logging
 import sys
 import shutil
-import re
-import glob
+import tempfile
 import json
+import time
+import itertools
+import hashlib
+import threading
+import atexit
+from multiprocessing.pool import ThreadPool
 from docopt import docopt
 import numpy as np
 import numpy.linalg as npl
 from parse_mrml import MapTracts
+from atlas_bundle import AtlasBundle, find_cluster_files, sha1_file
+from chunkfile import ChunkReader, ChunkWriter, ChunkFileError
+import progress
+from progress import Progress
+import preflight
+import profiling
+import staging
+import streamline_export
+from streamlines import (hash_streams, find_hashes, pack_streamlines,
+                         unpack_streamlines, match_streams, stream_stats,
+                         take_streamlines, resample_streamlines,
+                         make_match_tree, match_resampled)
+import vtkio
 import nibabel as nib
 from nibabel import trackvis as tv
+try:
+    from itertools import izip_longest as zip_longest
+except ImportError:
+    from itertools import zip_longest
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 
+# path to the MIRTK singularity container, set from --mirtk_file
+CONTAINER_FILE = 'MIRTK.img'
+
+# number of cores the pipeline may use, see set_thread_count
+THREADS = 1
+# share of THREADS given to a single thread, see get_thread_count
+_thread_state = threading.local()
+
+# write .vtk and .trk conversions to disk, set from --keep-intermediates
+KEEP_INTERMEDIATES = False
+
+# name and format version of the cluster streamline cache, see
+# get_cluster_cache
+CLUSTER_CACHE = 'cluster_cache.tmc'
+CLUSTER_CACHE_VERSION = 1
+
+# format version of the saved fiber ends, see save_fiber_ends
+FIBER_ENDS_VERSION = 1
+
+# fiber filter thresholds and the value that keeps every fiber,
+# see read_fiber_filter
+FIBER_FILTER_UNSET = {'min_points': 0,
+                      'min_length': 0,
+                      'max_length': np.inf,
+                      'min_end_distance': 0}
+
+# anat headers already read, see read_anat_header
+_ANAT_HEADERS = {}
+_anat_lock = threading.Lock()
+
+# subsampling of the subject fibers passed to registration, a dict
+# {'n_fibers', 'min_length', 'seed'} set from --subject-fibers,
+# and the folder caching the subsamples, see get_registration_target
+SUBJECT_SAMPLE = None
+SUBJECT_CACHE_DIR = None
+
+# fibers with no identical cluster streamline are matched to the nearest
+# one within MATCH_TOLERANCE mm, after resampling both to MATCH_POINTS
+# points, set from --match-tolerance, see match_tolerant
+MATCH_TOLERANCE = None
+MATCH_POINTS = 15
+MATCH_DISTANCES = 'match_distances.tmc'
+
+# sha1 of the files already hashed, see hash_file
+_FILE_HASHES = {}
+_subject_cache_lock = threading.Lock()
+
 def __run_cmd(command):
     '''
     Wrapper for subprocess.call_check
@@ -88,18 +301,109 @@ def __run_cmd(command):
         sys.exit(msg)
 
 
-def register_tractography(srcFile, targetFile, outDir):
+def set_thread_count(threads):
+    """
+    Sets the number of cores used by the pipeline.
+    Also limits the numpy / BLAS thread pools of child processes,
+    the launcher exports the same variables for this process.
+    """
+    global THREADS
+    THREADS = max(int(threads), 1)
+    for var in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']:
+        os.environ[var] = str(THREADS)
+
+
+def get_thread_count():
+    """
+    Number of cores the calling thread may use, THREADS unless the thread
+    was given its share of them, see main_atlases
+    """
+    return(getattr(_thread_state, 'threads', THREADS))
+
+
+def register_tractography(srcFile, targetFile, outDir, workers=1):
     """
     Register srcFile to targetFile using wm_register_to_atlas_new.py
     """
     cmd = ['wm_register_to_atlas_new.py',
-           srcFile,
-           targetFile,
+           '-j', str(workers),
+           staging.local(srcFile),
+           staging.local(get_registration_target(targetFile, outDir)),
            outDir]
 
     __run_cmd(cmd)
 
 
+def hash_file(fname):
+    """
+    Returns the sha1 of the contents of fname, files are only hashed
+    once per size and modification time
+    """
+    stat = os.stat(fname)
+    key = (os.path.abspath(fname), stat.st_mtime, stat.st_size)
+    if key not in _FILE_HASHES:
+        _FILE_HASHES[key] = sha1_file(fname)
+    return(_FILE_HASHES[key])
+
+
+def write_registration_target(subject_file, fname, n_fibers, min_length=0,
+                              seed=0):
+    """
+    Writes a random, but repeatable, sample of n_fibers of the subject
+    fibers at least min_length mm long to a binary .vtk file
+    """
+    if os.path.splitext(subject_file)[1] in ['.vtp', '.vtk']:
+        points, offsets = vtkio.read_polydata(subject_file)
+    else:
+        points, offsets = pack_streamlines(
+            get_streamlines_from_trk(subject_file))
+    _, lengths, _ = stream_stats(points, offsets)
+    idx = np.flatnonzero(lengths >= min_length)
+    if not len(idx):
+        msg = ('No fibers longer than {}mm in subject:{}'
+               .format(min_length, subject_file))
+        logger.error(msg)
+        sys.exit(msg)
+    if len(idx) > n_fibers:
+        idx = np.sort(np.random.RandomState(seed)
+                      .choice(idx, n_fibers, replace=False))
+
+    if not os.path.isdir(os.path.dirname(fname)):
+        os.makedirs(os.path.dirname(fname))
+    # readers never see a partial file
+    vtkio.write_vtk(fname + '.partial', *take_streamlines(points, offsets,
+                                                          idx))
+    os.rename(fname + '.partial', fname)
+    logger.info('Cached {} of {} subject fibers for registration in:{}'
+                .format(len(idx), len(lengths), fname))
+
+
+def get_registration_target(subject_file, output_dir):
+    """
+    The subject tractography passed to registration.
+    With SUBJECT_SAMPLE set this is a sample of the subject fibers, cached
+    in SUBJECT_CACHE_DIR (default output_dir) by the contents of the
+    subject file and the sample, so reruns and other atlases registered to
+    the same subject don't read the whole subject again.
+    """
+    if not SUBJECT_SAMPLE:
+        return(subject_file)
+    key = hashlib.sha1(json.dumps(dict(SUBJECT_SAMPLE,
+                                       sha1=hash_file(subject_file)),
+                                  sort_keys=True)
+                       .encode('utf-8')).hexdigest()[:16]
+    name = os.path.splitext(os.path.basename(subject_file))[0]
+    cached = os.path.join(SUBJECT_CACHE_DIR or output_dir,
+                          '{}_{}.vtk'.format(name, key))
+    # atlases registered at the same time wait for the first to write it
+    with _subject_cache_lock:
+        if os.path.isfile(cached):
+            logger.info('Using cached registration target:{}'.format(cached))
+        else:
+            write_registration_target(subject_file, cached, **SUBJECT_SAMPLE)
+    return(cached)
+
+
 def convert_vtp_to_vtk(path, outPath=None):
     """
     Converts a vtp file to vtk
@@ -149,7 +453,7 @@ def convert_vtk_to_trk(path, anatFile, outPath=None):
     cmd = ['TractConverter.py',
            '-i', path,
            '-o', outFile,
-           '-a', anatFile,
+           '-a', staging.local(anatFile),
            '-f']
     __run_cmd(cmd)
     return(outFile)
@@ -184,16 +488,15 @@ def get_most_advanced_file(filename):
             return fname
 
 
-def get_streams_from_file(fName, anatFile=None, outDir=None):
+def convert_file_to_trk(fName, anatFile=None, outDir=None):
     """
-    Process an input file to extract streamlines.
-    Takes care of file type conversions if needed.
-    Returns a list of streamlines
+    Takes care of file type conversions of an input file.
+    Converted files are created in outDir.
+    Returns the path to the .trk file
     """
     _, ext = os.path.splitext(fName)
     convert_to_vtk = False
     convert_to_trk = False
-    tmpDir = None
 
     if ext == '.vtp':
         if not anatFile:
@@ -207,12 +510,6 @@ def get_streams_from_file(fName, anatFile=None, outDir=None):
     elif ext != '.trk':
         logger.error('Unrecognised input file:{}'.format(fName))
 
-    if convert_to_vtk or convert_to_trk:
-        if not outDir:
-            tmpDir = tempfile.mkdtemp()
-            outDir = tmpDir
-        #os.chmod(tmpdir, 0666)
-
     if convert_to_vtk:
         logger.info('Converting file to vtk')
         fName = convert_vtp_to_vtk(fName, outDir)
@@ -221,6 +518,41 @@ def get_streams_from_file(fName, anatFile=None, outDir=None):
         logger.info('Converting file to trk')
         fName = convert_vtk_to_trk(fName, anatFile, outDir)
 
+    return(fName)
+
+
+def get_streamlines_from_polydata(fName):
+    """
+    Reads the streamlines of a .vtp or .vtk file without converting it.
+    TractConverter.py keeps the vtk coordinates and only uses the anat
+    file for the .trk header, so this returns the same float32 points
+    as convert_file_to_trk followed by get_streamlines_from_trk.
+    Returns a list of streamlines
+    """
+    points, offsets = vtkio.read_polydata(fName)
+    return(unpack_streamlines(points, offsets))
+
+
+def get_streams_from_file(fName, anatFile=None, outDir=None):
+    """
+    Process an input file to extract streamlines.
+    .vtp and .vtk files are read in memory, unless KEEP_INTERMEDIATES is
+    set, then they are converted to .trk in outDir first.
+    Returns a list of streamlines
+    """
+    if not KEEP_INTERMEDIATES and \
+            os.path.splitext(fName)[1] in ['.vtp', '.vtk']:
+        logger.debug('Reading streamlines from:{}'.format(fName))
+        return(get_streamlines_from_polydata(fName))
+
+    tmpDir = None
+    if not outDir and os.path.splitext(fName)[1] != '.trk':
+        tmpDir = tempfile.mkdtemp()
+        outDir = tmpDir
+        #os.chmod(tmpdir, 0666)
+
+    fName = convert_file_to_trk(fName, anatFile, outDir)
+
     logger.info('Extracting streamlines from file')
     streams = get_streamlines_from_trk(fName)
 
@@ -231,12 +563,26 @@ def get_streams_from_file(fName, anatFile=None, outDir=None):
     return(streams)
 
 
-def convert_clusters_to_streams(clusterDir,
-                                pattern=None,
-                                outDir=None,
-                                anatFile=None):
+def find_cluster_sources(clusterDir, pattern=None):
     """
-    Process a folder of cluster files, extracting the stream lines.
+    Finds the cluster files in clusterDir.
+    Return:
+        A dict {clustername: path to the .trk, .vtk or .vtp file}
+    """
+    clusters = find_cluster_files(clusterDir, pattern)
+    logger.info('Found {} cluster files.'.format(len(clusters)))
+    return({cluster_id: get_most_advanced_file(os.path.join(clusterDir,
+                                                            cluster_id))
+            for cluster_id in clusters})
+
+
+def convert_clusters_to_trk(clusterDir,
+                            pattern=None,
+                            outDir=None,
+                            anatFile=None,
+                            workers=1):
+    """
+    Process a folder of cluster files, converting them to .trk
 
     Inputs:
         clusterDir - directory containing the cluster files (.vtp)
@@ -245,29 +591,18 @@ def convert_clusters_to_streams(clusterDir,
         outDir - directory to create working files
         anatFile - subject nifti file that was used for tractography
             This can be left out if processing has already been done
+        workers - number of files to convert at the same time
 
     Return:
-        A dict {clustername: [streamlines]}
+        A dict {clustername: path to .trk file}
     """
-    # set a default pattern, so other files in the folder don't get processed
-    if not pattern:
-        pattern = '^.*cluster_\d{5}'
-
-    clusters = glob.glob(os.path.join(clusterDir, '*'))
-    # just get the cluster filename
-    clusters = [os.path.splitext(os.path.basename(f))[0]
-                for f in clusters]
-    clusters = set(clusters)
-    p = re.compile(pattern)
-    clusters = [f for f in clusters if p.match(f)]
+    clusters = find_cluster_files(clusterDir, pattern)
 
     logger.info('Found {} cluster files.'.format(len(clusters)))
 
-    cluster_streams = {}
-
-    # loop through all the possible files in reverse order
+    # look for all the possible files in reverse order
     # of computational difficulty
-    for cluster_id in clusters:
+    def convert_cluster(cluster_id):
         target_f = os.path.join(outDir, cluster_id)
         target_f = get_most_advanced_file(target_f)
         if not target_f:
@@ -275,258 +610,2256 @@ def convert_clusters_to_streams(clusterDir,
             target_f = os.path.join(clusterDir, cluster_id)
             target_f = get_most_advanced_file(target_f)
 
-        logger.info('Converting file:{}'.format(target_f))
-        streams = get_streams_from_file(target_f, anatFile, outDir=outDir)
-        cluster_streams[cluster_id] = streams
+        logger.debug('Converting file:{}'.format(target_f))
+        return(convert_file_to_trk(target_f, anatFile, outDir=outDir))
+
+    # conversion is mostly spent in external commands, so threads are enough
+    pool = ThreadPool(max(workers, 1))
+    try:
+        trk_files = []
+        with Progress('Converting clusters', total=len(clusters),
+                      unit='clusters') as prog:
+            for trk_file in pool.imap(convert_cluster, clusters):
+                trk_files.append(trk_file)
+                prog.update()
+    finally:
+        pool.close()
+        pool.join()
 
-    return(cluster_streams)
+    return(dict(zip(clusters, trk_files)))
 
 
-def match_fibers_to_clusters(fiber_streams, cluster_streams):
+def get_cluster_sources_state(clusterDir, pattern=None):
     """
-    Matches fiber streamlines to cluster streamlines.
-    Returns a vector of length fiber_streams, with keys from cluster_streams.
+    Returns {clustername: [size, mtime]} of the cluster files in clusterDir,
+    used to tell if a cluster cache is out of date.
     """
-    logger.info('Matching streams to clusters')
-    matches = [None] * len(fiber_streams)
-    cluster_streams_flat = []
-    cluster_labels_flat = []
-    for key, cluster in cluster_streams.iteritems():
-        for cluster_stream in cluster:
-            cluster_streams_flat.append(cluster_stream)
-            cluster_labels_flat.append(key)
-
-    logger.info('{} streams in {} clusters.'.format(len(cluster_streams_flat),
-                                                    len(cluster_streams)))
-    for i, stream in enumerate(fiber_streams):
-        logger.info('Searching for fiber:{}'.format(i))
-        idx = [np.array_equal(stream, cluster_stream)
-               for cluster_stream in cluster_streams_flat].index(True)
-
-        matches[i] = cluster_labels_flat[idx]
-    # for i, stream in enumerate(fiber_streams):
-    #     logger.info('Searching for fiber:{}'.format(i))
-    #     for key, cluster in cluster_streams.iteritems():
-    #         for cluster_stream in cluster:
-    #             if stream == cluster:
-    #                 matches[i] = key
-    #                 continue
-    return(matches)
-
-
-def get_stream_ends(streamlines, tractMap):
-    """
-    Extracts start end endpoints of fibers and maps to clusters
-    """
-    count = len(tractMap)
-    assert count == len(streamlines), ('All streamlines should'
-                                       ' be defined in the tractMap')
-    tract_ends = {}
-    for i, stream in enumerate(streamlines):
-        logger.info('Extracting ends for stream {} / {}'.format(i, count))
-        start_coords = streamlines[i][0].tolist()
-        end_coords = streamlines[i][-1].tolist()
+    sources = find_cluster_sources(clusterDir, pattern)
+    state = {}
+    for cluster_id, fname in sources.items():
+        stat = os.stat(fname)
+        state[cluster_id] = [stat.st_size, stat.st_mtime]
+    return(state)
+
+
+def build_cluster_cache(cache_file, clusterDir, pattern=None, outDir=None,
+                        anatFile=None, workers=1):
+    """
+    Reads every cluster file and writes the streamlines to a single
+    compressed cache file, one cluster at a time.
+
+    Cache arrays:
+        points - float32 coordinates of all streamlines
+        offsets - int64 (n_streams + 1), see streamlines.py
+        cluster_ids - int32 cluster of each streamline, indexing into
+            meta['cluster_names']
+        cluster_offsets - int64 (n_clusters + 1), the streamlines of
+            cluster i are cluster_offsets[i]:cluster_offsets[i + 1]
+    """
+    state = get_cluster_sources_state(clusterDir, pattern)
+    if KEEP_INTERMEDIATES:
+        cluster_files = convert_clusters_to_trk(clusterDir,
+                                                pattern=pattern,
+                                                outDir=outDir,
+                                                anatFile=anatFile,
+                                                workers=workers)
+    else:
+        cluster_files = find_cluster_sources(clusterDir, pattern)
+    cluster_names = sorted(cluster_files.keys())
+
+    logger.info('Writing cluster cache:{}'.format(cache_file))
+    pool = ThreadPool(max(workers, 1))
+    try:
+        with ChunkWriter(cache_file, chunk_rows=2 ** 18,
+                         compress=1) as writer:
+            writer.meta = {'version': CLUSTER_CACHE_VERSION,
+                           'cluster_dir': os.path.abspath(clusterDir),
+                           'cluster_names': cluster_names,
+                           'sources': state}
+            n_points = 0
+            n_streams = 0
+            cluster_offsets = [0]
+            writer.append('offsets', np.zeros(1, dtype=np.int64))
+            # imap keeps the cluster order while reading ahead
+            streams = pool.imap(get_streams_from_file,
+                                [cluster_files[name]
+                                 for name in cluster_names])
+            prog = Progress('Reading clusters', total=len(cluster_names),
+                            unit='clusters')
+            for cluster_id, cluster_streams in enumerate(streams):
+                prog.update()
+                points, offsets = pack_streamlines(cluster_streams)
+                writer.append('points', points)
+                writer.append('offsets', offsets[1:] + n_points)
+                writer.append('cluster_ids',
+                              np.full(len(cluster_streams), cluster_id,
+                                      dtype=np.int32))
+                n_points += len(points)
+                n_streams += len(cluster_streams)
+                cluster_offsets.append(n_streams)
+            writer.append('cluster_offsets',
+                          np.array(cluster_offsets, dtype=np.int64))
+            prog.finish()
+    finally:
+        pool.close()
+        pool.join()
+
+
+def get_cluster_cache(clusterDir, pattern=None, outDir=None, anatFile=None,
+                      workers=1):
+    """
+    Opens the cluster cache in outDir, creating it if it doesn't exist
+    or the cluster files have changed since it was written.
+    See build_cluster_cache for the inputs and contents.
 
+    Return:
+        An open ChunkReader, the caller closes it
+    """
+    cache_file = os.path.join(outDir, CLUSTER_CACHE)
+    state = get_cluster_sources_state(clusterDir, pattern)
+    # json turns the [size, mtime] pairs into lists of the same values
+    expected = {'version': CLUSTER_CACHE_VERSION,
+                'cluster_dir': os.path.abspath(clusterDir),
+                'cluster_names': sorted(state.keys()),
+                'sources': state}
+    if os.path.isfile(cache_file):
         try:
-            tract_ends[tractMap[i]]['starts'].append(start_coords)
-            tract_ends[tractMap[i]]['ends'].append(end_coords)
-        except KeyError:
-            tract_ends[tractMap[i]] = {'starts': [],
-                                       'ends': []}
-            tract_ends[tractMap[i]]['starts'].append(start_coords)
-            tract_ends[tractMap[i]]['ends'].append(end_coords)
-    return(tract_ends)
+            reader = ChunkReader(cache_file)
+        except ChunkFileError as e:
+            logger.warning('Ignoring cluster cache. {}'.format(str(e)))
+        else:
+            if reader.meta == expected and 'cluster_offsets' in reader.arrays:
+                logger.info('Using cluster cache:{}'.format(cache_file))
+                return(reader)
+            logger.info('Cluster cache is out of date:{}'.format(cache_file))
+            reader.close()
+
+    build_cluster_cache(cache_file, clusterDir, pattern, outDir, anatFile,
+                        workers)
+    return(ChunkReader(cache_file))
+
+
+def read_cluster_cache(cache):
+    """
+    Reads a whole cluster cache.
+
+    Return:
+        A dict {'points', 'offsets', 'cluster_ids', 'cluster_offsets',
+                'cluster_names'}, see build_cluster_cache
+    """
+    clusters = {name: cache.read(name)
+                for name in ['points', 'offsets', 'cluster_ids',
+                             'cluster_offsets']}
+    clusters['cluster_names'] = cache.meta['cluster_names']
+    return(clusters)
 
 
-def map_clusters_to_tracts(cluster_list, tract_map):
+def load_clusters(clusterDir, pattern=None, outDir=None, anatFile=None,
+                  workers=1):
     """
-    Takes a vector of clusters and a dict of tract membership.
-    Returns a vector of same length as clusters with values
-    replaced by tract membership
+    Loads the packed streamlines of all clusters through the cluster cache
+    in outDir. See convert_clusters_to_trk for the inputs, anatFile is
+    only used if KEEP_INTERMEDIATES is set.
+
+    Return:
+        See read_cluster_cache
     """
+    if not outDir:
+        # nowhere to keep the cache, the arrays are decompressed copies
+        # so they outlive the temporary folder
+        with tempdir.TempDir(prefix='clusters_') as tmpDir:
+            return(load_clusters(clusterDir, pattern, tmpDir, anatFile,
+                                 workers))
+
+    cache = get_cluster_cache(clusterDir, pattern, outDir, anatFile, workers)
+    try:
+        return(read_cluster_cache(cache))
+    finally:
+        cache.close()
 
-    cluster_map = {}
-    tracts = tract_map.keys()
-    #  rearrange tract map so can index by cluster instead of tract
-    for tract in tracts:
-        clusters = [v[0] for v in tract_map[tract]]
-        for cluster in clusters:
-            cluster_map[cluster] = tract
 
-    for i, cluster in enumerate(cluster_list):
-        cluster_list[i] = cluster_map[cluster]
+def convert_clusters_to_streams(clusterDir,
+                                pattern=None,
+                                outDir=None,
+                                anatFile=None,
+                                workers=1):
+    """
+    Process a folder of cluster files, extracting the stream lines.
+    See load_clusters for the inputs.
 
-    return(cluster_list)
+    Return:
+        A dict {clustername: [streamlines]}
+    """
+    clusters = load_clusters(clusterDir, pattern, outDir, anatFile, workers)
+    streams = unpack_streamlines(clusters['points'], clusters['offsets'])
+    bounds = clusters['cluster_offsets'].tolist()
+    return({name: streams[bounds[i]:bounds[i + 1]]
+            for i, name in enumerate(clusters['cluster_names'])})
 
 
-def convert_mm_to_voxels(coords, anat):
+def match_tolerant(points, offsets, match_tree):
     """
-    Uses measurements from the anatomy file to convert coordinates
-    from mm to voxels.
+    Finds the nearest cluster streamline within MATCH_TOLERANCE of each
+    packed streamline, see streamlines.match_resampled.
+    Returns a tuple (idx, distances), idx is -1 where none is close enough
     """
-    img = nib.load(anat)
-    affine = img.affine
-    for key, val in coords.iteritems():
-        coords_start = val['starts']
-        coords_end = val['ends']
-        voxels_start = nib.affines.apply_affine(npl.inv(affine), coords_start)
-        voxels_end = nib.affines.apply_affine(npl.inv(affine), coords_end)
-        # convert from numpy array back to list for json.dumps
-        voxels_start = voxels_start.tolist()
-        voxels_end = voxels_end.tolist()
-        coords[key]['starts'] = voxels_start
-        coords[key]['ends'] = voxels_end
-    return coords
+    return(match_resampled(match_tree,
+                           resample_streamlines(points, offsets,
+                                                match_tree['n_points']),
+                           MATCH_TOLERANCE))
 
 
-def process_atlas(atlas_file, subject_file, output_dir, anatFile=None):
+def fail_unmatched(n_missing):
+    msg = '{} fibers not found in any cluster'.format(n_missing)
+    if MATCH_TOLERANCE is not None:
+        msg += ' within {}mm'.format(MATCH_TOLERANCE)
+    logger.error(msg)
+    sys.exit(msg)
+
+
+def save_match_distances(output_dir, distances, cluster_ids):
     """
-    Convert an atlas file to streamlines in subject space.
+    Logs how far the fibers are from their cluster streamlines and saves
+    the distance of every fiber to <output_dir>/match_distances.tmc
+    Exact matches have a distance of 0
+    """
+    inexact = distances[distances > 0]
+    if len(inexact):
+        logger.info('{} fibers differ from their cluster streamline, median '
+                    'distance {:.3g}mm, max {:.3g}mm'
+                    .format(len(inexact), np.median(inexact), inexact.max()))
+    fname = os.path.join(output_dir, MATCH_DISTANCES)
+    with ChunkWriter(fname, chunk_rows=2 ** 18, compress=1) as writer:
+        writer.meta = {'tolerance': MATCH_TOLERANCE,
+                       'n_points': MATCH_POINTS,
+                       'n_inexact': len(inexact)}
+        writer.append('distances', distances.astype(np.float32))
+        writer.append('cluster_ids', cluster_ids)
+
+
+def match_fibers_to_clusters(fiber_streams, clusters, workers=1,
+                             work_dir=None):
+    """
+    Matches fiber streamlines to cluster streamlines.
+    The matching is sharded between workers processes, see match_streams.
+    With MATCH_TOLERANCE set, fibers without an identical cluster
+    streamline are matched to the nearest one, see match_tolerant.
 
-    Checks to see how much processing has been performed on the atlas.
     Inputs:
-        .vtp (or .vtk) atlas and subject files
-        output_dir - directory to create working files
-        anatFile - subject nifti file that was used for tractography
-            This can be left out if processing has already been done
-
+        clusters - packed cluster streamlines from load_clusters
+    Returns a tuple (cluster_ids, cluster_names, distances).
+        cluster_ids - np.int32 vector of length fiber_streams, indexing
+            into cluster_names
+        cluster_names - sorted list of cluster names
+        distances - distance of each fiber to its cluster streamline,
+            0 for identical streamlines
+    """
+    logger.info('Matching streams to clusters')
+    logger.info('{} streams in {} clusters.'
+                .format(len(clusters['cluster_ids']),
+                        len(clusters['cluster_names'])))
+    fiber_points, fiber_offsets = pack_streamlines(fiber_streams)
+    with Progress('Matching fibers', total=len(fiber_streams)) as prog:
+        match_idx = match_streams(fiber_points, fiber_offsets,
+                                  clusters['points'], clusters['offsets'],
+                                  workers=workers, work_dir=work_dir,
+                                  progress=prog.update)
+
+    distances = np.zeros(len(match_idx))
+    missing = np.flatnonzero(match_idx < 0)
+    if len(missing) and MATCH_TOLERANCE is not None:
+        logger.info('Matching {} fibers to the nearest cluster streamline'
+                    .format(len(missing)))
+        match_tree = make_match_tree(resample_streamlines(
+            clusters['points'], clusters['offsets'], MATCH_POINTS))
+        idx, dist = match_tolerant(*take_streamlines(fiber_points,
+                                                     fiber_offsets, missing),
+                                   match_tree=match_tree)
+        match_idx[missing] = idx
+        distances[missing] = dist
+        missing = missing[idx < 0]
+    if len(missing):
+        fail_unmatched(len(missing))
+
+    return(clusters['cluster_ids'].take(match_idx),
+           clusters['cluster_names'],
+           distances)
+
+
+def get_stream_ends(streamlines):
+    """
+    Extracts start end endpoints of fibers
     Return:
-        Dict {'registered': A list of streamlines from the registered atlas,
-              'raw': Streamlines from the unregistered atlas.}
+        A tuple (starts, ends) of (n, 3) arrays, one row per streamline
     """
-    atlas_name = os.path.splitext(os.path.basename(atlas_file))[0]
+    logger.info('Extracting ends for {} streams'.format(len(streamlines)))
+    starts = np.array([stream[0] for stream in streamlines]).reshape(-1, 3)
+    ends = np.array([stream[-1] for stream in streamlines]).reshape(-1, 3)
+    return(starts, ends)
 
-    # find the most processed version of the atlas file
-    atlas_raw = get_most_advanced_file(os.path.join(output_dir, atlas_name))
-    if not atlas_raw:
-        atlas_raw = get_most_advanced_file(atlas_file)
 
-    streams_raw = convert_atlas_to_streams(atlas_raw,
-                                           anatFile=anatFile,
-                                           outDir=output_dir)
+def group_ends_by_tract(starts, ends, tract_ids, tract_names):
+    """
+    Groups per-fiber start and end coordinates by tract id.
+    Tracts without any fibers are not included in the output.
+    """
+    keep = tract_ids >= 0
+    tract_ids = tract_ids[keep]
+    starts = starts[keep]
+    ends = ends[keep]
+
+    # stable sort so fibers keep their atlas order within a tract
+    order = np.argsort(tract_ids, kind='mergesort')
+    counts = np.bincount(tract_ids, minlength=len(tract_names))
+    bounds = np.cumsum(counts)[:-1]
+    starts = np.split(starts.take(order, axis=0), bounds)
+    ends = np.split(ends.take(order, axis=0), bounds)
 
-    # check if registration has already been performed
-    atlas_reg = os.path.join(output_dir,
-                             '{}/output_tractography/{}_reg.vtk')
+    tract_ends = {}
+    for tract_id, tract in enumerate(tract_names):
+        if counts[tract_id]:
+            tract_ends[tract] = {'starts': starts[tract_id],
+                                 'ends': ends[tract_id]}
+    return(tract_ends)
 
-    atlas_reg = atlas_reg.format(atlas_name, atlas_name)
 
-    if not os.path.isfile(atlas_reg):
-        # need to register atlas to subject space
-        register_tractography(atlas_file, subject_file, output_dir)
+def make_cluster_to_tract(cluster_names, tract_map):
+    """
+    Builds a lookup table from cluster id to tract id.
+    Returns a tuple (cluster_to_tract, tract_names), cluster_to_tract is a
+    np.int32 vector with one tract id (or -1) per entry in cluster_names.
+    """
+    tract_names = sorted(tract_map.keys())
+    cluster_index = {cluster: i for i, cluster in enumerate(cluster_names)}
 
-    # next check if the registered atlas has already been converted to .trk
-    atlas_reg = get_most_advanced_file(atlas_reg)
-    streams_reg = convert_atlas_to_streams(atlas_reg,
-                                           anatFile=anatFile,
-                                           outDir=os.path.dirname(atlas_reg))
-    return {'registered': streams_reg,
-            'raw': streams_raw}
+    #  lookup table so can index by cluster id instead of tract
+    cluster_to_tract = np.full(len(cluster_names), -1, dtype=np.int32)
+    for tract_id, tract in enumerate(tract_names):
+        for cluster, _ in tract_map[tract]:
+            if cluster in cluster_index:
+                cluster_to_tract[cluster_index[cluster]] = tract_id
+    return(cluster_to_tract, tract_names)
 
 
-def clean_working_dir(outputDir):
-    shutil.rmtree(outputDir)
+def map_clusters_to_tracts(cluster_ids, cluster_names, tract_map):
+    """
+    Takes a vector of cluster ids, the cluster names they index
+    and a dict of tract membership.
+    Returns a tuple (tract_ids, tract_names), tract_ids is a np.int32 vector
+    of same length as cluster_ids indexing into tract_names.
+    Clusters that do not belong to any tract are given the id -1.
+    """
+    cluster_to_tract, tract_names = make_cluster_to_tract(cluster_names,
+                                                          tract_map)
+    tract_ids = cluster_to_tract.take(cluster_ids)
+    unassigned = np.count_nonzero(tract_ids < 0)
+    if unassigned:
+        logger.warning('{} fibers belong to clusters without a tract.'
+                       .format(unassigned))
 
+    return(tract_ids, tract_names)
 
-def main(atlas_fibers, atlas_clusters, cluster_pattern,
-         subject_fibers, mrml_map, subject_anat, output_dir,
-         cleanup):
 
-    # create working directories
-    if not os.path.isdir(output_dir):
-        os.mkdir(output_dir)
+def read_fiber_filter(filter_file=None, **defaults):
+    """
+    Collects the fiber filter thresholds, see FIBER_FILTER_UNSET.
+    Inputs:
+        filter_file - optional json file {tract_name: {threshold: value}}
+            with the thresholds of single tracts
+        defaults - thresholds for every other tract, None values are unset
+    Return:
+        A dict {'default': {threshold: value},
+                'tracts': {tract_name: {threshold: value}}},
+        None if no threshold is set
+    """
+    fiber_filter = {'default': {key: val for key, val in defaults.items()
+                                if val is not None},
+                    'tracts': {}}
+    if filter_file:
+        try:
+            with open(filter_file, 'r') as f:
+                fiber_filter['tracts'] = json.load(f)
+        except (IOError, ValueError) as e:
+            msg = 'Failed to read fiber filter:{}. {}'.format(filter_file,
+                                                              str(e))
+            logger.error(msg)
+            sys.exit(msg)
 
-    cluster_dir = os.path.join(output_dir, 'clusters')
-    if not os.path.isdir(cluster_dir):
-        os.mkdir(cluster_dir)
+    for thresholds in [fiber_filter['default']] + \
+            list(fiber_filter['tracts'].values()):
+        unknown = set(thresholds) - set(FIBER_FILTER_UNSET)
+        if unknown:
+            msg = ('Unknown fiber filter thresholds:{}'
+                   .format(', '.join(sorted(unknown))))
+            logger.error(msg)
+            sys.exit(msg)
 
-    # convert a tractography atlas to subject space and get the streamlines
-    atlas_streams = process_atlas(atlas_fibers,
-                                  subject_fibers,
-                                  output_dir,
-                                  subject_anat)
+    if not fiber_filter['default'] and not any(fiber_filter['tracts'].values()):
+        return(None)
+    return(fiber_filter)
 
-    # convert clustered fibers in atlas space to identified streamlines
-    cluster_streams = convert_clusters_to_streams(atlas_clusters,
-                                                  anatFile=subject_anat,
-                                                  pattern=cluster_pattern,
-                                                  outDir=cluster_dir)
-    # get the mapping from cluster id to tract
-    tract_map = MapTracts(mrml_map)
 
-    # match the tracts identified in the unregistered atlas to
-    # fibers in the registered atlas
-    matches = match_fibers_to_clusters(atlas_streams['raw'], cluster_streams)
-    matches = map_clusters_to_tracts(matches, tract_map.tract_map)
+def prepare_fiber_filter(fiber_filter, labels):
+    """
+    Expands the thresholds of read_fiber_filter to one entry per tract of
+    the atlas, the last entry is used for fibers without a tract.
+    Return:
+        A dict used by filter_streams
+        {'cluster_to_tract': see make_cluster_to_tract,
+         'tract_names': list of tract names,
+         threshold: np.float64 vector for each threshold,
+         'removed': np.int64 count of the fibers removed from each tract,
+         'thresholds': fiber_filter}
+    """
+    cluster_to_tract, tract_names = make_cluster_to_tract(
+        labels['cluster_names'], labels['tract_map'])
+    unknown = set(fiber_filter['tracts']) - set(tract_names)
+    if unknown:
+        logger.warning('Fiber filter thresholds for unknown tracts:{}'
+                       .format(' : '.join(sorted(unknown))))
+
+    # -1 indexes the entry for fibers without a tract
+    prepared = {'cluster_to_tract': cluster_to_tract,
+                'tract_names': tract_names,
+                'removed': np.zeros(len(tract_names) + 1, dtype=np.int64),
+                'thresholds': fiber_filter}
+    for key, unset in FIBER_FILTER_UNSET.items():
+        default = fiber_filter['default'].get(key, unset)
+        prepared[key] = np.array(
+            [fiber_filter['tracts'].get(tract, {}).get(key, default)
+             for tract in tract_names] + [default], dtype=np.float64)
+    return(prepared)
+
+
+def filter_streams(streams, cluster_ids, fiber_filter):
+    """
+    Checks the point count, arc length and end point distance of each
+    streamline against the thresholds of its tract, counting the removed
+    fibers in fiber_filter['removed'].
+    Inputs:
+        fiber_filter - from prepare_fiber_filter
+    Returns a boolean vector, True for the streamlines that are kept
+    """
+    tract_ids = fiber_filter['cluster_to_tract'].take(cluster_ids)
+    n_points, lengths, end_distances = stream_stats(
+        *pack_streamlines(streams))
+    keep = ((n_points >= fiber_filter['min_points'][tract_ids]) &
+            (lengths >= fiber_filter['min_length'][tract_ids]) &
+            (lengths <= fiber_filter['max_length'][tract_ids]) &
+            (end_distances >= fiber_filter['min_end_distance'][tract_ids]))
+    fiber_filter['removed'] += np.bincount(
+        tract_ids[~keep] % len(fiber_filter['removed']),
+        minlength=len(fiber_filter['removed']))
+    return(keep)
+
+
+def filter_subject_streams(streams, cluster_ids, fiber_filter,
+                           block=2 ** 16):
+    """
+    Applies filter_streams to a list of streamlines block fibers at a
+    time, so only one block is packed at once.
+    Returns a tuple (streams, cluster_ids) of the kept fibers
+    """
+    keep = np.ones(len(streams), dtype=bool)
+    for start in range(0, len(streams), block):
+        keep[start:start + block] = filter_streams(
+            streams[start:start + block], cluster_ids[start:start + block],
+            fiber_filter)
+    return([streams[i] for i in np.flatnonzero(keep)], cluster_ids[keep])
 
-    # use tract -> fiber map to obtain fiber end points from registered atlas
-    # check to see if this atlas has already been registered, create if not.
-    tract_ends = get_stream_ends(atlas_streams['registered'], matches)
-    if subject_anat:
-        tract_ends_voxels = convert_mm_to_voxels(tract_ends, subject_anat)
 
-    if cleanup:
-        clean_working_dir(output_dir)
+def get_filter_counts(fiber_filter):
+    """
+    The number of fibers removed by a fiber filter, stored with the fiber
+    ends. None if no filter was used.
+    """
+    if fiber_filter is None:
+        return(None)
+    removed = fiber_filter['removed']
+    return({'thresholds': fiber_filter['thresholds'],
+            'removed': {tract: int(n) for tract, n in
+                        zip(fiber_filter['tract_names'], removed) if n},
+            'removed_unassigned': int(removed[-1]),
+            'removed_total': int(removed.sum())})
 
-    return json.dumps(tract_ends_voxels)
 
+def iter_streamline_chunks(trkFile, chunk_fibers):
+    """
+    Lazily reads streamlines from a .trk file.
+    .vtp and .vtk files can't be read lazily, they are read whole
+    and then split up.
+    Yields lists of at most chunk_fibers streamlines.
+    """
+    if os.path.splitext(trkFile)[1] == '.trk':
+        streams, hdr = tv.read(trkFile, as_generator=True)
+        streams = (i[0] for i in streams)
+    else:
+        streams = iter(get_streamlines_from_polydata(trkFile))
+    while True:
+        chunk = list(itertools.islice(streams, chunk_fibers))
+        if not chunk:
+            return
+        yield chunk
 
-if __name__ == "__main__":
-    arguments = docopt(__doc__)
-    atlasFile = arguments['--atlas_file']
-    clusterDir = arguments['--cluster_dir']
-    mrmlFile = arguments['--mrml_file']
-    subjectFile = arguments['<subjectFile>']
-    workingDir = arguments['--work_dir']
-    anatFile = arguments['<anatFile>']
-    outfile = arguments['--output']
 
-    CONTAINER_FILE = arguments['--mirtk_file']
+def iter_cluster_cache(cache, chunk_fibers):
+    """
+    Reads the streamlines of a cluster cache, only decoding the part of
+    the file needed for each chunk.
+    Yields lists of at most chunk_fibers streamlines.
+    """
+    offsets = cache.read('offsets')
+    for start in range(0, len(offsets) - 1, chunk_fibers):
+        stop = min(start + chunk_fibers, len(offsets) - 1)
+        points = cache.read('points', offsets[start], offsets[stop])
+        yield unpack_streamlines(points,
+                                 offsets[start:stop + 1] - offsets[start])
 
-    pattern = arguments['--cluster-pattern']
 
-    if arguments['--cleanup']:
-        cleanup = True
-    else:
-        cleanup = False
+def build_cluster_index(cache, chunk_fibers):
+    """
+    Hashes the streamlines in a cluster cache, without holding
+    the streamlines in memory.
 
-    if arguments['--debug']:
-        logger.setLevel(logging.DEBUG)
-    elif arguments['--quiet']:
-        logger.setLevel(logging.ERROR)
-    else:
-        logger.setLevel(logging.INFO)
+    Inputs:
+        cache - open cluster cache, see get_cluster_cache
+    Return:
+        A dict {'hashes': sorted np.uint64 stream hashes,
+                'cluster_ids': np.int32 cluster id for each hash,
+                'cluster_names': sorted list of cluster names,
+                'resampled': with MATCH_TOLERANCE set, the streamline of
+                    each hash resampled to MATCH_POINTS points,
+                'match_tree': KD-tree over 'resampled', built on first use}
+    """
+    cluster_names = cache.meta['cluster_names']
+    hashes = []
+    resampled = []
+    with Progress('Indexing clusters',
+                  total=cache.shape('cluster_ids')[0]) as prog:
+        for chunk in iter_cluster_cache(cache, chunk_fibers):
+            hashes.append(hash_streams(chunk))
+            if MATCH_TOLERANCE is not None:
+                resampled.append(resample_streamlines(
+                    *pack_streamlines(chunk), n_points=MATCH_POINTS))
+            prog.update(len(chunk))
+    hashes = np.concatenate(hashes) if hashes else np.empty(0, np.uint64)
+    cluster_ids = cache.read('cluster_ids')
+    # a streamline in several clusters always finds the first of them,
+    # like match_streams
+    order = np.argsort(hashes, kind='mergesort')
+    logger.info('{} streams in {} clusters.'.format(len(hashes),
+                                                    len(cluster_names)))
+    index = {'hashes': hashes[order],
+             'cluster_ids': cluster_ids[order],
+             'cluster_names': cluster_names,
+             'resampled': None,
+             'match_tree': None}
+    if MATCH_TOLERANCE is not None:
+        index['resampled'] = (np.concatenate(resampled)[order] if resampled
+                              else np.empty((0, MATCH_POINTS, 3), np.float32))
+    return(index)
+
+
+def lookup_clusters(streams, cluster_index):
+    """
+    Finds the cluster id of each streamline in a cluster index, with
+    MATCH_TOLERANCE set streamlines without an identical cluster
+    streamline are matched to the nearest one
+    Returns a tuple (cluster_ids, distances), see match_fibers_to_clusters
+    """
+    idx, found = find_hashes(cluster_index['hashes'], hash_streams(streams))
+    distances = np.zeros(len(idx))
+    missing = np.flatnonzero(~found)
+    if len(missing) and cluster_index.get('resampled') is not None:
+        if cluster_index['match_tree'] is None:
+            cluster_index['match_tree'] = make_match_tree(
+                cluster_index['resampled'])
+        near, dist = match_tolerant(
+            *pack_streamlines([streams[i] for i in missing]),
+            match_tree=cluster_index['match_tree'])
+        idx[missing] = near
+        distances[missing] = dist
+        missing = missing[near < 0]
+    if len(missing):
+        fail_unmatched(len(missing))
+    return(cluster_index['cluster_ids'].take(idx), distances)
+
+
+def iter_chunk_labels(raw_trk, cluster_index, chunk_fibers, distances=None):
+    """
+    Yields the cluster ids of the fibers of the unregistered atlas,
+    chunk_fibers at a time.
+    distances - if set, a list the match distances of each chunk are
+        appended to, see lookup_clusters
+    """
+    for chunk in iter_streamline_chunks(raw_trk, chunk_fibers):
+        cluster_ids, chunk_distances = lookup_clusters(chunk, cluster_index)
+        if distances is not None:
+            distances.append(chunk_distances)
+        yield cluster_ids
 
-    script_dir = os.path.dirname(__file__)
-    if not os.path.isabs(atlasFile):
-        atlasFile = os.path.abspath(os.path.join(script_dir, atlasFile))
-    if not os.path.isabs(clusterDir):
-        clusterDir = os.path.abspath(os.path.join(script_dir, clusterDir))
-    if not os.path.isabs(mrmlFile):
-        mrmlFile = os.path.abspath(os.path.join(script_dir, mrmlFile))
 
-    if workingDir:
-        ends = main(atlasFile,
-                    clusterDir,
-                    pattern,
-                    subjectFile,
-                    mrmlFile,
-                    anatFile,
-                    workingDir,
-                    cleanup)
-    else:
-        with tempdir.TempDir(prefix="tractmap_") as workingDir:
-            ends = main(atlasFile,
-                        clusterDir,
-                        pattern,
-                        subjectFile,
-                        mrmlFile,
-                        anatFile,
-                        workingDir,
-                        cleanup)
+def stream_ends(reg_trk, label_chunks, chunk_fibers, export=None,
+                fiber_filter=None):
+    """
+    Reads the registered atlas chunk_fibers at a time, in lockstep
+    with label_chunks, keeping only the end points of each fiber.
 
-    if outfile:
-        with open(outfile, 'w+') as outfile:
-            outfile.writelines(ends)
-    else:
+    Inputs:
+        reg_trk - the registered atlas .trk file
+        label_chunks - iterable of np.int32 cluster id vectors, one per chunk
+        export - if set, the streamlines are also added to this
+            StreamlineExportWriter
+        fiber_filter - if set, fibers are checked with filter_streams,
+            removed fibers are not exported
+    Return:
+        A tuple (cluster_ids, starts, ends, keep) for all fibers, keep is
+        True for the fibers that passed the filter
+    """
+    chunks = zip_longest(label_chunks,
+                         iter_streamline_chunks(reg_trk, chunk_fibers))
+    all_ids = []
+    all_starts = []
+    all_ends = []
+    all_keep = []
+    prog = Progress('Extracting ends')
+    for i, (cluster_ids, streams) in enumerate(chunks):
+        if cluster_ids is None or streams is None \
+                or len(cluster_ids) != len(streams):
+            msg = ('The registered atlas:{} and the atlas labels have '
+                   'different numbers of fibers'.format(reg_trk))
+            logger.error(msg)
+            sys.exit(msg)
+        logger.debug('Extracting ends for chunk:{}'.format(i))
+        keep = np.ones(len(streams), dtype=bool)
+        if fiber_filter is not None:
+            keep = filter_streams(streams, cluster_ids, fiber_filter)
+        starts = np.array([stream[0] for stream in streams]).reshape(-1, 3)
+        ends = np.array([stream[-1] for stream in streams]).reshape(-1, 3)
+        if export is not None:
+            export.add([streams[j] for j in np.flatnonzero(keep)],
+                       cluster_ids[keep])
+        all_ids.append(cluster_ids)
+        all_starts.append(starts)
+        all_ends.append(ends)
+        all_keep.append(keep)
+        prog.update(len(streams))
+    prog.finish()
+
+    if not all_ids:
+        return(np.empty(0, np.int32), np.empty((0, 3), np.float32),
+               np.empty((0, 3), np.float32), np.empty(0, bool))
+    return(np.concatenate(all_ids),
+           np.concatenate(all_starts),
+           np.concatenate(all_ends),
+           np.concatenate(all_keep))
+
+
+def split_labels(cluster_ids, chunk_fibers):
+    """
+    Yields consecutive chunk_fibers sized parts of cluster_ids
+    """
+    for start in range(0, len(cluster_ids), chunk_fibers):
+        yield cluster_ids[start:start + chunk_fibers]
+
+
+def read_anat_header(anat):
+    """
+    Reads the voxel to mm affine and the voxel grid shape of a nifti file.
+    Headers are only read once per file, so atlases mapped to the same
+    subject share them.
+    Returns a tuple (affine, shape)
+    """
+    stat = os.stat(anat)
+    key = (os.path.abspath(anat), stat.st_mtime, stat.st_size)
+    with _anat_lock:
+        if key not in _ANAT_HEADERS:
+            img = nib.load(anat)
+            _ANAT_HEADERS[key] = (img.affine,
+                                  tuple(int(i) for i in img.shape[:3]))
+        affine, shape = _ANAT_HEADERS[key]
+    return(affine.copy(), shape)
+
+
+def make_fiber_ends(starts, ends, cluster_ids, cluster_names, anat=None):
+    """
+    Collects the per fiber results of a subject. These don't depend on the
+    tract definitions, see fiber_ends_to_tracts.
+
+    Return:
+        A dict {'starts': (n, 3) float32 registered start points in mm,
+                'ends': (n, 3) float32 end points in mm,
+                'cluster_ids': np.int32 cluster of each fiber,
+                'cluster_names': list of cluster names,
+                'affine': voxel to mm affine of anat, None without anat,
+                'shape': voxel grid of anat, None without anat,
+                'filtered': fibers removed by the fiber filter, set by
+                    process_subject, see get_filter_counts}
+    """
+    affine = None
+    shape = None
+    if anat:
+        affine, shape = read_anat_header(anat)
+    return({'starts': np.asarray(starts, dtype=np.float32),
+            'ends': np.asarray(ends, dtype=np.float32),
+            'cluster_ids': np.asarray(cluster_ids, dtype=np.int32),
+            'cluster_names': list(cluster_names),
+            'affine': affine,
+            'shape': shape,
+            'filtered': None})
+
+
+def fiber_ends_to_tracts(fiber_ends, tract_map):
+    """
+    Groups the fiber end points of a subject by tract, using the cluster
+    membership of tract_map, see parse_mrml.MapTracts.
+    Coordinates are converted from mm to voxels if the subject had an
+    anat file.
+
+    Return:
+        A dict {tract_name: {'starts': (n, 3) array, 'ends': (n, 3) array}}
+    """
+    tract_ids, tract_names = map_clusters_to_tracts(fiber_ends['cluster_ids'],
+                                                    fiber_ends['cluster_names'],
+                                                    tract_map)
+    starts, ends = get_output_coords(fiber_ends)
+    return(group_ends_by_tract(starts, ends, tract_ids, tract_names))
+
+
+def get_output_coords(fiber_ends):
+    """
+    Returns the (starts, ends) of the fibers in the units of the outputs,
+    voxels if the subject had an anat file, otherwise mm
+    """
+    starts = fiber_ends['starts']
+    ends = fiber_ends['ends']
+    if fiber_ends['affine'] is not None:
+        inv_affine = npl.inv(fiber_ends['affine'])
+        starts = nib.affines.apply_affine(inv_affine, starts)
+        ends = nib.affines.apply_affine(inv_affine, ends)
+    return(starts, ends)
+
+
+def get_streamlines_file(outfile):
+    """
+    The exported streamlines of a subject are written next to its output
+    """
+    return(os.path.splitext(outfile)[0] + '_streamlines.tmc')
+
+
+def open_streamline_export(outfile, labels, step, **meta):
+    """
+    Opens the streamline export of a subject, see streamline_export.py
+    Extra keyword arguments are stored in the export.
+    Returns a StreamlineExportWriter, None if step is None
+    """
+    if step is None:
+        return(None)
+    cluster_to_tract, tract_names = make_cluster_to_tract(
+        labels['cluster_names'], labels['tract_map'])
+    return(streamline_export.StreamlineExportWriter(
+        get_streamlines_file(outfile), cluster_to_tract, tract_names,
+        step=step, **meta))
+
+
+def get_fiber_ends_file(outfile):
+    """
+    The fiber ends of a subject are saved next to its output
+    """
+    return(os.path.splitext(outfile)[0] + '_fiber_ends.tmc')
+
+
+def save_fiber_ends(fname, fiber_ends, **meta):
+    """
+    Saves the fiber ends of a subject to a chunk file, any extra
+    keyword arguments are stored in its meta data.
+    """
+    affine = fiber_ends['affine']
+    with ChunkWriter(fname, chunk_rows=2 ** 18, compress=1) as writer:
+        writer.meta = dict(meta,
+                           version=FIBER_ENDS_VERSION,
+                           cluster_names=fiber_ends['cluster_names'],
+                           affine=None if affine is None else affine.tolist(),
+                           shape=fiber_ends['shape'],
+                           filtered=fiber_ends.get('filtered'))
+        for name in ['starts', 'ends', 'cluster_ids']:
+            writer.append(name, fiber_ends[name])
+
+
+def load_fiber_ends(fname):
+    """
+    Reads fiber ends saved by save_fiber_ends.
+    Return:
+        A tuple (fiber_ends, meta)
+    """
+    try:
+        reader = ChunkReader(fname)
+    except (ChunkFileError, IOError, OSError) as e:
+        msg = 'Failed to read fiber ends:{}. {}'.format(fname, str(e))
+        logger.error(msg)
+        sys.exit(msg)
+
+    with reader:
+        meta = reader.meta
+        if meta.get('version') != FIBER_ENDS_VERSION:
+            msg = ('Unsupported fiber ends version:{} in {}'
+                   .format(meta.get('version'), fname))
+            logger.error(msg)
+            sys.exit(msg)
+        # compressed chunks are decoded to copies, they outlive the reader
+        fiber_ends = {name: reader.read(name)
+                      for name in ['starts', 'ends', 'cluster_ids']}
+    fiber_ends['cluster_names'] = meta['cluster_names']
+    fiber_ends['filtered'] = meta.get('filtered')
+    fiber_ends['affine'] = None
+    fiber_ends['shape'] = None
+    if meta['affine'] is not None:
+        fiber_ends['affine'] = np.array(meta['affine'])
+        fiber_ends['shape'] = tuple(meta['shape'])
+    return(fiber_ends, meta)
+
+
+def count_bins(idx, n_bins, block=2 ** 24):
+    """
+    np.bincount of idx into a np.int32 vector of length n_bins.
+    Counts at most block bins at a time, so the int64 counts bincount
+    returns stay small however many bins there are.
+    """
+    if n_bins <= block:
+        return(np.bincount(idx, minlength=n_bins).astype(np.int32))
+    idx = np.sort(idx)
+    starts = np.arange(0, n_bins, block)
+    edges = np.searchsorted(idx, np.append(starts, n_bins))
+    counts = np.empty(n_bins, dtype=np.int32)
+    for i, start in enumerate(starts):
+        stop = min(start + block, n_bins)
+        counts[start:stop] = np.bincount(idx[edges[i]:edges[i + 1]] - start,
+                                         minlength=stop - start)
+    return(counts)
+
+
+def make_density_maps(fiber_ends, tract_map):
+    """
+    Counts the fiber end points of each tract in every voxel of the
+    subject anat grid.
+
+    Return:
+        A tuple (data, tract_names)
+        data - np.int32 (x, y, z, 3 * n_tracts) array, volume
+            kind * n_tracts + tract_id counts the starts (kind 0),
+            ends (kind 1) or both (kind 2) of the fibers in a tract
+        tract_names - list of tract names indexed by tract_id
+    """
+    if fiber_ends['affine'] is None:
+        msg = 'Density maps need the subject anat file'
+        logger.error(msg)
+        sys.exit(msg)
+
+    tract_ids, tract_names = map_clusters_to_tracts(fiber_ends['cluster_ids'],
+                                                    fiber_ends['cluster_names'],
+                                                    tract_map)
+    shape = fiber_ends['shape']
+    n_voxels = int(np.prod(shape))
+    n_tracts = len(tract_names)
+    inv_affine = npl.inv(fiber_ends['affine'])
+
+    data = np.zeros(tuple(shape) + (3 * n_tracts,), dtype=np.int32,
+                    order='F')
+    # fortran order, so volume v is the flat range v * n_voxels ...
+    flat = data.reshape(-1, order='F')
+    for kind, name in enumerate(['starts', 'ends']):
+        voxels = np.rint(nib.affines.apply_affine(inv_affine,
+                                                  fiber_ends[name]))
+        keep = (tract_ids >= 0) & np.all((voxels >= 0) &
+                                         (voxels < np.array(shape)), axis=1)
+        outside = np.count_nonzero((tract_ids >= 0) & ~keep)
+        if outside:
+            logger.warning('{} fiber {} are outside the anat grid.'
+                           .format(outside, name))
+        voxels = voxels[keep].astype(np.intp)
+        idx = np.ravel_multi_index(voxels.T, shape, order='F')
+        idx = idx + tract_ids[keep].astype(np.intp) * n_voxels
+        lo = kind * n_tracts * n_voxels
+        flat[lo:lo + n_tracts * n_voxels] = count_bins(idx,
+                                                       n_tracts * n_voxels)
+    both = 2 * n_tracts * n_voxels
+    flat[both:] = (flat[:n_tracts * n_voxels] +
+                   flat[n_tracts * n_voxels:both])
+    return(data, tract_names)
+
+
+def kmeans(points, k, max_iter=100, seed=0):
+    """
+    Lloyd's k-means with k-means++ seeding from a fixed seed, so the same
+    points always give the same clusters.
+    Return:
+        A tuple (centroids, counts), sorted by decreasing count
+    """
+    points = np.asarray(points, dtype=np.float64)
+    k = min(k, len(points))
+    if k == 0:
+        return(np.empty((0, 3)), np.empty(0, dtype=np.intp))
+
+    rng = np.random.RandomState(seed)
+    centroids = [points[rng.randint(len(points))]]
+    dist = ((points - centroids[0]) ** 2).sum(axis=1)
+    for _ in range(1, k):
+        if dist.sum() == 0:
+            # fewer distinct points than clusters
+            break
+        centroids.append(points[rng.choice(len(points), p=dist / dist.sum())])
+        dist = np.minimum(dist, ((points - centroids[-1]) ** 2).sum(axis=1))
+    centroids = np.array(centroids)
+
+    labels = None
+    for _ in range(max_iter):
+        dist = ((points[:, np.newaxis, :] -
+                 centroids[np.newaxis, :, :]) ** 2).sum(axis=2)
+        new_labels = dist.argmin(axis=1)
+        if labels is not None and np.array_equal(labels, new_labels):
+            break
+        labels = new_labels
+        counts = np.bincount(labels, minlength=len(centroids))
+        for axis in range(3):
+            sums = np.bincount(labels, weights=points[:, axis],
+                               minlength=len(centroids))
+            # empty clusters keep their centroid
+            centroids[counts > 0, axis] = sums[counts > 0] / counts[counts > 0]
+
+    counts = np.bincount(labels, minlength=len(centroids))
+    order = np.lexsort((centroids[:, 2], centroids[:, 1], centroids[:, 0],
+                        -counts))
+    keep = order[counts[order] > 0]
+    return(centroids[keep], counts[keep])
+
+
+def summarise_points(points, bounds):
+    """
+    Centroid, covariance and bounding box of consecutive groups of points,
+    group i is points[bounds[i]:bounds[i + 1]], groups must not be empty.
+    Return:
+        A dict of arrays, one row per group
+    """
+    counts = np.diff(bounds).astype(np.float64)[:, np.newaxis]
+    starts = bounds[:-1]
+    sums = np.add.reduceat(points, starts, axis=0)
+    outer = (points[:, :, np.newaxis] * points[:, np.newaxis, :])
+    outer_sums = np.add.reduceat(outer.reshape(-1, 9), starts, axis=0)
+    centroids = sums / counts
+    cov = (outer_sums.reshape(-1, 3, 3) -
+           counts[:, :, np.newaxis] *
+           centroids[:, :, np.newaxis] * centroids[:, np.newaxis, :])
+    cov = cov / np.maximum(counts - 1, 1)[:, :, np.newaxis]
+    return({'centroid': centroids,
+            'covariance': cov,
+            'min': np.minimum.reduceat(points, starts, axis=0),
+            'max': np.maximum.reduceat(points, starts, axis=0)})
+
+
+def make_summary(fiber_ends, tract_map, k=0):
+    """
+    Summarises the fiber end points of each tract.
+
+    Inputs:
+        k - number of k-means clusters of the starts and ends of each
+            tract, 0 to skip k-means
+    Return:
+        A dict {'units': 'voxels' or 'mm',
+                'n_fibers': number of fibers assigned to a tract,
+                'tracts': {tract_name: {'count': n,
+                                        'starts': stats, 'ends': stats}}}
+        stats - {'centroid', 'covariance', 'min', 'max' and with k > 0
+                 'clusters': [{'centroid', 'count'}]}
+    """
+    tract_ids, tract_names = map_clusters_to_tracts(fiber_ends['cluster_ids'],
+                                                    fiber_ends['cluster_names'],
+                                                    tract_map)
+    starts, ends = get_output_coords(fiber_ends)
+    keep = tract_ids >= 0
+    order = np.argsort(tract_ids[keep], kind='mergesort')
+    counts = np.bincount(tract_ids[keep], minlength=len(tract_names))
+    bounds = np.concatenate([[0], np.cumsum(counts)])
+    present = np.flatnonzero(counts)
+    # bounds of the non empty tracts only, reduceat can't handle empty groups
+    group_bounds = np.append(bounds[present], bounds[-1])
+
+    tracts = {tract: {'count': 0} for tract in tract_names}
+    for name, points in [('starts', starts), ('ends', ends)]:
+        points = np.asarray(points, dtype=np.float64)[keep][order]
+        if not len(present):
+            continue
+        stats = summarise_points(points, group_bounds)
+        for row, tract_id in enumerate(present):
+            tract = tracts[tract_names[tract_id]]
+            tract['count'] = int(counts[tract_id])
+            tract[name] = {key: val[row].tolist()
+                           for key, val in stats.items()}
+            if k > 0:
+                centroids, sizes = kmeans(
+                    points[bounds[tract_id]:bounds[tract_id + 1]], k)
+                tract[name]['clusters'] = [
+                    {'centroid': c.tolist(), 'count': int(n)}
+                    for c, n in zip(centroids, sizes)]
+
+    return({'units': 'mm' if fiber_ends['affine'] is None else 'voxels',
+            'n_fibers': int(counts.sum()),
+            'tracts': tracts})
+
+
+def write_summary(outfile, fiber_ends, tract_map, k=0):
+    """
+    Writes the summary of a subject to <output>_summary.json,
+    see make_summary
+    """
+    summary_file = os.path.splitext(outfile)[0] + '_summary.json'
+    with open(summary_file, 'w') as f:
+        json.dump(make_summary(fiber_ends, tract_map, k), f)
+    logger.info('Wrote summary:{}'.format(summary_file))
+
+
+def get_density_files(outfile):
+    """
+    The density maps of a subject are written next to its output
+    """
+    base = os.path.splitext(outfile)[0] + '_density'
+    return(base + '.nii.gz', base + '.json')
+
+
+def write_density_maps(outfile, fiber_ends, tract_map):
+    """
+    Writes the density maps of a subject as a 4D nifti, with a json
+    sidecar naming the tract and kind of each volume.
+    """
+    data, tract_names = make_density_maps(fiber_ends, tract_map)
+    nii_file, json_file = get_density_files(outfile)
+    nib.save(nib.Nifti1Image(data, fiber_ends['affine']), nii_file)
+
+    kinds = ['starts', 'ends', 'all']
+    sidecar = {'tracts': tract_names,
+               'kinds': kinds,
+               'volumes': [{'tract': tract, 'kind': kind}
+                           for kind in kinds for tract in tract_names],
+               'units': 'fiber end points per voxel'}
+    with open(json_file, 'w') as f:
+        json.dump(sidecar, f, indent=2)
+    logger.info('Wrote density maps:{}'.format(nii_file))
+
+
+def write_extra_outputs(outfile, fiber_ends, tract_map, density=False,
+                        summary=None):
+    """
+    Writes the optional outputs next to outfile.
+    density - write the density maps, see write_density_maps
+    summary - if not None, write the summary with this many k-means
+        clusters, see write_summary
+    """
+    if density:
+        write_density_maps(outfile, fiber_ends, tract_map)
+    if summary is not None:
+        write_summary(outfile, fiber_ends, tract_map, summary)
+
+
+def write_subject_output(outfile, fiber_ends, tract_map, density=False,
+                         summary=None, **meta):
+    """
+    Writes the json output of a subject and saves its fiber ends next to
+    it, so it can be relabelled without rerunning the pipeline.
+    density and summary select extra outputs, see write_extra_outputs.
+    Extra keyword arguments are stored with the fiber ends.
+    Returns the json output
+    """
+    result = tract_ends_to_json(fiber_ends_to_tracts(fiber_ends, tract_map))
+    with open(outfile, 'w+') as f:
+        f.writelines(result)
+    write_extra_outputs(outfile, fiber_ends, tract_map, density, summary)
+    save_fiber_ends(get_fiber_ends_file(outfile), fiber_ends,
+                    output=os.path.abspath(outfile), **meta)
+    return(result)
+
+
+def relabel_subject(ends_file, tract_map, output_dir=None, density=False,
+                    summary=None):
+    """
+    Regenerates the json output of a subject from its saved fiber ends
+    and a new tract_map. Overwrites the output recorded with the fiber ends,
+    or writes a file with the same name in output_dir.
+    density and summary select extra outputs, see write_extra_outputs.
+    Returns the path to the output
+    """
+    fiber_ends, meta = load_fiber_ends(ends_file)
+    outfile = meta['output']
+    if output_dir:
+        outfile = os.path.join(output_dir, os.path.basename(outfile))
+    result = tract_ends_to_json(fiber_ends_to_tracts(fiber_ends, tract_map))
+    with open(outfile, 'w+') as f:
+        f.writelines(result)
+    write_extra_outputs(outfile, fiber_ends, tract_map, density, summary)
+    return(outfile)
+
+
+def tract_ends_to_json(tract_ends):
+    """
+    Serialises the output of get_stream_ends,
+    converting from numpy arrays back to lists for json.dumps
+    """
+    return json.dumps({key: {'starts': np.asarray(val['starts']).tolist(),
+                             'ends': np.asarray(val['ends']).tolist()}
+                       for key, val in tract_ends.items()})
+
+
+def get_raw_atlas(atlas_file, output_dir):
+    """
+    Finds the most processed version of the unregistered atlas file,
+    in output_dir or next to atlas_file.
+    """
+    atlas_name = os.path.splitext(os.path.basename(atlas_file))[0]
+
+    atlas_raw = get_most_advanced_file(os.path.join(output_dir, atlas_name))
+    if not atlas_raw:
+        atlas_raw = get_most_advanced_file(atlas_file)
+    return(atlas_raw)
+
+
+def get_raw_atlas_trk(atlas_file, output_dir, anatFile=None):
+    """
+    Converts the unregistered atlas file to .trk in output_dir.
+
+    Checks to see how much processing has been performed on the atlas.
+    Return:
+        The path to the .trk file
+    """
+    return(convert_file_to_trk(get_raw_atlas(atlas_file, output_dir),
+                               anatFile=anatFile,
+                               outDir=output_dir))
+
+
+def sample_registered_atlas(atlas_reg, sampled):
+    """
+    Writes the sampled fibers of the registered atlas next to it, so only
+    they are converted and mapped.
+
+    Inputs:
+        atlas_reg - .vtk file written by the registration
+        sampled - labels['sampled'] from sample_atlas
+    Return:
+        The path to the sampled registered atlas
+    """
+    sample_file = '{}_sample_{}.vtk'.format(os.path.splitext(atlas_reg)[0],
+                                            sampled['key'])
+    if get_most_advanced_file(sample_file):
+        return(sample_file)
+
+    points, offsets = vtkio.read_polydata(atlas_reg)
+    if len(offsets) - 1 != sampled['n_atlas_fibers']:
+        msg = ('The registered atlas:{} has {} fibers, the atlas labels {}'
+               .format(atlas_reg, len(offsets) - 1,
+                       sampled['n_atlas_fibers']))
+        logger.error(msg)
+        sys.exit(msg)
+    vtkio.write_vtk(sample_file + '.partial',
+                    *take_streamlines(points, offsets, sampled['idx']))
+    os.rename(sample_file + '.partial', sample_file)
+    logger.info('Sampled {} of {} registered atlas fibers to:{}'
+                .format(len(sampled['idx']), sampled['n_atlas_fibers'],
+                        sample_file))
+    return(sample_file)
+
+
+def get_registered_atlas(atlas_file, subject_file, output_dir, sampled=None):
+    """
+    Registers the atlas file to subject space.
+
+    Checks to see if registration has already been performed.
+    sampled - if set, only these fibers of the registered atlas are kept,
+        see sample_atlas
+    Return:
+        The path to the most processed version of the registered atlas
+    """
+    atlas_name = os.path.splitext(os.path.basename(atlas_file))[0]
+
+    # check if registration has already been performed
+    atlas_reg = os.path.join(output_dir,
+                             '{}/output_tractography/{}_reg.vtk')
+
+    atlas_reg = atlas_reg.format(atlas_name, atlas_name)
+
+    if not os.path.isfile(atlas_reg):
+        # need to register atlas to subject space
+        register_tractography(atlas_file, subject_file, output_dir,
+                              workers=get_thread_count())
+    if sampled:
+        atlas_reg = sample_registered_atlas(atlas_reg, sampled)
+
+    # next check if the registered atlas has already been converted to .trk
+    return(get_most_advanced_file(atlas_reg))
+
+
+def get_registered_atlas_trk(atlas_file, subject_file, output_dir,
+                             anatFile=None, sampled=None):
+    """
+    Registers the atlas file to subject space and converts it to .trk.
+    sampled - see get_registered_atlas
+    Return:
+        The path to the registered .trk file
+    """
+    atlas_reg = get_registered_atlas(atlas_file, subject_file, output_dir,
+                                     sampled)
+    return(convert_file_to_trk(atlas_reg,
+                               anatFile=anatFile,
+                               outDir=os.path.dirname(atlas_reg)))
+
+
+def convert_raw_atlas(atlas_file, output_dir, anatFile=None):
+    """
+    Convert the unregistered atlas file to streamlines.
+    Return:
+        A list of streamlines from the unregistered atlas
+    """
+    return(get_streams_from_file(get_raw_atlas(atlas_file, output_dir),
+                                 anatFile=anatFile,
+                                 outDir=output_dir))
+
+
+def register_atlas(atlas_file, subject_file, output_dir, anatFile=None,
+                   sampled=None):
+    """
+    Register the atlas file to subject space and convert to streamlines.
+    sampled - see get_registered_atlas
+    Return:
+        A list of streamlines from the registered atlas
+    """
+    atlas_reg = get_registered_atlas(atlas_file, subject_file, output_dir,
+                                     sampled)
+    return(get_streams_from_file(atlas_reg,
+                                 anatFile=anatFile,
+                                 outDir=os.path.dirname(atlas_reg)))
+
+
+def process_atlas(atlas_file, subject_file, output_dir, anatFile=None):
+    """
+    Convert an atlas file to streamlines in subject space.
+
+    Checks to see how much processing has been performed on the atlas.
+    Inputs:
+        .vtp (or .vtk) atlas and subject files
+        output_dir - directory to create working files
+        anatFile - subject nifti file that was used for tractography
+            This can be left out if processing has already been done
+
+    Return:
+        Dict {'registered': A list of streamlines from the registered atlas,
+              'raw': Streamlines from the unregistered atlas.}
+    """
+    streams_raw = convert_raw_atlas(atlas_file, output_dir, anatFile)
+    streams_reg = register_atlas(atlas_file, subject_file,
+                                 output_dir, anatFile)
+    return {'registered': streams_reg,
+            'raw': streams_raw}
+
+
+def clean_working_dir(outputDir):
+    staging.discard(outputDir)
+
+
+def make_working_dirs(output_dir):
+    """
+    Creates output_dir and the clusters folder inside it.
+    Returns the path to the clusters folder.
+    """
+    if not os.path.isdir(output_dir):
+        os.mkdir(output_dir)
+
+    cluster_dir = os.path.join(output_dir, 'clusters')
+    if not os.path.isdir(cluster_dir):
+        os.mkdir(cluster_dir)
+    return(cluster_dir)
+
+
+def label_atlas(atlas_fibers, atlas_clusters, cluster_pattern,
+                mrml_map, subject_anat, output_dir):
+    """
+    Identifies the cluster of every fiber in the unregistered atlas.
+    Labels only depend on the atlas, so they can be shared between subjects.
+
+    Return:
+        A dict {'cluster_ids': np.int32 cluster of every atlas fiber,
+                'cluster_names': list of names indexed by cluster_ids,
+                'tract_map': cluster membership of each tract, see
+                    parse_mrml.MapTracts,
+                'match_distances': distance of every atlas fiber to its
+                    cluster streamline, see match_fibers_to_clusters}
+    """
+    cluster_dir = make_working_dirs(output_dir)
+
+    # convert clustered fibers in atlas space to identified streamlines
+    clusters = load_clusters(atlas_clusters,
+                             anatFile=subject_anat,
+                             pattern=cluster_pattern,
+                             outDir=cluster_dir,
+                             workers=get_thread_count())
+    profiling.checkpoint('load_clusters')
+    # get the mapping from cluster id to tract
+    tract_map = MapTracts(mrml_map)
+
+    # match the tracts identified in the unregistered atlas to
+    # fibers in the registered atlas
+    streams_raw = convert_raw_atlas(atlas_fibers, output_dir, subject_anat)
+    profiling.checkpoint('convert_raw_atlas')
+    cluster_ids, cluster_names, distances = match_fibers_to_clusters(
+        streams_raw, clusters, workers=get_thread_count(),
+        work_dir=output_dir)
+    profiling.checkpoint('match_fibers_to_clusters')
+    if MATCH_TOLERANCE is not None:
+        save_match_distances(output_dir, distances, cluster_ids)
+    return({'cluster_ids': cluster_ids,
+            'cluster_names': cluster_names,
+            'tract_map': tract_map.tract_map,
+            'match_distances': distances})
+
+
+def map_subject(atlas_fibers, subject_fibers, subject_anat, output_dir,
+                labels, export=None, fiber_filter=None):
+    """
+    Registers the atlas to a subject and collects the fiber end points.
+
+    Inputs:
+        labels - dict from label_atlas
+        export - if set, the registered streamlines are also added to this
+            StreamlineExportWriter
+        fiber_filter - if set, fibers failing filter_streams are removed
+            before their end points are collected
+    Return:
+        The fiber ends of the subject, see make_fiber_ends
+    """
+    make_working_dirs(output_dir)
+
+    # check to see if this atlas has already been registered, create if not.
+    streams_reg = register_atlas(atlas_fibers, subject_fibers,
+                                 output_dir, subject_anat,
+                                 labels.get('sampled'))
+    profiling.checkpoint('register_atlas')
+    if len(streams_reg) != len(labels['cluster_ids']):
+        msg = ('The registered atlas has {} fibers, the atlas labels {}'
+               .format(len(streams_reg), len(labels['cluster_ids'])))
+        logger.error(msg)
+        sys.exit(msg)
+    cluster_ids = labels['cluster_ids']
+    if fiber_filter is not None:
+        streams_reg, cluster_ids = filter_subject_streams(
+            streams_reg, cluster_ids, fiber_filter)
+    if export is not None:
+        export.add(streams_reg, cluster_ids)
+    starts, ends = get_stream_ends(streams_reg)
+    return(make_fiber_ends(starts, ends, cluster_ids,
+                           labels['cluster_names'], subject_anat))
+
+
+def index_atlas(atlas_fibers, atlas_clusters, cluster_pattern,
+                mrml_map, subject_anat, output_dir, chunk_fibers):
+    """
+    Streaming counterpart of label_atlas.
+    Converts the unregistered atlas to .trk, so it can be read lazily, and
+    indexes the cluster streamlines from the cluster cache, without holding
+    all the streamlines in memory.
+
+    Return:
+        A dict used by stream_subject
+        {'raw_trk': path to the unregistered atlas .trk,
+         'cluster_index': see build_cluster_index,
+         'cluster_names': list of cluster names,
+         'tract_map': see label_atlas,
+         'cluster_ids': cluster of every fiber, None until a subject
+            has been streamed,
+         'match_distances': see label_atlas, None until a subject
+            has been streamed}
+    """
+    cluster_dir = make_working_dirs(output_dir)
+
+    cache = get_cluster_cache(atlas_clusters,
+                              anatFile=subject_anat,
+                              pattern=cluster_pattern,
+                              outDir=cluster_dir,
+                              workers=get_thread_count())
+    try:
+        cluster_index = build_cluster_index(cache, chunk_fibers)
+    finally:
+        cache.close()
+    tract_map = MapTracts(mrml_map)
+
+    return({'raw_trk': get_raw_atlas_trk(atlas_fibers, output_dir,
+                                         subject_anat),
+            'cluster_index': cluster_index,
+            'cluster_names': cluster_index['cluster_names'],
+            'tract_map': tract_map.tract_map,
+            'cluster_ids': None,
+            'match_distances': None})
+
+
+def stream_subject(atlas_fibers, subject_fibers, subject_anat, output_dir,
+                   atlas, chunk_fibers, export=None, fiber_filter=None):
+    """
+    Streaming counterpart of map_subject.
+    The unregistered and registered atlases are read in lockstep,
+    chunk_fibers at a time, and only the fiber end points are kept.
+    The cluster ids found are stored in atlas['cluster_ids'] so later
+    subjects only need to read their registered atlas.
+
+    Inputs:
+        atlas - dict from index_atlas, or the labels of an atlas bundle
+        export, fiber_filter - see map_subject
+    Return:
+        The fiber ends of the subject, see make_fiber_ends
+    """
+    make_working_dirs(output_dir)
+    reg_trk = get_registered_atlas_trk(atlas_fibers, subject_fibers,
+                                       output_dir, subject_anat,
+                                       atlas.get('sampled'))
+
+    distances = None
+    if atlas['cluster_ids'] is None:
+        distances = []
+        label_chunks = iter_chunk_labels(atlas['raw_trk'],
+                                         atlas['cluster_index'],
+                                         chunk_fibers, distances)
+    else:
+        label_chunks = split_labels(atlas['cluster_ids'], chunk_fibers)
+
+    cluster_ids, starts, ends, keep = stream_ends(reg_trk, label_chunks,
+                                                  chunk_fibers, export,
+                                                  fiber_filter)
+    # the labels of every atlas fiber, whatever the filter removed
+    atlas['cluster_ids'] = cluster_ids
+    if distances is not None:
+        set_match_distances(atlas, distances, output_dir)
+    return(make_fiber_ends(starts[keep], ends[keep], cluster_ids[keep],
+                           atlas['cluster_names'], subject_anat))
+
+
+def set_match_distances(atlas, distances, output_dir):
+    """
+    Stores the match distances of a streamed atlas, collected chunk by
+    chunk by iter_chunk_labels, in atlas['match_distances']
+    """
+    atlas['match_distances'] = (np.concatenate(distances) if distances
+                                else np.zeros(0))
+    if MATCH_TOLERANCE is not None:
+        save_match_distances(output_dir, atlas['match_distances'],
+                             atlas['cluster_ids'])
+
+
+def load_bundle(bundle_file, output_dir):
+    """
+    Reads the atlas labels from an atlas bundle and writes the atlas
+    fibers to output_dir for registration.
+    Nothing needs converting or matching, the bundle already holds the
+    cluster of every fiber.
+
+    Return:
+        A tuple (atlas_file, labels), labels as returned by label_atlas
+    """
+    make_working_dirs(output_dir)
+    with AtlasBundle(bundle_file) as bundle:
+        atlas_file = os.path.join(output_dir, bundle.atlas_name + '.vtk')
+        if not os.path.isfile(atlas_file):
+            logger.info('Extracting atlas from bundle:{}'
+                        .format(bundle_file))
+            bundle.write_atlas_vtk(atlas_file)
+        labels = {'cluster_ids': bundle.cluster_ids(),
+                  'cluster_names': bundle.cluster_names,
+                  'tract_map': bundle.tract_map}
+    return(atlas_file, labels)
+
+
+def prepare_atlas(atlas_fibers, atlas_clusters, cluster_pattern, mrml_map,
+                  subject_anat, output_dir, chunk_fibers=None,
+                  bundle_file=None):
+    """
+    Does the subject independent work on the atlas.
+
+    Return:
+        A tuple (atlas_file, labels), labels is passed to process_subject,
+        labels['tract_map'] holds the tract definitions
+    """
+    if bundle_file:
+        atlas_fibers, labels = load_bundle(bundle_file, output_dir)
+    elif chunk_fibers:
+        labels = index_atlas(atlas_fibers, atlas_clusters, cluster_pattern,
+                             mrml_map, subject_anat, output_dir, chunk_fibers)
+    else:
+        labels = label_atlas(atlas_fibers, atlas_clusters, cluster_pattern,
+                             mrml_map, subject_anat, output_dir)
+    return(atlas_fibers, labels)
+
+
+def sample_fibers(tract_ids, n_tracts, fraction=None, max_per_tract=None,
+                  seed=0):
+    """
+    Picks a random, but repeatable, subset of the fibers of each tract.
+    Each tract keeps round(fraction * n) of its n fibers, at least one,
+    and at most max_per_tract. Fibers with tract id -1 are never picked.
+    Returns the sorted indices of the picked fibers
+    """
+    tract_ids = np.asarray(tract_ids)
+    counts = np.bincount(tract_ids[tract_ids >= 0], minlength=n_tracts)
+    keep = counts.copy()
+    if fraction is not None:
+        keep = np.maximum(np.round(counts * fraction), 1).astype(np.int64)
+    if max_per_tract is not None:
+        keep = np.minimum(keep, max_per_tract)
+
+    # a random key per fiber, each tract keeps its fibers with the
+    # smallest keys
+    keys = np.random.RandomState(seed).random_sample(len(tract_ids))
+    order = np.lexsort((keys, tract_ids))
+    sorted_ids = tract_ids[order]
+    first = np.searchsorted(sorted_ids, sorted_ids)
+    rank = np.arange(len(order)) - first
+    valid = sorted_ids >= 0
+    picked = np.zeros(len(order), dtype=bool)
+    picked[valid] = rank[valid] < keep[sorted_ids[valid]]
+    return(np.sort(order[picked]))
+
+
+def sample_atlas(atlas_fibers, labels, output_dir, sample, chunk_fibers=None):
+    """
+    Picks the sampled fibers of the atlas.
+    The whole atlas is still registered, so the transform doesn't depend on
+    the sample, only the sampled fibers of the registered atlas are
+    converted and mapped, see sample_registered_atlas.
+
+    Inputs:
+        atlas_fibers, labels - from prepare_atlas
+        sample - dict {'fraction', 'max_per_tract', 'seed'},
+            see sample_fibers
+    Return:
+        A tuple (atlas_file, labels) for the sampled atlas,
+        labels['sampled'] is a dict {'key': name of the sample,
+        'idx': sorted index of the sampled fibers,
+        'n_atlas_fibers': number of atlas fibers}
+    """
+    labels = dict(labels)
+    if labels['cluster_ids'] is None:
+        # streamed atlases are only labelled with the first subject
+        distances = []
+        labels['cluster_ids'] = np.concatenate(
+            list(iter_chunk_labels(labels['raw_trk'],
+                                   labels['cluster_index'],
+                                   chunk_fibers or 2 ** 16, distances)) or
+            [np.empty(0, np.int32)])
+        set_match_distances(labels, distances, output_dir)
+    cluster_ids = labels['cluster_ids']
+    cluster_to_tract, tract_names = make_cluster_to_tract(
+        labels['cluster_names'], labels['tract_map'])
+    idx = sample_fibers(cluster_to_tract.take(cluster_ids), len(tract_names),
+                        sample.get('fraction'), sample.get('max_per_tract'),
+                        sample.get('seed', 0))
+
+    # a different name for each sample, so the converted fibers of
+    # different samples are never mixed up
+    key = hashlib.sha1(json.dumps(sample, sort_keys=True)
+                       .encode('utf-8')).hexdigest()[:8]
+    logger.info('Sampled {} of {} atlas fibers'.format(len(idx),
+                                                       len(cluster_ids)))
+
+    labels['cluster_ids'] = cluster_ids[idx]
+    labels['sampled'] = {'key': key,
+                         'idx': idx,
+                         'n_atlas_fibers': len(cluster_ids)}
+    labels['sample'] = dict(sample, n_fibers=len(idx),
+                            n_atlas_fibers=len(cluster_ids))
+    return(atlas_fibers, labels)
+
+
+def process_subject(atlas_fibers, subject_fibers, subject_anat, output_dir,
+                    labels, chunk_fibers=None, export=None, fiber_filter=None):
+    """
+    Maps the atlas to a subject, using the labels from prepare_atlas
+    export - if set, a StreamlineExportWriter from open_streamline_export,
+        closed once the subject is done
+    fiber_filter - if set, thresholds from read_fiber_filter, fibers
+        outside them are removed
+    Returns the fiber ends of the subject, see make_fiber_ends
+    """
+    prepared = None
+    if fiber_filter:
+        prepared = prepare_fiber_filter(fiber_filter, labels)
+    try:
+        if chunk_fibers:
+            fiber_ends = stream_subject(atlas_fibers, subject_fibers,
+                                        subject_anat, output_dir, labels,
+                                        chunk_fibers, export, prepared)
+        else:
+            fiber_ends = map_subject(atlas_fibers, subject_fibers,
+                                     subject_anat, output_dir, labels, export,
+                                     prepared)
+    except BaseException:
+        if export is not None:
+            export.abort()
+        raise
+    if export is not None:
+        export.close()
+    fiber_ends['filtered'] = get_filter_counts(prepared)
+    if prepared is not None:
+        logger.info('Fiber filter removed {} fibers'
+                    .format(fiber_ends['filtered']['removed_total']))
+    return(fiber_ends)
+
+
+def main(atlas_fibers, atlas_clusters, cluster_pattern,
+         subject_fibers, mrml_map, subject_anat, output_dir,
+         cleanup, chunk_fibers=None, bundle_file=None, outfile=None,
+         density=False, summary=None, streamlines=None, sample=None,
+         fiber_filter=None):
+
+    atlas_fibers, labels = prepare_atlas(atlas_fibers, atlas_clusters,
+                                         cluster_pattern, mrml_map,
+                                         subject_anat, output_dir,
+                                         chunk_fibers, bundle_file)
+    if sample:
+        atlas_fibers, labels = sample_atlas(atlas_fibers, labels, output_dir,
+                                            sample, chunk_fibers)
+    profiling.checkpoint('prepare_atlas')
+    staging.sync()
+    export = None
+    if outfile:
+        export = open_streamline_export(outfile, labels, streamlines,
+                                        subject=subject_fibers,
+                                        anat=subject_anat)
+    fiber_ends = process_subject(atlas_fibers, subject_fibers, subject_anat,
+                                 output_dir, labels, chunk_fibers, export,
+                                 fiber_filter)
+    profiling.checkpoint('process_subject')
+    staging.sync()
+
+    if cleanup:
+        clean_working_dir(output_dir)
+
+    if outfile:
+        return(write_subject_output(outfile, fiber_ends, labels['tract_map'],
+                                    density=density, summary=summary,
+                                    subject=subject_fibers,
+                                    anat=subject_anat,
+                                    sample=labels.get('sample')))
+    return tract_ends_to_json(fiber_ends_to_tracts(fiber_ends,
+                                                   labels['tract_map']))
+
+
+def read_atlas_list(atlas_list):
+    """
+    Reads an --atlases file, one atlas per line with tab separated
+    <name> <atlas_file> <cluster_dir> <mrml_file> columns.
+    Blank lines and lines starting with # are ignored, relative paths are
+    interpreted relative to the file.
+    Returns a list of (name, atlas_file, cluster_dir, mrml_file) tuples
+    """
+    with open(atlas_list, 'r') as f:
+        lines = f.readlines()
+
+    base_dir = os.path.dirname(os.path.abspath(atlas_list))
+    atlases = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        fields = line.split('\t')
+        if len(fields) != 4:
+            msg = 'Invalid atlas line, expected 4 columns:{}'.format(line)
+            logger.error(msg)
+            sys.exit(msg)
+        name = fields[0]
+        paths = [os.path.join(base_dir, path) for path in fields[1:]]
+        atlases.append(tuple([name] + paths))
+
+    names = [atlas[0] for atlas in atlases]
+    if len(set(names)) != len(names):
+        msg = 'Atlas names must be unique:{}'.format(' '.join(names))
+        logger.error(msg)
+        sys.exit(msg)
+    return(atlases)
+
+
+def get_atlas_output(outfile, name):
+    """
+    The output of atlas name, with --atlases
+    """
+    base, ext = os.path.splitext(outfile)
+    return('{}_{}{}'.format(base, name, ext))
+
+
+def main_atlases(atlases, cluster_pattern, subject_fibers, subject_anat,
+                 output_dir, cleanup, outfile, chunk_fibers=None,
+                 density=False, summary=None, streamlines=None, sample=None,
+                 fiber_filter=None):
+    """
+    Maps several atlases to one subject.
+    Atlases are processed at the same time in their own subdirectory of
+    output_dir, up to THREADS at once with the cores split between them.
+    Each atlas thread sees its share through get_thread_count, THREADS and
+    the environment are left alone while the atlases run.
+    A failing atlas is logged and the remaining atlases are processed.
+
+    Inputs:
+        atlases - list of (name, atlas_file, cluster_dir, mrml_file) tuples
+        outfile - each atlas is written to get_atlas_output(outfile, name)
+        other inputs are passed to main for each atlas
+    Return:
+        A list of the names of the atlases that failed
+    """
+    if not os.path.isdir(output_dir):
+        os.mkdir(output_dir)
+
+    if subject_anat:
+        # read once, shared by all the atlases
+        read_anat_header(subject_anat)
+
+    parallel = max(min(len(atlases), THREADS), 1)
+    share = max(THREADS // parallel, 1)
+
+    def run(atlas):
+        name, atlas_fibers, atlas_clusters, mrml_map = atlas
+        _thread_state.threads = share
+        logger.info('Mapping atlas:{}'.format(name))
+        start_time = time.time()
+        status = 'ok'
+        try:
+            main(atlas_fibers, atlas_clusters, cluster_pattern,
+                 subject_fibers, mrml_map, subject_anat,
+                 os.path.join(output_dir, name), cleanup, chunk_fibers,
+                 None, get_atlas_output(outfile, name), density, summary,
+                 streamlines, sample, fiber_filter)
+        except (Exception, SystemExit):
+            logger.exception('Atlas:{} failed'.format(name))
+            status = 'failed'
+        progress.emit_event('atlas', atlas=name, subject=subject_fibers,
+                            status=status,
+                            seconds=round(time.time() - start_time, 3))
+        return(status)
+
+    pool = ThreadPool(parallel)
+    try:
+        statuses = pool.map(run, atlases)
+    finally:
+        pool.close()
+        pool.join()
+
+    return([atlas[0] for atlas, status in zip(atlases, statuses)
+            if status != 'ok'])
+
+
+def record_timing(timings_file, subject_file, seconds, status):
+    """
+    Appends a <subjectFile> <size in bytes> <seconds> <status> line to
+    timings_file, these are used by dm-launch-tractmap.py to estimate
+    the cost of future runs.
+    """
+    try:
+        size = os.path.getsize(subject_file)
+    except OSError:
+        size = 0
+    line = '\t'.join([subject_file, str(size),
+                      '{:.1f}'.format(seconds), status])
+    try:
+        with open(timings_file, 'a') as f:
+            f.write(line + '\n')
+    except IOError as e:
+        logger.warning('Failed to record timing in:{}. {}'
+                       .format(timings_file, str(e)))
+
+
+def get_profile_prefix(outfile, batch=None):
+    """
+    Profiles are written next to the output, in batch mode next to
+    the output of the first subject.
+    """
+    if batch:
+        return(os.path.splitext(batch[0][2])[0] + '_batch')
+    if outfile:
+        return(os.path.splitext(outfile)[0])
+    return(os.path.abspath('tractmap'))
+
+
+def read_batch_file(batch_file):
+    """
+    Reads a batch file, one subject per line with tab separated
+    <subjectFile> <anatFile> <output> columns.
+    Blank lines and lines starting with # are ignored.
+    '-' reads the batch from stdin.
+    Returns a list of (subjectFile, anatFile, output) tuples
+    """
+    if batch_file == '-':
+        lines = sys.stdin.readlines()
+    else:
+        with open(batch_file, 'r') as f:
+            lines = f.readlines()
+
+    batch = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        fields = line.split('\t')
+        if len(fields) != 3:
+            msg = 'Invalid batch line, expected 3 columns:{}'.format(line)
+            logger.error(msg)
+            sys.exit(msg)
+        batch.append(tuple(fields))
+    return(batch)
+
+
+def check_cluster_dir(cluster_dir, pattern=None):
+    """
+    Preflight check of an atlas cluster folder
+    """
+    problems = preflight.check_dir(cluster_dir, 'cluster folder')
+    if not problems and not find_cluster_files(cluster_dir, pattern):
+        problems.append('No cluster files matching:{} in:{}'
+                        .format(pattern, cluster_dir))
+    return(problems)
+
+
+def check_mirtk():
+    """
+    Preflight check of the MIRTK container used to convert .vtp files
+    """
+    return(preflight.check_executable('singularity') +
+           preflight.check_file(CONTAINER_FILE, 'MIRTK container'))
+
+
+def get_preflight_checks(atlases, subjects, cluster_pattern,
+                         chunk_fibers=None, bundle_file=None, outputs=(),
+                         folders=()):
+    """
+    Lists the checks run before any expensive stage, see preflight.py
+
+    Inputs:
+        atlases - list of (atlas_file, cluster_dir, mrml_file) tuples,
+            ignored with bundle_file
+        subjects - list of (subject_file, anat_file) tuples, anat_file
+            may be None
+        outputs - files the run writes, their folders must be writable
+        folders - folders the run writes to
+    Returns a list of (function, args) checks
+    """
+    checks = [(preflight.check_executable, ['wm_register_to_atlas_new.py'])]
+    # .trk files are only written when streaming or keeping intermediates
+    to_trk = KEEP_INTERMEDIATES or chunk_fibers
+    if to_trk:
+        checks.append((preflight.check_executable, ['TractConverter.py']))
+
+    if bundle_file:
+        checks.append((preflight.check_file, [bundle_file, 'atlas bundle']))
+        atlases = []
+    for atlas_file, cluster_dir, mrml_file in atlases:
+        checks.append((preflight.check_file, [atlas_file, 'atlas file']))
+        checks.append((check_cluster_dir, [cluster_dir, cluster_pattern]))
+        checks.append((preflight.check_file, [mrml_file, 'mrml file']))
+    if to_trk and (KEEP_INTERMEDIATES or
+                   any(atlas[0].endswith('.vtp') for atlas in atlases)):
+        checks.append((check_mirtk, []))
+    if MATCH_TOLERANCE is not None and atlases:
+        checks.append((preflight.check_module,
+                       ['scipy.spatial', '--match-tolerance']))
+
+    for subject_file, anat_file in subjects:
+        checks.append((preflight.check_file, [subject_file, 'subject file']))
+        if anat_file:
+            checks.append((preflight.check_nifti, [anat_file, 'anat file']))
+        elif to_trk:
+            # converting to .trk needs the anat header
+            checks.append((preflight.check_file,
+                           [None, 'anat file for:{}'.format(subject_file)]))
+
+    for output in outputs:
+        if output:
+            checks.append((preflight.check_writable,
+                           [os.path.dirname(os.path.abspath(output)),
+                            'output folder']))
+    for folder in folders:
+        if folder:
+            checks.append((preflight.check_writable, [folder, 'folder']))
+    return(checks)
+
+
+def main_batch(atlas_fibers, atlas_clusters, cluster_pattern,
+               mrml_map, batch, output_dir, cleanup, timings_file=None,
+               chunk_fibers=None, bundle_file=None, density=False,
+               summary=None, streamlines=None, sample=None, fiber_filter=None):
+    """
+    Processes several subjects in one process.
+    The atlas labels are calculated once and shared, each subject is
+    registered in its own subdirectory of output_dir.
+    A failing subject is logged and the remaining subjects are processed.
+
+    Inputs:
+        batch - list of (subjectFile, anatFile, output) tuples
+        timings_file - if set, the run time of each subject is recorded here
+        chunk_fibers - if set, the atlases are streamed in chunks of
+            this many fibers
+        bundle_file - if set, the atlas is read from this atlas bundle
+        density, summary - extra outputs for each subject, see
+            write_extra_outputs
+        streamlines - if set, export the streamlines of each subject
+            with this step, see open_streamline_export
+        sample - if set, only map a sample of the atlas fibers,
+            see sample_atlas
+        fiber_filter - if set, remove the fibers outside these thresholds,
+            see read_fiber_filter
+    Return:
+        A list of the subject files that failed
+    """
+    if not os.path.isdir(output_dir):
+        os.mkdir(output_dir)
+
+    labels = None
+    atlas_file = atlas_fibers
+    failed = []
+    for i, (subject_fibers, subject_anat, outfile) in enumerate(batch):
+        logger.info('Processing subject {} / {}:{}'
+                    .format(i + 1, len(batch), subject_fibers))
+        subject_dir = os.path.join(output_dir, 'subject_{:04d}'.format(i))
+        start_time = time.time()
+        status = 'ok'
+        try:
+            if labels is None:
+                # needs an anat file, so is done with the first
+                # subject that can provide one
+                atlas_file, labels = prepare_atlas(
+                    atlas_fibers, atlas_clusters, cluster_pattern, mrml_map,
+                    subject_anat, os.path.join(output_dir, 'atlas'),
+                    chunk_fibers, bundle_file)
+                if sample:
+                    atlas_file, labels = sample_atlas(
+                        atlas_file, labels, os.path.join(output_dir, 'atlas'),
+                        sample, chunk_fibers)
+                profiling.checkpoint('prepare_atlas')
+                staging.sync()
+
+            export = open_streamline_export(outfile, labels, streamlines,
+                                            subject=subject_fibers,
+                                            anat=subject_anat)
+            fiber_ends = process_subject(atlas_file, subject_fibers,
+                                         subject_anat, subject_dir, labels,
+                                         chunk_fibers, export, fiber_filter)
+            write_subject_output(outfile, fiber_ends, labels['tract_map'],
+                                 density=density, summary=summary,
+                                 subject=subject_fibers, anat=subject_anat,
+                                 sample=labels.get('sample'))
+            profiling.checkpoint('subject_{:04d}'.format(i))
+            staging.sync()
+        except (Exception, SystemExit):
+            logger.exception('Subject:{} failed'.format(subject_fibers))
+            failed.append(subject_fibers)
+            status = 'failed'
+
+        seconds = time.time() - start_time
+        if timings_file:
+            record_timing(timings_file, subject_fibers, seconds, status)
+        progress.emit_event('subject', subject=subject_fibers,
+                            index=i + 1, total=len(batch), status=status,
+                            seconds=round(seconds, 3))
+
+        if cleanup and os.path.isdir(subject_dir):
+            clean_working_dir(subject_dir)
+
+    atlas_dir = os.path.join(output_dir, 'atlas')
+    if cleanup and os.path.isdir(atlas_dir):
+        clean_working_dir(atlas_dir)
+
+    return(failed)
+
+
+if __name__ == "__main__":
+    arguments = docopt(__doc__)
+    atlasFile = arguments['--atlas_file']
+    clusterDir = arguments['--cluster_dir']
+    mrmlFile = arguments['--mrml_file']
+    subjectFile = arguments['<subjectFile>']
+    workingDir = arguments['--work_dir']
+    anatFile = arguments['<anatFile>']
+    outfile = arguments['--output']
+    batchFile = arguments['--batch']
+    atlasList = arguments['--atlases']
+    timingsFile = arguments['--timings']
+    chunkFibers = arguments['--chunk-fibers']
+    bundleFile = arguments['--bundle']
+    density = arguments['--density']
+    summary = None
+    if arguments['--summary']:
+        try:
+            summary = int(arguments['--summary-k'])
+            assert summary >= 0
+        except (ValueError, AssertionError):
+            msg = 'Invalid --summary-k:{}'.format(arguments['--summary-k'])
+            logger.error(msg)
+            sys.exit(msg)
+    streamlines = None
+    if arguments['--streamlines']:
+        try:
+            streamlines = float(arguments['--streamline-step'])
+            assert streamlines > 0
+        except (ValueError, AssertionError):
+            msg = 'Invalid --streamline-step:{}'.format(
+                arguments['--streamline-step'])
+            logger.error(msg)
+            sys.exit(msg)
+
+    sample = {}
+    try:
+        if arguments['--sample-fraction']:
+            sample['fraction'] = float(arguments['--sample-fraction'])
+            assert 0 < sample['fraction'] <= 1
+        if arguments['--max-fibers-per-tract']:
+            sample['max_per_tract'] = int(arguments['--max-fibers-per-tract'])
+            assert sample['max_per_tract'] > 0
+        if sample:
+            sample['seed'] = int(arguments['--seed'])
+    except (ValueError, AssertionError):
+        msg = 'Invalid --sample-fraction, --max-fibers-per-tract or --seed'
+        logger.error(msg)
+        sys.exit(msg)
+
+    thresholds = {}
+    try:
+        for key in FIBER_FILTER_UNSET:
+            value = arguments['--' + key.replace('_', '-')]
+            thresholds[key] = None if value is None else float(value)
+            assert thresholds[key] is None or thresholds[key] >= 0
+    except (ValueError, AssertionError):
+        msg = 'Invalid --{}:{}'.format(key.replace('_', '-'), value)
+        logger.error(msg)
+        sys.exit(msg)
+    fiberFilter = read_fiber_filter(arguments['--fiber-filter'], **thresholds)
+
+    if arguments['--subject-fibers']:
+        try:
+            SUBJECT_SAMPLE = {
+                'n_fibers': int(arguments['--subject-fibers']),
+                'min_length': float(arguments['--subject-min-length']),
+                'seed': int(arguments['--seed'])}
+            assert SUBJECT_SAMPLE['n_fibers'] > 0
+        except (ValueError, AssertionError):
+            msg = 'Invalid --subject-fibers, --subject-min-length or --seed'
+            logger.error(msg)
+            sys.exit(msg)
+
+    if arguments['--match-tolerance'] is not None:
+        try:
+            MATCH_TOLERANCE = float(arguments['--match-tolerance'])
+            MATCH_POINTS = int(arguments['--match-points'])
+            assert MATCH_TOLERANCE >= 0 and MATCH_POINTS >= 2
+        except (ValueError, AssertionError):
+            msg = 'Invalid --match-tolerance or --match-points'
+            logger.error(msg)
+            sys.exit(msg)
+
+    CONTAINER_FILE = arguments['--mirtk_file']
+    KEEP_INTERMEDIATES = arguments['--keep-intermediates']
+
+    pattern = arguments['--cluster-pattern']
+
+    if chunkFibers:
+        try:
+            chunkFibers = int(chunkFibers)
+            assert chunkFibers > 0
+        except (ValueError, AssertionError):
+            msg = 'Invalid --chunk-fibers:{}'.format(chunkFibers)
+            logger.error(msg)
+            sys.exit(msg)
+
+    threads = arguments['--threads'] or os.environ.get('NSLOTS', 1)
+    try:
+        set_thread_count(threads)
+    except ValueError:
+        msg = 'Invalid --threads:{}'.format(threads)
+        logger.error(msg)
+        sys.exit(msg)
+
+    if arguments['--cleanup']:
+        cleanup = True
+    else:
+        cleanup = False
+
+    if arguments['--debug']:
+        logger.setLevel(logging.DEBUG)
+    elif arguments['--quiet']:
+        logger.setLevel(logging.ERROR)
+    else:
+        logger.setLevel(logging.INFO)
+    progress.logger.setLevel(logger.level)
+    profiling.logger.setLevel(logger.level)
+    staging.logger.setLevel(logger.level)
+    preflight.logger.setLevel(logger.level)
+    progress.set_event_file(arguments['--progress-events'])
+
+    script_dir = os.path.dirname(__file__)
+    if not os.path.isabs(atlasFile):
+        atlasFile = os.path.abspath(os.path.join(script_dir, atlasFile))
+    if not os.path.isabs(clusterDir):
+        clusterDir = os.path.abspath(os.path.join(script_dir, clusterDir))
+    if not os.path.isabs(mrmlFile):
+        mrmlFile = os.path.abspath(os.path.join(script_dir, mrmlFile))
+
+    batch = None
+    atlases = None
+    if batchFile:
+        if atlasList:
+            msg = '--atlases can not be used with --batch'
+            logger.error(msg)
+            sys.exit(msg)
+        batch = read_batch_file(batchFile)
+    elif atlasList and not outfile:
+        msg = '--atlases needs --output'
+        logger.error(msg)
+        sys.exit(msg)
+    elif atlasList and bundleFile:
+        msg = '--atlases can not be used with --bundle'
+        logger.error(msg)
+        sys.exit(msg)
+    elif density and not (outfile and anatFile):
+        msg = '--density needs <anatFile> and --output'
+        logger.error(msg)
+        sys.exit(msg)
+    elif summary is not None and not outfile:
+        msg = '--summary needs --output'
+        logger.error(msg)
+        sys.exit(msg)
+    elif streamlines is not None and not outfile:
+        msg = '--streamlines needs --output'
+        logger.error(msg)
+        sys.exit(msg)
+
+    if arguments['--profile']:
+        profiler = profiling.Profiler(get_profile_prefix(outfile, batch),
+                                      trace_memory=arguments[
+                                          '--profile-memory'])
+        profiler.start()
+        # also write the profile when the run fails or calls sys.exit
+        atexit.register(profiler.stop)
+
+    if atlasList:
+        atlases = read_atlas_list(atlasList)
+
+    if atlases:
+        checked_atlases = [atlas[1:] for atlas in atlases]
+        outputs = [get_atlas_output(outfile, atlas[0]) for atlas in atlases]
+    else:
+        checked_atlases = [(atlasFile, clusterDir, mrmlFile)]
+        outputs = [outfile]
+    if batch:
+        subjects = [(subject, anat) for subject, anat, _ in batch]
+        outputs = [output for _, _, output in batch]
+    else:
+        subjects = [(subjectFile, anatFile)]
+    outputs += [timingsFile, arguments['--progress-events']]
+    problems = preflight.check_all(get_preflight_checks(
+        checked_atlases, subjects, pattern, chunkFibers, bundleFile, outputs,
+        [workingDir, arguments['--scratch'], arguments['--subject-cache']]))
+    if problems:
+        preflight.fail(problems)
+    if arguments['--check-only']:
+        print('Preflight checks passed')
+        sys.exit(0)
+
+    if arguments['--scratch']:
+        keep = []
+        if not cleanup:
+            keep = [p for p in arguments['--stage-keep'].split(',') if p]
+        stage = staging.Stage(arguments['--scratch'], workingDir, keep)
+        stage.start()
+        # also copies back and cleans up when the run fails or calls sys.exit
+        atexit.register(stage.close)
+        if not workingDir:
+            # like a temporary work dir, free scratch as subjects finish
+            cleanup = True
+        workingDir = stage.work_path
+
+    SUBJECT_CACHE_DIR = arguments['--subject-cache']
+    if not SUBJECT_CACHE_DIR and workingDir:
+        SUBJECT_CACHE_DIR = os.path.join(workingDir, 'subject_cache')
+
+    if atlases:
+        if workingDir:
+            failed = main_atlases(atlases, pattern, subjectFile, anatFile,
+                                  workingDir, cleanup, outfile, chunkFibers,
+                                  density, summary, streamlines, sample,
+                                  fiberFilter)
+        else:
+            with tempdir.TempDir(prefix="tractmap_") as workingDir:
+                failed = main_atlases(atlases, pattern, subjectFile,
+                                      anatFile, workingDir, True, outfile,
+                                      chunkFibers, density, summary,
+                                      streamlines, sample, fiberFilter)
+        if failed:
+            msg = '{} of {} atlases failed:{}'.format(len(failed),
+                                                      len(atlases),
+                                                      ' : '.join(failed))
+            logger.error(msg)
+            sys.exit(msg)
+        sys.exit(0)
+
+    if batchFile:
+        if workingDir:
+            failed = main_batch(atlasFile, clusterDir, pattern, mrmlFile,
+                                batch, workingDir, cleanup, timingsFile,
+                                chunkFibers, bundleFile, density,
+                                summary, streamlines, sample, fiberFilter)
+        else:
+            with tempdir.TempDir(prefix="tractmap_") as workingDir:
+                failed = main_batch(atlasFile, clusterDir, pattern, mrmlFile,
+                                    batch, workingDir, True, timingsFile,
+                                    chunkFibers, bundleFile, density,
+                                    summary, streamlines, sample,
+                                    fiberFilter)
+        if failed:
+            msg = '{} of {} subjects failed:{}'.format(len(failed),
+                                                       len(batch),
+                                                       ' : '.join(failed))
+            logger.error(msg)
+            sys.exit(msg)
+        sys.exit(0)
+
+    start_time = time.time()
+    if workingDir:
+        ends = main(atlasFile,
+                    clusterDir,
+                    pattern,
+                    subjectFile,
+                    mrmlFile,
+                    anatFile,
+                    workingDir,
+                    cleanup,
+                    chunkFibers,
+                    bundleFile,
+                    outfile,
+                    density,
+                    summary,
+                    streamlines,
+                    sample,
+                    fiberFilter)
+    else:
+        with tempdir.TempDir(prefix="tractmap_") as workingDir:
+            ends = main(atlasFile,
+                        clusterDir,
+                        pattern,
+                        subjectFile,
+                        mrmlFile,
+                        anatFile,
+                        workingDir,
+                        cleanup,
+                        chunkFibers,
+                        bundleFile,
+                        outfile,
+                        density,
+                        summary,
+                        streamlines,
+                        sample,
+                        fiberFilter)
+
+    seconds = time.time() - start_time
+    if timingsFile:
+        record_timing(timingsFile, subjectFile, seconds, 'ok')
+    progress.emit_event('subject', subject=subjectFile, index=1, total=1,
+                        status='ok', seconds=round(seconds, 3))
+
+    if not outfile:
         print(ends)
@@ -28,7 +28,7 @@ class MapTracts(object):
     def __init__(self, fname):
         root = self.load_mrml(fname)
         tracts = self.find_tract_names(root)
-        for tract_name, tract_id in tracts.iteritems():
+        for tract_name, tract_id in tracts.items():
             clusters = self.find_clusters(tract_id, root)
             tracts[tract_name] = clusters
 
@@ -84,10 +84,10 @@ def main():
     if args['--verbose']:
         logger.setLevel(logging.DEBUG)
 
-    tract_map = tractmap(args['<filename>'])
+    tract_map = MapTracts(args['<filename>'])
 
     return(json.dumps(tract_map.tract_map))
 
 
 if __name__ == '__main__':
-    print main()
+    print(main())
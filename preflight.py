@@ -0,0 +1,166 @@
+"""
+Fail fast checks of the external tools and inputs of the pipeline.
+
+Registration and conversion take a long time, a missing tool or an
+unreadable input found after them wastes all that compute. The checks here
+only look at the PATH, file system metadata and file headers, so they run
+in well under a second, and are run in parallel threads.
+
+Every check returns a list of problems, an empty list if all is well, so
+all the problems are reported together:
+    problems = check_all([(check_executable, ['TractConverter.py']),
+                          (check_nifti, [anat_file, 'anat file'])])
+    if problems:
+        fail(problems)
+"""
+import importlib
+import logging
+import os
+import sys
+from multiprocessing.pool import ThreadPool
+import nibabel as nib
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+
+logger = logging.getLogger(__name__)
+
+# threads running the checks, most of the time is spent waiting on
+# the file system
+WORKERS = 16
+
+
+def _title(what):
+    return(what[:1].upper() + what[1:])
+
+
+def check_executable(name):
+    """
+    Checks that name is an executable on the PATH
+    """
+    if which(name):
+        return([])
+    return(['Command:{} not found on the PATH. Did you load the required '
+            'modules?'.format(name)])
+
+
+def check_module(name, needed_by):
+    """
+    Checks that the optional python module name can be imported
+    """
+    try:
+        importlib.import_module(name)
+    except ImportError:
+        return(['Python module:{} not found, it is needed by {}'
+                .format(name, needed_by)])
+    return([])
+
+
+def check_file(path, what='file'):
+    """
+    Checks that path is a readable file
+    """
+    if not path:
+        return(['No {} given'.format(what)])
+    if not os.path.isfile(path):
+        return(['{}:{} not found'.format(_title(what), path)])
+    if not os.access(path, os.R_OK):
+        return(['{}:{} is not readable'.format(_title(what), path)])
+    return([])
+
+
+def check_dir(path, what='folder'):
+    """
+    Checks that path is a readable folder
+    """
+    if not path:
+        return(['No {} given'.format(what)])
+    if not os.path.isdir(path):
+        return(['{}:{} not found'.format(_title(what), path)])
+    if not os.access(path, os.R_OK | os.X_OK):
+        return(['{}:{} is not readable'.format(_title(what), path)])
+    return([])
+
+
+def check_writable(path, what='folder'):
+    """
+    Checks that files can be created in the folder path, or that it can
+    be created if it doesn't exist yet
+    """
+    path = os.path.abspath(path)
+    existing = path
+    while not os.path.exists(existing):
+        existing = os.path.dirname(existing)
+    if not os.path.isdir(existing):
+        return(['{}:{} is not a folder'.format(_title(what), existing)])
+    if not os.access(existing, os.W_OK | os.X_OK):
+        return(['{}:{} is not writable'.format(_title(what), existing)])
+    return([])
+
+
+def check_nifti(path, what='anat file'):
+    """
+    Checks that path is a nifti file with a readable header
+    """
+    problems = check_file(path, what)
+    if problems:
+        return(problems)
+    # nibabel only reads the header until the data is used
+    try:
+        shape = nib.load(path).shape
+    except Exception as e:
+        return(['Failed to read the header of {}:{}. {}'
+                .format(what, path, str(e))])
+    if len(shape) < 3:
+        return(['{}:{} is not a 3D volume'.format(_title(what), path)])
+    return([])
+
+
+def _run(check):
+    func, args = check
+    try:
+        return(func(*args))
+    except Exception as e:
+        return(['Check {}{} failed. {}'.format(func.__name__, tuple(args),
+                                               str(e))])
+
+
+def run_checks(checks, workers=WORKERS):
+    """
+    Runs checks in parallel threads
+    Inputs:
+        checks - list of (function, args) tuples, each function returns a
+            list of problems
+    Returns a list with the problems of each check
+    """
+    if not checks:
+        return([])
+    pool = ThreadPool(max(min(workers, len(checks)), 1))
+    try:
+        return(pool.map(_run, checks))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def check_all(checks, workers=WORKERS):
+    """
+    Runs checks in parallel threads
+    Returns a list of all the problems, each one only once
+    """
+    problems = []
+    for result in run_checks(checks, workers):
+        problems.extend(p for p in result if p not in problems)
+    return(problems)
+
+
+def fail(problems):
+    """
+    Logs every problem and exits
+    """
+    for problem in problems:
+        logger.error(problem)
+    msg = 'Preflight checks failed with {} problems'.format(len(problems))
+    logger.error(msg)
+    sys.exit(msg)
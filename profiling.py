@@ -0,0 +1,157 @@
+"""
+Profiling hooks for the pipeline.
+
+While a Profiler is active the code runs under cProfile and a background
+thread samples the stacks of all threads, writing
+    <prefix>.prof - cProfile stats, open with pstats or snakeviz
+    <prefix>.stacks.txt - collapsed stacks, one 'frame;frame;... count'
+        line per stack, the input format of flamegraph.pl and speedscope
+    <prefix>.memory.txt - with trace_memory, tracemalloc usage and the top
+        allocation sites at each checkpoint
+
+Stage boundaries in the pipeline call checkpoint(name), which emits a
+'checkpoint' progress event, see progress.py, and records memory use if a
+Profiler tracing memory is active.
+cProfile only sees the main thread, the stack samples cover all threads of
+this process. Worker processes are not profiled.
+"""
+import cProfile
+import logging
+import os
+import sys
+import threading
+import time
+import progress
+try:
+    import tracemalloc
+except ImportError:
+    # python 2
+    tracemalloc = None
+
+logger = logging.getLogger(__name__)
+
+# the active Profiler, used by checkpoint
+_ACTIVE = None
+
+
+def checkpoint(name):
+    """
+    Marks a stage boundary, records memory use if memory is being traced
+    """
+    progress.emit_event('checkpoint', name=name)
+    if _ACTIVE is not None:
+        _ACTIVE.checkpoint(name)
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    module = os.path.splitext(os.path.basename(code.co_filename))[0]
+    return('{}:{}'.format(module, code.co_name))
+
+
+class Profiler(object):
+    """
+    Profiles the code run inside the with block.
+
+        with Profiler('/path/to/output', trace_memory=True):
+            main(...)
+    """
+    def __init__(self, prefix, interval=0.005, trace_memory=False):
+        self.prefix = prefix
+        self.interval = interval
+        self.trace_memory = trace_memory
+        self.stacks = {}
+        self.memory = []
+        self._profile = cProfile.Profile()
+        self._stop = threading.Event()
+        self._sampler = None
+        self._enabled = False
+
+        if trace_memory and tracemalloc is None:
+            logger.warning('tracemalloc needs python 3, '
+                           'memory will not be traced')
+            self.trace_memory = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *errstuff):
+        self.stop()
+
+    def start(self):
+        global _ACTIVE
+        _ACTIVE = self
+        if self.trace_memory:
+            tracemalloc.start()
+            self.checkpoint('start')
+        self._sampler = threading.Thread(target=self._sample,
+                                         name='profiling-sampler')
+        self._sampler.daemon = True
+        self._sampler.start()
+        self._profile.enable()
+        self._enabled = True
+
+    def stop(self):
+        global _ACTIVE
+        if _ACTIVE is not self:
+            # already stopped
+            return
+        self._profile.disable()
+        self._enabled = False
+        self._stop.set()
+        self._sampler.join()
+        if self.trace_memory:
+            self.checkpoint('end')
+            tracemalloc.stop()
+        _ACTIVE = None
+        self.write()
+
+    def checkpoint(self, name):
+        if not self.trace_memory:
+            return
+        # snapshots are slow, keep them out of the cProfile stats
+        if self._enabled:
+            self._profile.disable()
+        current, peak = tracemalloc.get_traced_memory()
+        top = tracemalloc.take_snapshot().statistics('lineno')[:10]
+        self.memory.append((name, time.time(), current, peak, top))
+        # so the next peak belongs to the next stage
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        if self._enabled:
+            self._profile.enable()
+
+    def _sample(self):
+        own_id = threading.current_thread().ident
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                key = ';'.join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def write(self):
+        self._profile.dump_stats(self.prefix + '.prof')
+        with open(self.prefix + '.stacks.txt', 'w') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write('{} {}\n'.format(stack, count))
+        outputs = [self.prefix + '.prof', self.prefix + '.stacks.txt']
+
+        if self.memory:
+            with open(self.prefix + '.memory.txt', 'w') as f:
+                start = self.memory[0][1]
+                for name, when, current, peak, top in self.memory:
+                    f.write('{} +{:.1f}s current {:.1f} MB peak {:.1f} MB\n'
+                            .format(name, when - start, current / 2.0 ** 20,
+                                    peak / 2.0 ** 20))
+                    for stat in top:
+                        f.write('    {}\n'.format(stat))
+            outputs.append(self.prefix + '.memory.txt')
+        logger.info('Wrote profile to:{}'.format(', '.join(outputs)))
@@ -0,0 +1,129 @@
+"""
+Rate limited progress reporting.
+
+Long running stages report how much of their work is done. At most once
+every LOG_INTERVAL seconds a stage logs its throughput and an estimate of
+the time left, so the logs don't grow with the size of the atlas. Messages
+are logged at INFO, --quiet silences them.
+
+If an event file is set with set_event_file every report, and the start
+and end of each stage, is also appended to it as a json line, for the
+launcher to follow:
+    {"time": unix time, "event": "start" | "progress" | "end",
+     "stage": str, "done": n, "total": n or null, "unit": str,
+     "rate": units per second, "eta": seconds or null}
+The pipeline also emits 'checkpoint' events at stage boundaries, and
+'subject' and 'atlas' events as each one finishes, see emit_event.
+"""
+import datetime
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# minimum number of seconds between two reports of a stage
+LOG_INTERVAL = 10.0
+
+# json lines file receiving the progress events, see set_event_file
+EVENT_FILE = None
+
+_event_lock = threading.Lock()
+
+
+def set_event_file(fname):
+    global EVENT_FILE
+    EVENT_FILE = fname
+
+
+def emit_event(event, **fields):
+    """
+    Appends an event to EVENT_FILE, does nothing if it isn't set
+    """
+    if not EVENT_FILE:
+        return
+    fields['event'] = event
+    fields['time'] = round(time.time(), 3)
+    line = json.dumps(fields, sort_keys=True)
+    with _event_lock:
+        try:
+            with open(EVENT_FILE, 'a') as f:
+                f.write(line + '\n')
+        except IOError as e:
+            logger.debug('Failed to write progress event to:{}. {}'
+                         .format(EVENT_FILE, str(e)))
+
+
+def format_seconds(seconds):
+    return(str(datetime.timedelta(seconds=int(round(seconds)))))
+
+
+class Progress(object):
+    """
+    Tracks the progress of a single stage.
+
+        with Progress('matching', total=len(fibers)) as progress:
+            for chunk in chunks:
+                ...
+                progress.update(len(chunk))
+
+    update is thread safe, so it can be called from pool callbacks.
+    """
+    def __init__(self, stage, total=None, unit='fibers', interval=None):
+        self.stage = stage
+        self.total = total
+        self.unit = unit
+        self.interval = LOG_INTERVAL if interval is None else interval
+        self.done = 0
+        self._lock = threading.Lock()
+        self._start = time.time()
+        self._last = self._start
+        emit_event('start', stage=stage, total=total, unit=unit)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.finish(ok=type is None)
+
+    def update(self, n=1):
+        with self._lock:
+            self.done += n
+            now = time.time()
+            if now - self._last < self.interval:
+                return
+            self._last = now
+            self._report('progress', now)
+
+    def finish(self, ok=True):
+        with self._lock:
+            now = time.time()
+            if ok:
+                logger.info('{}: {} {} in {}'.format(
+                    self.stage, self.done, self.unit,
+                    format_seconds(now - self._start)))
+            emit_event('end', stage=self.stage, done=self.done,
+                       total=self.total, unit=self.unit,
+                       seconds=round(now - self._start, 3), ok=ok)
+
+    def _report(self, event, now):
+        elapsed = max(now - self._start, 1e-6)
+        rate = self.done / elapsed
+        eta = None
+        if self.total is not None and rate > 0:
+            eta = max(self.total - self.done, 0) / rate
+
+        done = str(self.done)
+        if self.total is not None:
+            done = '{} / {}'.format(self.done, self.total)
+        msg = '{}: {} {} ({:.1f} {}/s'.format(self.stage, done, self.unit,
+                                              rate, self.unit)
+        if eta is not None:
+            msg = msg + ', ETA {}'.format(format_seconds(eta))
+        logger.info(msg + ')')
+
+        emit_event(event, stage=self.stage, done=self.done,
+                   total=self.total, unit=self.unit,
+                   rate=round(rate, 3),
+                   eta=None if eta is None else round(eta, 1))
@@ -0,0 +1,234 @@
+"""
+A long running tractmapper service.
+
+Holds the atlas labels in memory and maps subjects sent over a local unix
+socket, so each subject doesn't pay for python start up and atlas loading.
+Requests are queued and processed by a pool of worker threads.
+
+Protocol, one json object per line in each direction:
+    request  {"subject": path, "anat": path or null, "output": path or null,
+              "density": bool, optional,
+              "summary": k-means clusters or null, optional,
+              "streamlines": export step in mm or null, optional,
+              "fiber_filter": thresholds or null, optional, see
+                  get_subject_tract_coordinates.read_fiber_filter}
+    response {"status": "ok", "output": path} if output was given
+             {"status": "ok", "result": json string} otherwise
+             {"status": "error", "message": str}, also when the queue
+                 is full
+    request  {"command": "status"}
+    response {"status": "ok", "queued": n, "workers": n, "ready": bool}
+"""
+import json
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import threading
+try:
+    import Queue as queue
+    import SocketServer as socketserver
+except ImportError:
+    import queue
+    import socketserver
+
+import get_subject_tract_coordinates as tractmap
+
+logger = logging.getLogger(__name__)
+
+
+class TractmapService(object):
+    """
+    Queue and worker pool processing subject requests against one atlas.
+    """
+    def __init__(self, atlas_fibers, atlas_clusters, cluster_pattern,
+                 mrml_map, work_dir, bundle_file=None, chunk_fibers=None,
+                 workers=1, queue_size=0, cleanup=False):
+        self.atlas_fibers = atlas_fibers
+        self.atlas_clusters = atlas_clusters
+        self.cluster_pattern = cluster_pattern
+        self.mrml_map = mrml_map
+        self.work_dir = work_dir
+        self.bundle_file = bundle_file
+        self.chunk_fibers = chunk_fibers
+        self.workers = workers
+        self.cleanup = cleanup
+        self.queue = queue.Queue(queue_size)
+
+        self.atlas_file = atlas_fibers
+        self.labels = None
+        self._lock = threading.Lock()
+        self._threads = []
+
+        if bundle_file:
+            # bundles don't need an anat file, so can be loaded up front
+            self.prepare(None)
+
+    def prepare(self, subject_anat):
+        """
+        Loads the atlas labels the first time they are needed.
+        Without a bundle this needs a subject anat file.
+        """
+        with self._lock:
+            if self.labels is None:
+                logger.info('Loading atlas')
+                self.atlas_file, self.labels = tractmap.prepare_atlas(
+                    self.atlas_fibers, self.atlas_clusters,
+                    self.cluster_pattern, self.mrml_map, subject_anat,
+                    os.path.join(self.work_dir, 'atlas'),
+                    self.chunk_fibers, self.bundle_file)
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work,
+                                      name='tractmap-worker-{}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, request):
+        """
+        Queues a request and waits for the response, the request is
+        rejected if the queue is full
+        """
+        if request.get('command') == 'status':
+            return {'status': 'ok',
+                    'queued': self.queue.qsize(),
+                    'workers': self.workers,
+                    'ready': self.labels is not None}
+
+        job = {'request': request,
+               'done': threading.Event(),
+               'response': None}
+        try:
+            self.queue.put_nowait(job)
+        except queue.Full:
+            logger.warning('Queue full, rejected:{}'.format(request))
+            return {'status': 'error',
+                    'message': 'Queue full, {} subjects are waiting'
+                               .format(self.queue.maxsize)}
+        job['done'].wait()
+        return job['response']
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            try:
+                job['response'] = self.process(job['request'])
+            except (Exception, SystemExit) as e:
+                logger.exception('Request failed:{}'.format(job['request']))
+                job['response'] = {'status': 'error', 'message': str(e)}
+            finally:
+                job['done'].set()
+                self.queue.task_done()
+
+    def process(self, request):
+        """
+        Maps the atlas to a single subject
+        """
+        subject_fibers = request['subject']
+        subject_anat = request.get('anat')
+        output = request.get('output')
+        logger.info('Processing subject:{}'.format(subject_fibers))
+
+        self.prepare(subject_anat)
+        subject_dir = tempfile.mkdtemp(prefix='subject_', dir=self.work_dir)
+        export = None
+        if output:
+            export = tractmap.open_streamline_export(
+                output, self.labels, request.get('streamlines'),
+                subject=subject_fibers, anat=subject_anat)
+        try:
+            fiber_ends = tractmap.process_subject(self.atlas_file,
+                                                  subject_fibers,
+                                                  subject_anat,
+                                                  subject_dir,
+                                                  self.labels,
+                                                  self.chunk_fibers,
+                                                  export,
+                                                  request.get('fiber_filter'))
+        finally:
+            if self.cleanup:
+                shutil.rmtree(subject_dir)
+
+        tract_map = self.labels['tract_map']
+        if output:
+            tractmap.write_subject_output(output, fiber_ends, tract_map,
+                                          density=request.get('density',
+                                                              False),
+                                          summary=request.get('summary'),
+                                          subject=subject_fibers,
+                                          anat=subject_anat)
+            return {'status': 'ok', 'output': output}
+        result = tractmap.tract_ends_to_json(
+            tractmap.fiber_ends_to_tracts(fiber_ends, tract_map))
+        return {'status': 'ok', 'result': result}
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        try:
+            request = json.loads(line.decode('utf-8'))
+            if not isinstance(request, dict) or not (
+                    'subject' in request or 'command' in request):
+                raise ValueError('missing subject')
+        except ValueError as e:
+            response = {'status': 'error',
+                        'message': 'Invalid request:{}'.format(str(e))}
+        else:
+            response = self.server.service.submit(request)
+        self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(socket_path, service):
+    """
+    Serves requests on a unix socket until interrupted
+    """
+    if os.path.exists(socket_path):
+        # refuse to take over the socket of a running service
+        try:
+            request(socket_path, {'command': 'status'}, timeout=5)
+        except socket.error:
+            os.remove(socket_path)
+        else:
+            raise RuntimeError('A service is already listening on:{}'
+                               .format(socket_path))
+
+    server = _UnixServer(socket_path, _RequestHandler)
+    server.service = service
+    os.chmod(socket_path, 0o600)
+    service.start()
+    logger.info('Listening on:{}'.format(socket_path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info('Shutting down')
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+
+
+def request(socket_path, payload, timeout=None):
+    """
+    Sends a request to a service and returns its response
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(socket_path)
+        sock.sendall((json.dumps(payload) + '\n').encode('utf-8'))
+        data = b''
+        while not data.endswith(b'\n'):
+            block = sock.recv(2 ** 16)
+            if not block:
+                break
+            data += block
+    finally:
+        sock.close()
+    return json.loads(data.decode('utf-8'))
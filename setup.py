@@ -6,14 +6,24 @@ datadir = os.path.join(basedir, 'data')
 clusterdir = os.path.join(datadir, 'clusters')
 cluster_f = os.listdir(clusterdir)
 cluster_f = [os.path.join(clusterdir, f) for f in cluster_f]
+data_f = ['data/clustered_whole_brain.vtp',
+          'data/clustered_tracts_display_100_percent_aem.mrml']
+# ship the single file atlas bundle when one has been built
+bundle_f = os.path.join(datadir, 'clustered_whole_brain.tmb')
+if os.path.isfile(bundle_f):
+    data_f.append(bundle_f)
 
 setup(name='tractmapper',
       version='0.1.0',
       description="Map DTI tract atlas to subject space and extract fiber coordinates",
       author="Tom Wright",
       author_email="tom@maladmin.com",
-      py_modules=['get_subject_tract_coordinates', 'parse_mrml', 'tempdir', 'docopt'],
-      scripts=['get_subject_tract_coordinates.py', 'parse_mrml.py'],
-      data_files=[('data', ['data/clustered_whole_brain.vtp',
-                            'data/clustered_tracts_display_100_percent_aem.mrml']),
+      py_modules=['get_subject_tract_coordinates', 'parse_mrml', 'tempdir', 'docopt',
+                  'tractmapper', 'atlas_bundle', 'chunkfile', 'streamlines', 'service',
+                  'preflight', 'progress', 'profiling', 'staging',
+                  'streamline_export',
+                  'vtkio'],
+      scripts=['get_subject_tract_coordinates.py', 'parse_mrml.py',
+               'tractmapper.py'],
+      data_files=[('data', data_f),
                   ('data/clusters/', cluster_f)])
@@ -0,0 +1,260 @@
+"""
+Node local scratch staging of the work directory.
+
+Shared filesystems are slow for the many small reads and writes of the
+pipeline. While a Stage is active the pipeline works in a directory on
+node local scratch (e.g. $TMPDIR) instead of --work_dir:
+    - files matching the keep patterns are copied from the work dir to
+      scratch at the start, so caches from earlier runs are still used
+    - input files passed to local() are copied to scratch once and read
+      from there
+    - sync() copies new or changed files matching the keep patterns back
+      to the work dir in a background thread, the pipeline carries on
+    - close() waits for the copies, then moves the scratch directory aside
+      and deletes it in a background process
+
+Keep patterns are fnmatch patterns matched against paths relative to the
+work dir, * also matches /.
+Without an active Stage local() and sync() do nothing, discard() deletes
+straight away.
+"""
+import fnmatch
+import itertools
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+logger = logging.getLogger(__name__)
+
+# the active Stage, used by local, sync and discard
+_ACTIVE = None
+
+
+def local(path):
+    """
+    Returns the path of a scratch copy of an input file,
+    the path itself if no Stage is active
+    """
+    if _ACTIVE is None or not path:
+        return(path)
+    return(_ACTIVE.local(path))
+
+
+def sync():
+    """
+    Starts copying the kept artifacts back to the work dir
+    """
+    if _ACTIVE is not None:
+        _ACTIVE.sync()
+
+
+def discard(path):
+    """
+    Deletes a directory the pipeline is done with. Inside an active Stage
+    its kept artifacts are copied back first and it is deleted with the
+    rest of scratch, otherwise it is deleted now.
+    """
+    if _ACTIVE is not None and _ACTIVE.contains(path):
+        _ACTIVE.discard(path)
+    else:
+        shutil.rmtree(path)
+
+
+def remove_in_background(path):
+    """
+    Moves path aside and deletes it in a separate process, which carries
+    on after this process exits
+    """
+    if not os.path.exists(path):
+        return
+    trash = tempfile.mkdtemp(prefix='.deleting_',
+                             dir=os.path.dirname(os.path.abspath(path)))
+    os.rename(path, os.path.join(trash, os.path.basename(path)))
+    with open(os.devnull, 'wb') as devnull:
+        subprocess.Popen(['rm', '-rf', trash], stdin=devnull, stdout=devnull,
+                         stderr=devnull, close_fds=True,
+                         preexec_fn=os.setsid)
+    logger.debug('Deleting in the background:{}'.format(path))
+
+
+def _copy(src, dst):
+    """
+    Copies a file, readers of dst never see a partial file
+    """
+    dst_dir = os.path.dirname(dst)
+    if not os.path.isdir(dst_dir):
+        try:
+            os.makedirs(dst_dir)
+        except OSError:
+            # created by another thread
+            if not os.path.isdir(dst_dir):
+                raise
+    shutil.copy2(src, dst + '.partial')
+    os.rename(dst + '.partial', dst)
+
+
+class Stage(object):
+    """
+    A work directory on node local scratch.
+
+        with Stage(os.environ['TMPDIR'], work_dir, keep=['*.tmc']) as path:
+            main(..., path, ...)
+
+    Inputs:
+        scratch - directory on node local storage
+        work_dir - persistent work directory, None if nothing is kept
+        keep - fnmatch patterns of the artifacts copied to and from work_dir
+    """
+    def __init__(self, scratch, work_dir=None, keep=()):
+        self.scratch = scratch
+        self.work_dir = work_dir
+        self.keep = list(keep) if work_dir else []
+        self.path = None
+        self._inputs = {}
+        self._synced = {}
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._copier = None
+        self._errors = []
+
+    def __enter__(self):
+        self.start()
+        return self.work_path
+
+    def __exit__(self, *errstuff):
+        self.close()
+
+    def start(self):
+        global _ACTIVE
+        if not os.path.isdir(self.scratch):
+            os.makedirs(self.scratch)
+        self.path = tempfile.mkdtemp(prefix='tractmap_', dir=self.scratch)
+        os.mkdir(os.path.join(self.path, 'work'))
+        if self.work_dir and not os.path.isdir(self.work_dir):
+            os.makedirs(self.work_dir)
+
+        for rel_path in self._find_kept(self.work_dir):
+            _copy(os.path.join(self.work_dir, rel_path),
+                  os.path.join(self.work_path, rel_path))
+            self._synced[rel_path] = self._file_state(rel_path)
+        if self._synced:
+            logger.info('Staged {} cached files from:{}'
+                        .format(len(self._synced), self.work_dir))
+
+        self._copier = threading.Thread(target=self._copy_back,
+                                        name='staging-copier')
+        self._copier.daemon = True
+        self._copier.start()
+        _ACTIVE = self
+        logger.info('Working in:{}'.format(self.work_path))
+
+    @property
+    def work_path(self):
+        return(os.path.join(self.path, 'work'))
+
+    def contains(self, path):
+        path = os.path.abspath(path)
+        return(path.startswith(os.path.abspath(self.path) + os.sep))
+
+    def local(self, path):
+        if self.contains(path):
+            return(path)
+        key = os.path.abspath(path)
+        with self._lock:
+            if key not in self._inputs:
+                # own folder for each input, so names never clash
+                dst = os.path.join(self.path, 'inputs',
+                                   str(next(self._counter)),
+                                   os.path.basename(path))
+                logger.debug('Staging input:{}'.format(path))
+                _copy(path, dst)
+                self._inputs[key] = dst
+            return(self._inputs[key])
+
+    def _find_kept(self, top, base=None):
+        """
+        Finds the kept artifacts under top, returns their paths
+        relative to base, default top
+        """
+        base = base or top
+        if not top or not self.keep or not os.path.isdir(top):
+            return([])
+        found = []
+        for root, _, files in os.walk(top):
+            for fname in files:
+                rel_path = os.path.relpath(os.path.join(root, fname), base)
+                if any(fnmatch.fnmatch(rel_path, p) for p in self.keep):
+                    found.append(rel_path)
+        return(sorted(found))
+
+    def _file_state(self, rel_path):
+        stat = os.stat(os.path.join(self.work_path, rel_path))
+        return((stat.st_size, stat.st_mtime))
+
+    def sync(self, base=None):
+        """
+        Queues new or changed kept artifacts under base, default the whole
+        work dir, for copying back
+        """
+        with self._lock:
+            for rel_path in self._find_kept(base or self.work_path,
+                                            self.work_path):
+                state = self._file_state(rel_path)
+                if self._synced.get(rel_path) != state:
+                    self._synced[rel_path] = state
+                    self._queue.put(rel_path)
+
+    def wait(self):
+        """
+        Waits for the queued copies to finish
+        """
+        self._queue.join()
+
+    def _copy_back(self):
+        while True:
+            rel_path = self._queue.get()
+            try:
+                if rel_path is None:
+                    return
+                _copy(os.path.join(self.work_path, rel_path),
+                      os.path.join(self.work_dir, rel_path))
+                logger.debug('Copied back:{}'.format(rel_path))
+            except (IOError, OSError) as e:
+                logger.error('Failed to copy back:{}. {}'
+                             .format(rel_path, str(e)))
+                self._errors.append(rel_path)
+            finally:
+                self._queue.task_done()
+
+    def discard(self, path):
+        self.sync(path)
+        self.wait()
+        trash = os.path.join(self.path, 'trash')
+        if not os.path.isdir(trash):
+            os.mkdir(trash)
+        os.rename(path, os.path.join(tempfile.mkdtemp(dir=trash),
+                                     os.path.basename(path)))
+
+    def close(self):
+        global _ACTIVE
+        if _ACTIVE is not self:
+            # already closed
+            return
+        try:
+            self.sync()
+            self._queue.put(None)
+            self._copier.join()
+            if self._errors:
+                logger.error('{} files were not copied back to:{}'
+                             .format(len(self._errors), self.work_dir))
+        finally:
+            _ACTIVE = None
+            remove_in_background(self.path)
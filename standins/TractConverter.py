@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""
+Stand-in for tractconverter TractConverter.py, used by benchmark_pipeline.py.
+
+Converts a .vtp or .vtk file to a TrackVis .trk file. Like the real tool the
+coordinates are written unchanged, the anat file only sets the header.
+
+Usage:
+    TractConverter.py -i <input> -o <output> -a <anat> [-f]
+"""
+import os
+import sys
+import numpy as np
+import nibabel as nib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import vtkio  # noqa: E402
+
+TRK_HEADER = np.dtype([('id_string', 'S6'),
+                       ('dim', '<i2', 3),
+                       ('voxel_size', '<f4', 3),
+                       ('origin', '<f4', 3),
+                       ('n_scalars', '<i2'),
+                       ('scalar_name', 'S20', 10),
+                       ('n_properties', '<i2'),
+                       ('property_name', 'S20', 10),
+                       ('vox_to_ras', '<f4', (4, 4)),
+                       ('reserved', 'S444'),
+                       ('voxel_order', 'S4'),
+                       ('pad2', 'S4'),
+                       ('image_orientation_patient', '<f4', 6),
+                       ('pad1', 'S2'),
+                       ('invert_x', 'S1'),
+                       ('invert_y', 'S1'),
+                       ('invert_z', 'S1'),
+                       ('swap_xy', 'S1'),
+                       ('swap_yz', 'S1'),
+                       ('swap_zx', 'S1'),
+                       ('n_count', '<i4'),
+                       ('version', '<i4'),
+                       ('hdr_size', '<i4')])
+
+
+def write_trk(fname, points, offsets, anat):
+    img = nib.load(anat)
+    hdr = np.zeros((), dtype=TRK_HEADER)
+    hdr['id_string'] = b'TRACK'
+    hdr['dim'] = img.shape[:3]
+    hdr['voxel_size'] = img.header.get_zooms()[:3]
+    hdr['vox_to_ras'] = img.affine
+    hdr['voxel_order'] = ''.join(nib.aff2axcodes(img.affine)).encode('ascii')
+    hdr['n_count'] = len(offsets) - 1
+    hdr['version'] = 2
+    hdr['hdr_size'] = TRK_HEADER.itemsize
+
+    points = np.asarray(points, dtype='<f4')
+    with open(fname, 'wb') as f:
+        f.write(hdr.tobytes())
+        for start, stop in zip(offsets[:-1], offsets[1:]):
+            f.write(np.array([stop - start], dtype='<i4').tobytes())
+            f.write(points[start:stop].tobytes())
+
+
+def main(argv):
+    args = dict(zip(argv[::2], argv[1::2]))
+    if not all(key in args for key in ['-i', '-o', '-a']):
+        sys.exit(__doc__)
+    points, offsets = vtkio.read_polydata(args['-i'])
+    write_trk(args['-o'], points, offsets, args['-a'])
+
+
+if __name__ == '__main__':
+    main([arg for arg in sys.argv[1:] if arg != '-f'])
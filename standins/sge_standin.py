@@ -0,0 +1,67 @@
+"""
+Shared code of the qsub, qstat and qacct stand-ins, used to test
+dm-launch-tractmap.py without a Grid Engine cluster.
+
+Jobs run on the local machine, their state is kept in $SGE_STANDIN_DIR
+(default /tmp/sge_standin_<uid>):
+    <id>.sh     the submitted job script
+    <id>.pid    written while the job runs
+    <id>.exit   the exit status, written when the job ends
+With $SGE_STANDIN_HOLD set, submitted jobs stay queued and never run.
+"""
+import fcntl
+import os
+import re
+
+STATE_DIR = os.environ.get('SGE_STANDIN_DIR',
+                           '/tmp/sge_standin_{}'.format(os.getuid()))
+
+
+def get_path(job_id, ext):
+    return(os.path.join(STATE_DIR, '{}.{}'.format(job_id, ext)))
+
+
+def next_job_id():
+    """
+    Allocates a job id, safe with concurrent submissions
+    """
+    if not os.path.isdir(STATE_DIR):
+        os.makedirs(STATE_DIR)
+    with open(os.path.join(STATE_DIR, 'counter'), 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        job_id = int(f.read() or 0) + 1
+        f.seek(0)
+        f.truncate()
+        f.write(str(job_id))
+    return(job_id)
+
+
+def read_directives(script):
+    """
+    Returns a dict of the #$ options of a job script, e.g. {'-N': 'name'}
+    """
+    directives = {}
+    for line in script.splitlines():
+        match = re.match(r'#\$\s+(-\S+)\s*(.*)$', line)
+        if match:
+            directives[match.group(1)] = match.group(2).strip()
+    return(directives)
+
+
+def list_jobs():
+    """
+    Returns a list of (job_id, state) of the jobs that have not ended
+    """
+    if not os.path.isdir(STATE_DIR):
+        return([])
+    jobs = []
+    for fname in os.listdir(STATE_DIR):
+        if not fname.endswith('.sh'):
+            continue
+        job_id = int(fname[:-3])
+        if os.path.isfile(get_path(job_id, 'exit')):
+            continue
+        state = 'r' if os.path.isfile(get_path(job_id, 'pid')) else 'qw'
+        jobs.append((job_id, state))
+    return(sorted(jobs))
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+"""
+Stand-in for whitematteranalysis wm_register_to_atlas_new.py, used by
+benchmark_pipeline.py.
+
+Instead of registering, moves the fibers of <inputFile> with a fixed affine
+transform and writes them where the real tool writes its output,
+<outputDir>/<name>/output_tractography/<name>_reg.vtk, so the result only
+depends on the input.
+
+Usage:
+    wm_register_to_atlas_new.py [-j <n>] <inputFile> <atlasFile> <outputDir>
+"""
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import vtkio  # noqa: E402
+
+# small rotation about z, scaling and translation
+ANGLE = np.radians(5.0)
+AFFINE = np.array([[np.cos(ANGLE), -np.sin(ANGLE), 0, 2.0],
+                   [np.sin(ANGLE), np.cos(ANGLE), 0, -3.0],
+                   [0, 0, 1, 1.0],
+                   [0, 0, 0, 1]]) * [[1.02], [1.02], [1.02], [1]]
+
+
+def main(argv):
+    args = list(argv)
+    if args[:1] == ['-j']:
+        args = args[2:]
+    if len(args) != 3:
+        sys.exit(__doc__)
+    src_file, _, out_dir = args
+
+    name = os.path.splitext(os.path.basename(src_file))[0]
+    points, offsets = vtkio.read_polydata(src_file)
+    points = (np.asarray(points, dtype=np.float64).dot(AFFINE[:3, :3].T) +
+              AFFINE[:3, 3])
+
+    reg_dir = os.path.join(out_dir, name, 'output_tractography')
+    if not os.path.isdir(reg_dir):
+        os.makedirs(reg_dir)
+    vtkio.write_vtk(os.path.join(reg_dir, name + '_reg.vtk'), points, offsets)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,235 @@
+"""
+Compact per tract export of registered streamlines.
+
+The streamlines of a subject are grouped by tract and stored in a chunk file
+(see chunkfile.py). Coordinates are quantized to a grid of step mm and delta
+encoded along each fiber, so every coordinate is within step / 2 of the
+registered coordinate. The deltas are small integers, which compress well
+once shuffled. Each tract has its own arrays, so one tract, or a range of
+fibers in it, can be read without decoding the rest of the file.
+    <tract>/lengths - np.int32 number of points in each fiber
+    <tract>/first - (n_fibers, 3) np.int32 quantized first point of each fiber
+    <tract>/deltas - (n_points - n_fibers, 3) np.int32 difference between
+        each following quantized point and the one before it
+    meta - the step, the error bound, the number of fibers in each tract
+        and the number of fibers without a tract
+"""
+import logging
+import numpy as np
+from chunkfile import ChunkReader, ChunkWriter
+from streamlines import pack_streamlines
+
+logger = logging.getLogger(__name__)
+
+EXPORT_VERSION = 1
+
+DEFAULT_STEP = 0.01
+
+
+class ExportError(Exception):
+    pass
+
+
+def quantize_streamlines(points, offsets, step):
+    """
+    Quantizes packed streamlines, see streamlines.py.
+    Return:
+        A tuple (lengths, first, deltas)
+    """
+    q = np.round(np.asarray(points, dtype=np.float64) / step)
+    if len(q) and np.abs(q).max() >= 2 ** 31:
+        raise ExportError('Coordinates too large for a step of:{}'
+                          .format(step))
+    q = q.astype(np.int32)
+    lengths = np.diff(offsets).astype(np.int32)
+    if np.any(lengths == 0):
+        raise ExportError('Empty streamlines can not be exported')
+    starts = offsets[:-1]
+    is_delta = np.ones(len(q), dtype=bool)
+    is_delta[starts] = False
+    deltas = np.diff(q, axis=0)[is_delta[1:]]
+    return(lengths, q[starts], deltas)
+
+
+def dequantize_streamlines(lengths, first, deltas, step):
+    """
+    Inverse of quantize_streamlines.
+    Return:
+        Packed streamlines (points, offsets)
+    """
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    q = np.zeros((offsets[-1], 3), dtype=np.int64)
+    is_delta = np.ones(len(q), dtype=bool)
+    is_delta[offsets[:-1]] = False
+    q[is_delta] = deltas
+    # running sum restarted at the first point of each fiber
+    q = np.cumsum(q, axis=0)
+    fiber = np.repeat(np.arange(len(lengths)), lengths)
+    q = q - q[offsets[:-1]][fiber] + first.astype(np.int64)[fiber]
+    return((q * step).astype(np.float32), offsets)
+
+
+def take_fibers(lengths, first, deltas, idx):
+    """
+    Selects fibers idx from quantized streamlines
+    """
+    delta_lengths = lengths - 1
+    delta_offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(delta_lengths, out=delta_offsets[1:])
+    counts = delta_lengths[idx]
+    # index of every delta of the selected fibers
+    rows = (np.repeat(delta_offsets[idx] - np.cumsum(counts) + counts,
+                      counts) +
+            np.arange(counts.sum()))
+    return(lengths[idx], first[idx], deltas[rows])
+
+
+class StreamlineExportWriter(object):
+    """
+    Writes the streamlines of a subject grouped by tract.
+
+        with StreamlineExportWriter(fname, cluster_to_tract, tract_names,
+                                    step) as writer:
+            for streams, cluster_ids in chunks:
+                writer.add(streams, cluster_ids)
+
+    Each tract is buffered until it has chunk_rows deltas, so streamlines
+    can be added a few at a time without making the chunks small.
+
+    Inputs:
+        cluster_to_tract - tract id of each cluster id, -1 for no tract,
+            see get_subject_tract_coordinates.make_cluster_to_tract
+        tract_names - list of names indexed by tract id
+        step - size of the quantization grid in mm
+        meta - extra keyword arguments are stored in the file
+    """
+    def __init__(self, fname, cluster_to_tract, tract_names,
+                 step=DEFAULT_STEP, chunk_rows=2 ** 18, **meta):
+        if not step > 0:
+            raise ExportError('Invalid step:{}'.format(step))
+        self.fname = fname
+        self.cluster_to_tract = np.asarray(cluster_to_tract)
+        self.tract_names = list(tract_names)
+        self.step = step
+        self.chunk_rows = chunk_rows
+        self.counts = np.zeros(len(self.tract_names), dtype=np.int64)
+        self.unassigned = 0
+        self._pending = {}
+        self._done = False
+        self._writer = ChunkWriter(fname, chunk_rows=chunk_rows,
+                                   shuffle=True)
+        self._writer.meta = dict(meta)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def add(self, streams, cluster_ids):
+        """
+        Adds streamlines, cluster_ids holds the cluster of each one
+        """
+        tract_ids = self.cluster_to_tract.take(cluster_ids)
+        self.unassigned += int(np.count_nonzero(tract_ids < 0))
+        points, offsets = pack_streamlines(streams)
+        encoded = quantize_streamlines(points, offsets, self.step)
+        for tract_id in np.unique(tract_ids[tract_ids >= 0]):
+            parts = take_fibers(*(encoded +
+                                  (np.flatnonzero(tract_ids == tract_id),)))
+            self.counts[tract_id] += len(parts[0])
+            pending = self._pending.setdefault(int(tract_id), [])
+            pending.append(parts)
+            if sum(len(p[2]) for p in pending) >= self.chunk_rows:
+                self._flush(tract_id)
+
+    def _flush(self, tract_id):
+        pending = self._pending.pop(int(tract_id), [])
+        if not pending:
+            return
+        name = self.tract_names[tract_id]
+        for key, i in [('lengths', 0), ('first', 1), ('deltas', 2)]:
+            self._writer.append('{}/{}'.format(name, key),
+                                np.concatenate([p[i] for p in pending]))
+
+    def close(self):
+        if self._done:
+            return
+        for tract_id in sorted(self._pending):
+            self._flush(tract_id)
+        self._writer.meta.update({
+            'version': EXPORT_VERSION,
+            'units': 'mm',
+            'step': self.step,
+            # per coordinate, the euclidean error is up to sqrt(3) times this
+            'max_error': self.step / 2.0,
+            'tracts': {name: int(count) for name, count
+                       in zip(self.tract_names, self.counts)},
+            'unassigned': self.unassigned})
+        self._writer.close()
+        self._done = True
+        logger.info('Exported {} streamlines to:{}'
+                    .format(int(self.counts.sum()), self.fname))
+
+    def abort(self):
+        if self._done:
+            return
+        self._writer.abort()
+        self._done = True
+
+
+class StreamlineExport(object):
+    """
+    Reads a streamline export.
+
+        with StreamlineExport(fname) as export:
+            points, offsets = export.read_tract('AF_left')
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        self.reader = ChunkReader(fname)
+        meta = self.reader.meta
+        if meta.get('version') != EXPORT_VERSION:
+            raise ExportError('Unsupported export version:{} in {}'
+                              .format(meta.get('version'), fname))
+        self.meta = meta
+        self.step = meta['step']
+        self.tracts = meta['tracts']
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *errstuff):
+        self.close()
+
+    def close(self):
+        self.reader.close()
+
+    def read_tract(self, tract, start=0, stop=None):
+        """
+        Reads fibers start:stop of a tract.
+        Return:
+            Packed streamlines (points, offsets) in mm
+        """
+        if tract not in self.tracts:
+            raise ExportError('No tract:{} in {}'.format(tract, self.fname))
+        n_fibers = self.tracts[tract]
+        if stop is None or stop > n_fibers:
+            stop = n_fibers
+        start = min(start, stop)
+        if not n_fibers:
+            return(np.empty((0, 3), dtype=np.float32),
+                   np.zeros(1, dtype=np.int64))
+
+        all_lengths = self.reader.read('{}/lengths'.format(tract))
+        delta_start = int(all_lengths[:start].sum()) - start
+        lengths = all_lengths[start:stop]
+        first = self.reader.read('{}/first'.format(tract), start, stop)
+        deltas = self.reader.read('{}/deltas'.format(tract), delta_start,
+                                  delta_start + int(lengths.sum()) -
+                                  len(lengths))
+        return(dequantize_streamlines(lengths, first, deltas, self.step))
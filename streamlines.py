@@ -0,0 +1,389 @@
+"""
+Helpers for working with streamlines packed into flat arrays.
+
+A packed set of streamlines is a tuple (points, offsets)
+    points - (n_points, 3) float32 array of all the coordinates
+    offsets - (n_streams + 1) int64 array, streamline i is
+        points[offsets[i]:offsets[i + 1]]
+"""
+import hashlib
+import multiprocessing
+import os
+import threading
+import numpy as np
+import tempdir
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    # only needed for tolerant matching, see make_match_tree
+    cKDTree = None
+
+# fibers matched between progress calls with a single worker,
+# see match_streams
+PROGRESS_BLOCK = 2 ** 16
+
+
+def pack_streamlines(streams):
+    """
+    Packs a list of streamlines into (points, offsets)
+    """
+    lengths = [len(stream) for stream in streams]
+    offsets = np.zeros(len(streams) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    if streams:
+        points = np.concatenate([np.asarray(stream, dtype=np.float32)
+                                 .reshape(-1, 3) for stream in streams])
+    else:
+        points = np.empty((0, 3), dtype=np.float32)
+    return(points, offsets)
+
+
+def unpack_streamlines(points, offsets):
+    """
+    Splits packed points back into a list of streamlines,
+    the streamlines are views into points.
+    """
+    if len(offsets) <= 1:
+        return([])
+    return(np.split(points, offsets[1:-1]))
+
+
+def take_streamlines(points, offsets, idx):
+    """
+    Packs the streamlines idx of a packed set, without unpacking them
+    Returns a tuple (points, offsets)
+    """
+    idx = np.asarray(idx, dtype=np.int64)
+    lengths = np.diff(offsets)[idx]
+    new_offsets = np.zeros(len(idx) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=new_offsets[1:])
+    point_idx = (np.repeat(offsets[:-1][idx] - new_offsets[:-1], lengths) +
+                 np.arange(new_offsets[-1]))
+    return(points[point_idx], new_offsets)
+
+
+def hash_streams(streams):
+    """
+    Returns a np.uint64 hash of the coordinates of each streamline.
+    Equal streamlines have equal hashes, -0.0 and 0.0 are equal.
+    """
+    hashes = np.empty(len(streams), dtype=np.uint64)
+    for i, stream in enumerate(streams):
+        coords = np.ascontiguousarray(normalise_points(stream))
+        digest = hashlib.sha1(coords.tobytes()).digest()
+        hashes[i] = np.frombuffer(digest[:8], dtype=np.uint64)[0]
+    return(hashes)
+
+
+def find_hashes(sorted_hashes, hashes):
+    """
+    Looks up hashes in a sorted hash array.
+    Returns a tuple (idx, found), idx is the position of each hash in
+    sorted_hashes and is only valid where the boolean found is True
+    """
+    if len(sorted_hashes) == 0:
+        return(np.zeros(len(hashes), dtype=np.intp),
+               np.zeros(len(hashes), dtype=bool))
+    idx = np.searchsorted(sorted_hashes, hashes)
+    idx = np.minimum(idx, len(sorted_hashes) - 1)
+    found = sorted_hashes[idx] == hashes
+    return(idx, found)
+
+
+def normalise_points(points):
+    """
+    Returns points as float32 with -0.0 replaced by 0.0,
+    so equal coordinates also have equal bytes
+    """
+    return(np.asarray(points, dtype=np.float32) + np.float32(0))
+
+
+def stream_signatures(points, offsets):
+    """
+    Cheap np.uint64 signature of each streamline, its point count
+    combined with a hash of its first point.
+    Equal streamlines have equal signatures.
+    """
+    counts = np.diff(offsets).astype(np.uint64)
+    signatures = counts.copy()
+    nonempty = counts > 0
+    first = np.ascontiguousarray(points[offsets[:-1][nonempty]],
+                                 dtype=np.float32)
+    bits = first.view(np.uint32).reshape(-1, 3).astype(np.uint64)
+    # FNV style mixing, uint64 arithmetic wraps around
+    sig = counts[nonempty] * np.uint64(0x9E3779B97F4A7C15)
+    for col in range(3):
+        sig = (sig ^ bits[:, col]) * np.uint64(0x100000001B3)
+    signatures[nonempty] = sig
+    return(signatures)
+
+
+def stream_stats(points, offsets):
+    """
+    Point count, arc length and distance between the end points of each
+    streamline, in one pass over the packed points.
+    Return:
+        A tuple (n_points, lengths, end_distances) with one entry per
+        streamline, lengths and distances are 0 below 2 points
+    """
+    n_points = np.diff(offsets)
+    lengths = np.zeros(len(n_points))
+    end_distances = np.zeros(len(n_points))
+    nonempty = n_points > 0
+    if not nonempty.any():
+        return(n_points, lengths, end_distances)
+
+    # segment k joins points k and k + 1, the last point of a
+    # streamline starts no segment
+    segments = np.zeros(len(points))
+    segments[:-1] = np.sqrt(np.square(np.diff(points, axis=0)).sum(axis=1))
+    starts = offsets[:-1][nonempty]
+    stops = offsets[1:][nonempty]
+    segments[stops - 1] = 0
+    # empty streamlines are skipped, so every sum ends where the
+    # next nonempty streamline starts
+    lengths[nonempty] = np.add.reduceat(segments, starts)
+    end_distances[nonempty] = np.sqrt(np.square(
+        np.asarray(points[stops - 1], dtype=np.float64) -
+        points[starts]).sum(axis=1))
+    return(n_points, lengths, end_distances)
+
+
+def resample_streamlines(points, offsets, n_points):
+    """
+    Resamples every streamline to n_points points equally spaced along
+    its arc length, in one pass over the packed points.
+    Streamlines with a single point repeat it, empty streamlines are NaN.
+    Returns a (n_streams, n_points, 3) float32 array
+    """
+    n_streams = len(offsets) - 1
+    resampled = np.full((n_streams, n_points, 3), np.nan, dtype=np.float32)
+    counts = np.diff(offsets)
+    nonempty = np.flatnonzero(counts > 0)
+    if not len(nonempty):
+        return(resampled)
+
+    points = np.asarray(points, dtype=np.float64)
+    starts = offsets[:-1][nonempty]
+    stops = offsets[1:][nonempty]
+    # arc length from the first point, the segments joining two
+    # streamlines are set to 0 so it restarts at each streamline
+    segments = np.zeros(len(points))
+    segments[:-1] = np.sqrt(np.square(np.diff(points, axis=0)).sum(axis=1))
+    segments[stops - 1] = 0
+    arc = np.zeros(len(points))
+    np.cumsum(segments[:-1], out=arc[1:])
+    lengths = arc[stops - 1] - arc[starts]
+
+    # target positions on the global arc, one row per streamline
+    steps = np.linspace(0, 1, n_points)
+    targets = arc[starts][:, None] + lengths[:, None] * steps[None, :]
+    seg = np.searchsorted(arc, targets, side='right') - 1
+    seg = np.clip(seg, starts[:, None],
+                  np.maximum(stops - 2, starts)[:, None])
+    nxt = np.minimum(seg + 1, (stops - 1)[:, None])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        frac = np.where(segments[seg] > 0,
+                        (targets - arc[seg]) / segments[seg], 0)
+    frac = np.clip(frac, 0, 1)[:, :, None]
+    resampled[nonempty] = points[seg] * (1 - frac) + points[nxt] * frac
+    return(resampled)
+
+
+def make_match_tree(resampled):
+    """
+    Builds a KD-tree over resampled streamlines for match_resampled,
+    each streamline is added in both orientations.
+    Inputs:
+        resampled - (n_streams, n_points, 3) array from resample_streamlines
+    Return:
+        A dict {'tree': scipy cKDTree, 'targets': index of the streamline
+                of each tree entry, 'n_points': n_points}
+    """
+    if cKDTree is None:
+        raise ImportError('Tolerant streamline matching needs scipy')
+    n_points = resampled.shape[1]
+    # empty streamlines can't be matched and are left out
+    targets = np.flatnonzero(np.isfinite(resampled).all(axis=(1, 2)))
+    valid = resampled[targets]
+    flat = np.concatenate([valid.reshape(len(targets), -1),
+                           valid[:, ::-1].reshape(len(targets), -1)])
+    return({'tree': cKDTree(flat),
+            'targets': np.concatenate([targets, targets]),
+            'n_points': n_points})
+
+
+def match_resampled(match_tree, resampled, max_distance):
+    """
+    Finds the nearest target streamline of each resampled streamline, in
+    either orientation.
+    The distance between two streamlines is the root mean square distance
+    between their resampled points, in the units of the points.
+    Return:
+        A tuple (idx, distances), idx is the np.int64 target index of
+        each streamline, -1 where the nearest target is further than
+        max_distance, distances is np.inf there
+    """
+    n_streams, n_points = resampled.shape[:2]
+    if n_points != match_tree['n_points']:
+        raise ValueError('Resampled to {} points, the tree has {}'
+                         .format(n_points, match_tree['n_points']))
+    flat = resampled.reshape(n_streams, -1)
+    valid = np.isfinite(flat).all(axis=1)
+    idx = np.full(n_streams, -1, dtype=np.int64)
+    distances = np.full(n_streams, np.inf)
+    if not valid.any() or not len(match_tree['targets']):
+        return(idx, distances)
+
+    scale = np.sqrt(n_points)
+    dist, found = match_tree['tree'].query(
+        flat[valid], k=1, distance_upper_bound=max_distance * scale)
+    matched = np.isfinite(dist)
+    valid_idx = np.flatnonzero(valid)
+    idx[valid_idx[matched]] = match_tree['targets'][found[matched]]
+    distances[valid_idx[matched]] = dist[matched] / scale
+    return(idx, distances)
+
+
+def _make_lookup(target_points, target_offsets, target_idx):
+    """
+    Dict from the bytes of the targets in target_idx to their index
+    """
+    lookup = {}
+    starts = target_offsets[target_idx].tolist()
+    stops = target_offsets[target_idx + 1].tolist()
+    for j, start, stop in zip(target_idx.tolist(), starts, stops):
+        # keep the first target, like a linear search would
+        lookup.setdefault(target_points[start:stop].tobytes(), j)
+    return(lookup)
+
+
+def _lookup_fibers(lookup, fiber_points, fiber_offsets, fiber_idx):
+    starts = fiber_offsets[fiber_idx].tolist()
+    stops = fiber_offsets[fiber_idx + 1].tolist()
+    matches = [lookup.get(fiber_points[start:stop].tobytes(), -1)
+               for start, stop in zip(starts, stops)]
+    return(np.array(matches, dtype=np.int64))
+
+
+def _join_shard(fiber_points, fiber_offsets, fiber_idx,
+                target_points, target_offsets, target_idx):
+    """
+    Exact join of the fibers in fiber_idx against the targets in
+    target_idx. Returns the index of the first equal target of each
+    fiber, -1 if there is none.
+    """
+    lookup = _make_lookup(target_points, target_offsets, target_idx)
+    return(_lookup_fibers(lookup, fiber_points, fiber_offsets, fiber_idx))
+
+
+def _match_shard(args):
+    """
+    Worker for match_streams, reads the packed arrays from data_dir
+    as memory maps and joins a single shard.
+    """
+    data_dir, shard = args
+    arrays = {}
+    for name in ['fiber_points', 'fiber_offsets', 'fiber_shards',
+                 'target_points', 'target_offsets', 'target_shards']:
+        # plain ndarray views of the maps, slicing np.memmap is slow
+        arrays[name] = np.asarray(np.load(os.path.join(data_dir,
+                                                       name + '.npy'),
+                                          mmap_mode='r'))
+    fiber_idx = np.flatnonzero(arrays['fiber_shards'] == shard)
+    target_idx = np.flatnonzero(arrays['target_shards'] == shard)
+    matches = _join_shard(arrays['fiber_points'], arrays['fiber_offsets'],
+                          fiber_idx,
+                          arrays['target_points'], arrays['target_offsets'],
+                          target_idx)
+    return(fiber_idx, matches)
+
+
+def _ignore_progress(n):
+    pass
+
+
+def _get_context():
+    """
+    Worker processes are started by a fork server, or spawned, because
+    forking a process that runs threads, e.g. several atlases at once, can
+    copy locks held by the other threads and deadlock.
+    Python 2 can only fork, this is only done from the main thread.
+    Returns None if no worker processes can be started safely
+    """
+    if not hasattr(multiprocessing, 'get_context'):
+        if threading.current_thread().name == 'MainThread':
+            return(multiprocessing)
+        return(None)
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return(multiprocessing.get_context('forkserver'))
+    return(multiprocessing.get_context('spawn'))
+
+
+def match_streams(fiber_points, fiber_offsets, target_points, target_offsets,
+                  workers=1, work_dir=None, progress=None):
+    """
+    Finds, for each packed fiber, the first exactly equal packed target
+    streamline.
+
+    Fibers and targets are sharded by stream_signatures, equal streamlines
+    always fall in the same shard so each shard is joined independently
+    by a separate worker process. The packed arrays are written to a
+    temporary folder in work_dir and memory mapped by the workers,
+    so they aren't pickled.
+
+    progress, if set, is called with the number of fibers matched as each
+    shard, or each block of PROGRESS_BLOCK fibers with a single worker,
+    finishes. The fibers are matched in this process when worker processes
+    can't be started safely, see _get_context.
+
+    Return:
+        np.int64 vector of target indices, -1 where no target is equal
+    """
+    if progress is None:
+        progress = _ignore_progress
+    fiber_points = normalise_points(fiber_points)
+    target_points = normalise_points(target_points)
+    context = _get_context() if workers > 1 else None
+    if context is None:
+        lookup = _make_lookup(target_points, target_offsets,
+                              np.arange(len(target_offsets) - 1))
+        n_fibers = len(fiber_offsets) - 1
+        matches = np.empty(n_fibers, dtype=np.int64)
+        for start in range(0, n_fibers, PROGRESS_BLOCK):
+            fiber_idx = np.arange(start, min(start + PROGRESS_BLOCK,
+                                             n_fibers))
+            matches[fiber_idx] = _lookup_fibers(lookup, fiber_points,
+                                                fiber_offsets, fiber_idx)
+            progress(len(fiber_idx))
+        return(matches)
+
+    # several shards per worker to even out the load
+    n_shards = np.uint64(workers * 4)
+    arrays = {'fiber_points': fiber_points,
+              'fiber_offsets': fiber_offsets,
+              'fiber_shards': stream_signatures(fiber_points,
+                                                fiber_offsets) % n_shards,
+              'target_points': target_points,
+              'target_offsets': target_offsets,
+              'target_shards': stream_signatures(target_points,
+                                                 target_offsets) % n_shards}
+
+    matches = np.full(len(fiber_offsets) - 1, -1, dtype=np.int64)
+    with tempdir.TempDir(prefix='match_', basedir=work_dir) as data_dir:
+        for name, array in arrays.items():
+            np.save(os.path.join(data_dir, name + '.npy'), array)
+
+        pool = context.Pool(workers)
+        try:
+            results = pool.imap_unordered(_match_shard,
+                                          [(data_dir, shard)
+                                           for shard in range(int(n_shards))])
+            for fiber_idx, shard_matches in results:
+                matches[fiber_idx] = shard_matches
+                progress(len(fiber_idx))
+        finally:
+            pool.close()
+            pool.join()
+
+    return(matches)
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+"""
+Tools for managing tractmapper atlases and services.
+
+Usage:
+    tractmapper.py bundle [options] <bundleFile>
+    tractmapper.py serve [options] <socket>
+    tractmapper.py submit [options] <socket> <subjectFile>
+    tractmapper.py submit [options] <socket> <subjectFile> <anatFile>
+    tractmapper.py relabel [options] <endsFile>...
+
+Commands:
+    bundle      Pack an atlas, its cluster files and the MRML hierarchy
+                into a single atlas bundle file, used with
+                get_subject_tract_coordinates.py --bundle
+    serve       Run a service that keeps the atlas loaded and maps subjects
+                sent to it over the unix socket <socket>
+    submit      Send a subject to a running service, takes the same
+                subject arguments as get_subject_tract_coordinates.py
+    relabel     Regenerate subject outputs for the tracts in --mrml_file,
+                from the _fiber_ends.tmc files saved next to the outputs.
+                Registration and conversion are not rerun
+
+Arguments:
+    <bundleFile>    Path of the atlas bundle to create
+    <socket>        Path to the unix socket of the service
+    <subjectFile>   Full path to a tractography file
+    <anatFile>      Full path to the subject nifti format DTI file
+    <endsFile>      Fiber ends saved by get_subject_tract_coordinates.py
+
+Options:
+    --atlas_file=<atlas_file>       Path to a tractography atlas file (vtp or vtk)
+                                    [default: ./data/clustered_whole_brain.vtp]
+    --cluster_dir=<cluster_dir>     Path to a folder containing the atlas tract clusters
+                                    [default: ./data/clusters/]
+    --mrml_file=<mrml_file>         Path to the atlas mrml (Slicer) file mapping clusters to tracts
+                                    [default: ./data/clustered_tracts_display_100_percent_aem.mrml]
+    --cluster-pattern=<pattern>     A regular expression used to limit files
+                                    in <clusterDir>
+                                    [default: ^.*cluster_\d{5}]
+    --chunk-rows=<rows>             bundle: Number of rows in each compressed
+                                    chunk [default: 262144]
+    --uncompressed                  bundle: Store the arrays uncompressed, so
+                                    they can be memory mapped without decoding
+    --bundle=<file>                 serve: Path to an atlas bundle, used
+                                    instead of the atlas, cluster and mrml files
+    --chunk-fibers=<n>              serve: Stream the atlases n fibers at a time
+    --mirtk_file=<file>             serve: Path to the MIRTK singularity container
+                                    [default: MIRTK.img]
+    --work_dir=<dir>                serve: Where to create intermediate files
+    --workers=<n>                   serve: Number of subjects processed at the
+                                    same time [default: 1]
+    --queue-size=<n>                serve: Maximum number of waiting subjects,
+                                    more are rejected with an error, 0 for no
+                                    limit [default: 0]
+    --threads=<n>                   serve: Number of cores each subject may use.
+                                    Defaults to $NSLOTS if set, otherwise 1
+    --cleanup                       serve: Delete the temporary files of each
+                                    subject
+    --output=<output>               submit: Path to the output file, the result
+                                    is printed if not set
+    --timeout=<seconds>             submit: Give up waiting for the service
+    --output-dir=<dir>              relabel: Write the outputs here, instead
+                                    of replacing the original outputs
+    --density                       submit, relabel: Also write the density
+                                    maps, see get_subject_tract_coordinates.py
+    --summary                       submit, relabel: Also write the tract
+                                    summary, see get_subject_tract_coordinates.py
+    --summary-k=<k>                 submit, relabel: Number of k-means clusters
+                                    in the summary [default: 0]
+    --streamlines                   submit: Also export the registered
+                                    streamlines of each tract
+    --streamline-step=<mm>          submit: Quantization step of the exported
+                                    streamlines [default: 0.01]
+    --debug                         Extra logging information
+    --quiet                         Only log errors
+
+Details:
+    --atlas_file, --cluster_dir or --mrml_file can be specified. If a relative
+    path is provided it is interpreted relative to __file__
+"""
+import logging
+import os
+import sys
+from docopt import docopt
+import atlas_bundle
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+
+def get_int(arguments, option, minimum=None):
+    """
+    Reads an integer option, exits if it isn't one or is below minimum
+    """
+    try:
+        value = int(arguments[option])
+        assert minimum is None or value >= minimum
+    except (ValueError, AssertionError):
+        msg = 'Invalid {}:{}'.format(option, arguments[option])
+        logger.error(msg)
+        sys.exit(msg)
+    return(value)
+
+
+def get_atlas_paths(arguments):
+    """
+    Returns the atlas, cluster dir and mrml paths,
+    relative paths are interpreted relative to __file__
+    """
+    script_dir = os.path.dirname(__file__)
+    paths = []
+    for opt in ['--atlas_file', '--cluster_dir', '--mrml_file']:
+        path = arguments[opt]
+        if not os.path.isabs(path):
+            path = os.path.abspath(os.path.join(script_dir, path))
+        paths.append(path)
+    return(paths)
+
+
+def get_summary(arguments):
+    """
+    Returns the number of k-means clusters of the summary,
+    None without --summary
+    """
+    if not arguments['--summary']:
+        return(None)
+    k = get_int(arguments, '--summary-k')
+    if k < 0:
+        msg = 'Invalid --summary-k:{}'.format(k)
+        logger.error(msg)
+        sys.exit(msg)
+    return(k)
+
+
+def bundle(arguments):
+    atlas_file, cluster_dir, mrml_file = get_atlas_paths(arguments)
+    compress = 0 if arguments['--uncompressed'] else 6
+    try:
+        atlas_bundle.create_bundle(arguments['<bundleFile>'],
+                                   atlas_file,
+                                   cluster_dir,
+                                   mrml_file,
+                                   pattern=arguments['--cluster-pattern'],
+                                   chunk_rows=get_int(arguments,
+                                                      '--chunk-rows', 1),
+                                   compress=compress)
+    except atlas_bundle.BundleError as e:
+        logger.error(str(e))
+        sys.exit(str(e))
+
+
+def relabel(arguments):
+    import get_subject_tract_coordinates as tractmap
+    from parse_mrml import MapTracts
+
+    _, _, mrml_file = get_atlas_paths(arguments)
+    tract_map = MapTracts(mrml_file).tract_map
+
+    output_dir = arguments['--output-dir']
+    if output_dir and not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    summary = get_summary(arguments)
+    failed = []
+    for ends_file in arguments['<endsFile>']:
+        try:
+            outfile = tractmap.relabel_subject(ends_file, tract_map,
+                                               output_dir,
+                                               arguments['--density'],
+                                               summary)
+            logger.info('Relabelled:{}'.format(outfile))
+        except (Exception, SystemExit):
+            logger.exception('Failed to relabel:{}'.format(ends_file))
+            failed.append(ends_file)
+
+    if failed:
+        msg = '{} of {} subjects failed:{}'.format(len(failed),
+                                                   len(arguments['<endsFile>']),
+                                                   ' : '.join(failed))
+        logger.error(msg)
+        sys.exit(msg)
+
+
+def serve(arguments):
+    import tempdir
+    import service
+    import get_subject_tract_coordinates as tractmap
+
+    atlas_file, cluster_dir, mrml_file = get_atlas_paths(arguments)
+    chunk_fibers = None
+    if arguments['--chunk-fibers']:
+        chunk_fibers = get_int(arguments, '--chunk-fibers')
+
+    tractmap.CONTAINER_FILE = arguments['--mirtk_file']
+    threads = arguments['--threads'] or os.environ.get('NSLOTS', 1)
+    try:
+        tractmap.set_thread_count(threads)
+    except ValueError:
+        msg = 'Invalid --threads:{}'.format(threads)
+        logger.error(msg)
+        sys.exit(msg)
+
+    def run(work_dir):
+        svc = service.TractmapService(atlas_file, cluster_dir,
+                                      arguments['--cluster-pattern'],
+                                      mrml_file, work_dir,
+                                      bundle_file=arguments['--bundle'],
+                                      chunk_fibers=chunk_fibers,
+                                      workers=get_int(arguments, '--workers',
+                                                      1),
+                                      queue_size=get_int(arguments,
+                                                         '--queue-size', 0),
+                                      cleanup=arguments['--cleanup'])
+        service.serve(arguments['<socket>'], svc)
+
+    if arguments['--work_dir']:
+        if not os.path.isdir(arguments['--work_dir']):
+            os.mkdir(arguments['--work_dir'])
+        run(arguments['--work_dir'])
+    else:
+        with tempdir.TempDir(prefix="tractmap_") as work_dir:
+            run(work_dir)
+
+
+def submit(arguments):
+    import service
+
+    # the service runs elsewhere, so it needs full paths
+    request = {}
+    for key, arg in [('subject', '<subjectFile>'),
+                     ('anat', '<anatFile>'),
+                     ('output', '--output')]:
+        request[key] = arguments[arg]
+        if request[key]:
+            request[key] = os.path.abspath(request[key])
+
+    request['density'] = arguments['--density']
+    request['summary'] = get_summary(arguments)
+    request['streamlines'] = None
+    if arguments['--streamlines']:
+        try:
+            request['streamlines'] = float(arguments['--streamline-step'])
+        except ValueError:
+            msg = 'Invalid --streamline-step:{}'.format(
+                arguments['--streamline-step'])
+            logger.error(msg)
+            sys.exit(msg)
+
+    timeout = None
+    if arguments['--timeout']:
+        timeout = get_int(arguments, '--timeout')
+
+    response = service.request(arguments['<socket>'], request, timeout)
+    if response['status'] != 'ok':
+        logger.error(response['message'])
+        sys.exit(response['message'])
+    if 'result' in response:
+        print(response['result'])
+
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+
+    if arguments['--debug']:
+        level = logging.DEBUG
+    elif arguments['--quiet']:
+        level = logging.ERROR
+    else:
+        level = logging.INFO
+    logging.getLogger().setLevel(level)
+    for name in [__name__, 'atlas_bundle', 'service', 'progress',
+                 'get_subject_tract_coordinates']:
+        logging.getLogger(name).setLevel(level)
+
+    if arguments['bundle']:
+        bundle(arguments)
+    elif arguments['serve']:
+        serve(arguments)
+    elif arguments['submit']:
+        submit(arguments)
+    elif arguments['relabel']:
+        relabel(arguments)
@@ -0,0 +1,382 @@
+"""
+Minimal readers and writers for VTK polydata tractography files.
+
+Reads the line cells and point coordinates of XML (.vtp) and legacy (.vtk)
+polydata files without needing VTK installed, point and cell data
+arrays are ignored.
+Fibers are returned packed, see streamlines.py
+"""
+import base64
+import logging
+import os
+import zlib
+import xml.etree.ElementTree as ET
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+VTK_TYPES = {'Int8': 'i1', 'UInt8': 'u1',
+             'Int16': 'i2', 'UInt16': 'u2',
+             'Int32': 'i4', 'UInt32': 'u4',
+             'Int64': 'i8', 'UInt64': 'u8',
+             'Float32': 'f4', 'Float64': 'f8'}
+
+LEGACY_TYPES = {'char': 'i1', 'unsigned_char': 'u1',
+                'short': 'i2', 'unsigned_short': 'u2',
+                'int': 'i4', 'unsigned_int': 'u4',
+                'long': 'i8', 'unsigned_long': 'u8',
+                'vtktypeint64': 'i8', 'vtktypeuint64': 'u8',
+                'float': 'f4', 'double': 'f8'}
+
+
+class VTKFormatError(Exception):
+    pass
+
+
+def read_polydata(fname):
+    """
+    Reads the fibers from a .vtp or .vtk file.
+    Returns a tuple (points, offsets), see streamlines.py
+    """
+    ext = os.path.splitext(fname)[1]
+    if ext == '.vtp':
+        return(read_vtp(fname))
+    elif ext == '.vtk':
+        return(read_vtk(fname))
+    raise VTKFormatError('Unrecognised polydata file:{}'.format(fname))
+
+
+def _lines_to_packed(points, connectivity, ends):
+    """
+    Converts line cells to packed streamlines.
+    ends is the end offset of each cell in connectivity.
+    """
+    offsets = np.zeros(len(ends) + 1, dtype=np.int64)
+    offsets[1:] = ends
+    points = np.asarray(points, dtype=np.float32).reshape(-1, 3)
+    connectivity = np.asarray(connectivity, dtype=np.int64)
+    # the connectivity is normally just 0..n, only copy if it isn't
+    if not (len(connectivity) == len(points) and
+            np.array_equal(connectivity, np.arange(len(points)))):
+        points = points.take(connectivity, axis=0)
+    return(points, offsets)
+
+
+# XML (.vtp) files
+
+def read_vtp(fname):
+    """
+    Reads the fibers from a VTK XML PolyData file.
+    Supports ascii, binary and appended (raw or base64) data,
+    with or without zlib compression.
+    Returns a tuple (points, offsets)
+    """
+    with open(fname, 'rb') as f:
+        data = f.read()
+
+    # appended raw data isn't valid xml, so split it from the header
+    appended = None
+    appended_base64 = False
+    start = data.find(b'<AppendedData')
+    if start >= 0:
+        tag_end = data.find(b'>', start)
+        appended_base64 = b'base64' in data[start:tag_end]
+        stop = data.rfind(b'</AppendedData>')
+        appended = data[data.find(b'_', tag_end) + 1:stop]
+        if appended_base64:
+            appended = appended.strip()
+        xml = data[:start] + b'</VTKFile>'
+    else:
+        xml = data
+
+    root = ET.fromstring(xml)
+    if root.get('type') != 'PolyData':
+        raise VTKFormatError('{} is not a PolyData file'.format(fname))
+    byte_order = '<' if root.get('byte_order',
+                                 'LittleEndian') == 'LittleEndian' else '>'
+    header_type = byte_order + VTK_TYPES[root.get('header_type', 'UInt32')]
+    compressed = root.get('compressor') is not None
+
+    def read_array(el):
+        dtype = np.dtype(byte_order + VTK_TYPES[el.get('type')])
+        fmt = el.get('format')
+        if fmt == 'ascii':
+            return(np.array((el.text or '').split(), dtype=dtype))
+        if fmt == 'binary':
+            raw = _decode_base64_array(el.text.strip().encode('ascii'),
+                                       header_type, compressed)
+        elif fmt == 'appended':
+            offset = int(el.get('offset'))
+            if appended_base64:
+                raw = _decode_base64_array(appended[offset:],
+                                           header_type, compressed)
+            else:
+                raw = _decode_raw_array(appended, offset,
+                                        header_type, compressed)
+        else:
+            raise VTKFormatError('Unknown data format:{}'.format(fmt))
+        return(np.frombuffer(raw, dtype=dtype))
+
+    piece = root.find('PolyData/Piece')
+    n_points = int(piece.get('NumberOfPoints'))
+    points = read_array(piece.find('Points/DataArray'))[:n_points * 3]
+    lines = {el.get('Name'): el for el in piece.findall('Lines/DataArray')}
+    if int(piece.get('NumberOfLines', 0)) == 0 or not lines:
+        return(np.asarray(points, dtype=np.float32).reshape(-1, 3)[:0],
+               np.zeros(1, dtype=np.int64))
+    connectivity = read_array(lines['connectivity'])
+    ends = read_array(lines['offsets'])
+    return(_lines_to_packed(points, connectivity, ends))
+
+
+def _decode_raw_array(data, offset, header_type, compressed):
+    """
+    Reads one array from raw appended data
+    """
+    size = np.dtype(header_type).itemsize
+    if not compressed:
+        nbytes = np.frombuffer(data, header_type, 1, offset)[0]
+        return(data[offset + size:offset + size + int(nbytes)])
+
+    n_blocks = int(np.frombuffer(data, header_type, 1, offset)[0])
+    header = np.frombuffer(data, header_type, 3 + n_blocks, offset)
+    pos = offset + (3 + n_blocks) * size
+    blocks = []
+    for comp_size in header[3:]:
+        blocks.append(zlib.decompress(data[pos:pos + int(comp_size)]))
+        pos += int(comp_size)
+    return(b''.join(blocks))
+
+
+def _b64_length(nbytes):
+    """
+    Number of base64 characters used to encode nbytes
+    """
+    return(4 * ((nbytes + 2) // 3))
+
+
+def _decode_base64_array(text, header_type, compressed):
+    """
+    Reads one array from base64 encoded data.
+    Uncompressed arrays encode the header and data together, compressed
+    arrays encode the header and the compressed blocks separately.
+    """
+    size = np.dtype(header_type).itemsize
+    if not compressed:
+        head = base64.b64decode(text[:_b64_length(size)])
+        nbytes = int(np.frombuffer(head[:size], header_type)[0])
+        decoded = base64.b64decode(text[:_b64_length(size + nbytes)])
+        return(decoded[size:size + nbytes])
+
+    head = base64.b64decode(text[:_b64_length(size)])
+    n_blocks = int(np.frombuffer(head[:size], header_type)[0])
+    head_len = _b64_length((3 + n_blocks) * size)
+    header = np.frombuffer(base64.b64decode(text[:head_len]),
+                           header_type, 3 + n_blocks)
+    comp_sizes = [int(c) for c in header[3:]]
+    data = base64.b64decode(text[head_len:head_len +
+                                 _b64_length(sum(comp_sizes))])
+    blocks = []
+    pos = 0
+    for comp_size in comp_sizes:
+        blocks.append(zlib.decompress(data[pos:pos + comp_size]))
+        pos += comp_size
+    return(b''.join(blocks))
+
+
+# legacy (.vtk) files
+
+def read_vtk(fname):
+    """
+    Reads the fibers from a legacy VTK POLYDATA file, ascii or binary.
+    Supports both the count prefixed and the OFFSETS / CONNECTIVITY
+    (version 5) layouts of the LINES section.
+    Returns a tuple (points, offsets)
+    """
+    with open(fname, 'rb') as f:
+        data = f.read()
+
+    lines = data.split(b'\n', 3)
+    if len(lines) < 4 or not lines[0].startswith(b'# vtk DataFile'):
+        raise VTKFormatError('{} is not a legacy vtk file'.format(fname))
+    binary = lines[2].strip().upper() == b'BINARY'
+    reader = _LegacyReader(data, len(b'\n'.join(lines[:3])) + 1, binary)
+
+    points = None
+    connectivity = None
+    ends = None
+    while True:
+        keyword = reader.next_line()
+        if keyword is None:
+            break
+        fields = keyword.split()
+        if not fields:
+            continue
+        name = fields[0].upper()
+        if name == b'DATASET' and fields[1].upper() != b'POLYDATA':
+            raise VTKFormatError('{} is not a POLYDATA file'.format(fname))
+        elif name == b'POINTS':
+            n_points = int(fields[1])
+            dtype = LEGACY_TYPES[fields[2].decode('ascii').lower()]
+            points = reader.read(n_points * 3, dtype)
+        elif name == b'LINES':
+            n_cells, size = int(fields[1]), int(fields[2])
+            nxt = reader.peek_line()
+            if nxt is not None and nxt.split()[:1] == [b'OFFSETS']:
+                reader.next_line()
+                dtype = LEGACY_TYPES[nxt.split()[1].decode('ascii').lower()]
+                cell_offsets = reader.read(n_cells, dtype)
+                conn = reader.next_line().split()
+                dtype = LEGACY_TYPES[conn[1].decode('ascii').lower()]
+                connectivity = reader.read(size, dtype)
+                ends = cell_offsets[1:]
+            else:
+                cells = reader.read(size, 'i4').astype(np.int64)
+                counts = []
+                conn = []
+                pos = 0
+                for i in range(n_cells):
+                    count = int(cells[pos])
+                    counts.append(count)
+                    conn.append(cells[pos + 1:pos + 1 + count])
+                    pos += count + 1
+                connectivity = (np.concatenate(conn) if conn
+                                else np.empty(0, np.int64))
+                ends = np.cumsum(counts)
+        elif name in (b'POINT_DATA', b'CELL_DATA'):
+            break
+        elif name in (b'VERTICES', b'POLYGONS', b'TRIANGLE_STRIPS'):
+            raise VTKFormatError('Unsupported cells {} in:{}'
+                                 .format(name, fname))
+
+    if points is None or ends is None:
+        raise VTKFormatError('No fibers found in:{}'.format(fname))
+    return(_lines_to_packed(points, connectivity, ends))
+
+
+class _LegacyReader(object):
+    """
+    Cursor over the contents of a legacy vtk file
+    """
+    def __init__(self, data, pos, binary):
+        self.data = data
+        self.pos = pos
+        self.binary = binary
+
+    def peek_line(self):
+        pos = self.pos
+        line = self.next_line()
+        self.pos = pos
+        return(line)
+
+    def next_line(self):
+        while self.pos < len(self.data):
+            end = self.data.find(b'\n', self.pos)
+            if end < 0:
+                end = len(self.data)
+            line = self.data[self.pos:end].strip()
+            self.pos = end + 1
+            if line:
+                return(line)
+        return(None)
+
+    def read(self, count, dtype):
+        if self.binary:
+            dtype = np.dtype('>' + dtype)
+            nbytes = count * dtype.itemsize
+            values = np.frombuffer(self.data, dtype, count, self.pos)
+            self.pos += nbytes
+            # skip the newline that ends the binary block
+            if self.data[self.pos:self.pos + 1] == b'\n':
+                self.pos += 1
+            return(values)
+
+        values = []
+        while len(values) < count:
+            line = self.next_line()
+            if line is None:
+                raise VTKFormatError('Unexpected end of file')
+            values.extend(line.split())
+        return(np.array(values[:count], dtype=np.dtype(dtype)))
+
+
+def write_vtk(fname, points, offsets):
+    """
+    Writes packed fibers as a binary legacy VTK POLYDATA file.
+
+    Inputs:
+        points, offsets - packed fibers, see streamlines.py
+            points can also be an iterable of (n, 3) arrays, so large files
+            can be written without loading all the points in memory.
+    """
+    n_points = int(offsets[-1])
+    n_lines = len(offsets) - 1
+    counts = np.diff(offsets)
+
+    with open(fname, 'wb') as f:
+        f.write(b'# vtk DataFile Version 3.0\n')
+        f.write(b'tractmapper\n')
+        f.write(b'BINARY\n')
+        f.write(b'DATASET POLYDATA\n')
+        f.write('POINTS {} float\n'.format(n_points).encode('ascii'))
+        if isinstance(points, np.ndarray):
+            points = [points]
+        for chunk in points:
+            f.write(np.asarray(chunk, dtype='>f4').tobytes())
+        f.write(b'\n')
+
+        f.write('LINES {} {}\n'.format(n_lines,
+                                       n_lines + n_points).encode('ascii'))
+        # write the cells in blocks to keep memory use down,
+        # each cell is its point count followed by its point ids
+        block = 65536
+        for start in range(0, n_lines, block):
+            stop = min(start + block, n_lines)
+            first, last = offsets[start], offsets[stop]
+            cells = np.empty(stop - start + last - first, dtype='>i4')
+            count_pos = (offsets[start:stop] - first +
+                         np.arange(stop - start))
+            is_count = np.zeros(len(cells), dtype=bool)
+            is_count[count_pos] = True
+            cells[is_count] = counts[start:stop]
+            cells[~is_count] = np.arange(first, last)
+            f.write(cells.tobytes())
+        f.write(b'\n')
+
+
+def write_vtp(fname, points, offsets):
+    """
+    Writes packed fibers as a VTK XML PolyData file, with uncompressed
+    base64 binary arrays.
+    """
+    points = np.asarray(points, dtype='<f4').reshape(-1, 3)
+    offsets = np.asarray(offsets, dtype=np.int64)
+
+    def data_array(array, vtk_type, **attrs):
+        raw = np.ascontiguousarray(array).tobytes()
+        header = np.array([len(raw)], dtype='<u4').tobytes()
+        attrs = ''.join(' {}="{}"'.format(k, v)
+                        for k, v in sorted(attrs.items()))
+        return('<DataArray type="{}"{} format="binary">{}</DataArray>\n'
+               .format(vtk_type, attrs,
+                       base64.b64encode(header + raw).decode('ascii')))
+
+    with open(fname, 'w') as f:
+        f.write('<?xml version="1.0"?>\n')
+        f.write('<VTKFile type="PolyData" version="0.1" '
+                'byte_order="LittleEndian" header_type="UInt32">\n')
+        f.write('<PolyData>\n')
+        f.write('<Piece NumberOfPoints="{}" NumberOfLines="{}">\n'
+                .format(len(points), len(offsets) - 1))
+        f.write('<Points>\n')
+        f.write(data_array(points, 'Float32', NumberOfComponents=3))
+        f.write('</Points>\n')
+        f.write('<Lines>\n')
+        f.write(data_array(np.arange(len(points), dtype='<i8'), 'Int64',
+                           Name='connectivity'))
+        f.write(data_array(offsets[1:].astype('<i8'), 'Int64',
+                           Name='offsets'))
+        f.write('</Lines>\n')
+        f.write('</Piece>\n')
+        f.write('</PolyData>\n')
+        f.write('</VTKFile>\n')